@@ -29,27 +29,28 @@ def process_command_line(argv):
 
 
 def compute_union(images, threshold):
+    # rle lives in segment/, which must be on the PYTHONPATH
+    from rle import RLEMask, vote
     import numpy as np
 
-    consensus = np.zeros(images[0].shape)
-
-    n_img = 0
+    masks = []
     for img in images:
-        if 1e4 < np.count_nonzero(img) < 1e6:
-            consensus += (img != 0)
-            n_img += 1
+        mask = RLEMask.from_array(img)
+        if 1e4 < mask.count() < 1e6:
+            masks.append(mask)
 
+    n_img = len(masks)
     if n_img == 0:
         raise ValueError("No image in had an acceptable size.")
 
-    consensus = consensus >= (threshold * n_img)
+    consensus = vote(masks, int(np.ceil(threshold * n_img)))
 
-    if not (1e3 < np.count_nonzero(consensus) < 1e7):
+    if not (1e3 < consensus.count() < 1e7):
         print consensus.shape
         raise ValueError("Consensus image had unacceptable size " +
-                         str(np.count_nonzero(consensus)))
+                         str(consensus.count()))
 
-    return consensus
+    return consensus.to_array(dtype='bool')
 
 
 def label_swap(inname, new_label="consensus"):
@@ -0,0 +1,333 @@
+'''A store for the seed-independent artefacts of a masterseg run (lung masks,
+watershed labels and hierarchies, featurized images and deterministic seed
+tables), kept in media_root and keyed by the study sha and a hash of the
+options that produced them. Run as a script to list or garbage-collect a
+store.'''
+
+from __future__ import print_function
+import sys
+import argparse
+import os
+import json
+import hashlib
+import datetime
+import logging
+
+import numpy as np
+
+import sitkstrats
+
+SIDECAR_EXT = '.meta.json'
+CREATED_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def process_command_line(argv):
+    '''Parse the command line and do a first-pass on processing them into a
+    format appropriate for the rest of the script.'''
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.
+                                     ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        "command", choices=['list', 'gc'],
+        help="List the artefacts in the store, or remove unwanted ones.")
+    parser.add_argument(
+        "media_root",
+        help="The media_root directory holding the store.")
+    parser.add_argument(
+        '--sha', default=None,
+        help="Only consider artefacts for the study with this sha.")
+    parser.add_argument(
+        '--older_than', default=None, type=float, metavar='DAYS',
+        help="(gc) Remove artefacts created more than DAYS days ago.")
+    parser.add_argument(
+        '--dry_run', default=False, action='store_true',
+        help="(gc) Report what would be removed without removing it.")
+
+    args = parser.parse_args(argv[1:])
+
+    return args
+
+
+def opthash(options):
+    '''Produce a short hash of the input options.'''
+
+    sha = hashlib.sha1()
+    sha.update(str(options))
+
+    return sha.hexdigest()[0:8]
+
+
+def checksum(fname, blocksize=2**20):
+    '''Compute the sha1 of the contents of the file fname.'''
+
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+class ArtefactStore(object):
+    '''
+    Artefacts live at <root>/<kind>/<sha>-<opthash><ext>, where kind names the
+    step that produced them. Each is accompanied by a sidecar file recording
+    the info dict of the step that built it and a checksum of the artefact. The
+    sidecar is written last, so an artefact without a valid sidecar is treated
+    as absent.
+
+    Images are written in the format given by image_ext (see sitkstrats.write)
+    unless overridden for their kind in formats. With verify='checksum' every
+    load checksums the artefact; with verify='size' only its size is checked,
+    which avoids reading memory-mapped artefacts in full.
+    '''
+
+    def __init__(self, root, image_ext='.nii', formats=None,
+                 verify='checksum'):
+        self.root = root
+        self.image_ext = image_ext
+        self.formats = formats if formats is not None else {}
+        self.verify = verify
+
+    def path(self, kind, sha, opts, ext=None):
+        '''The file name an artefact of this kind, study and options has.'''
+        if ext is None:
+            ext = self.formats.get(kind, self.image_ext)
+
+        return os.path.join(self.root, kind, sha + "-" + opthash(opts) + ext)
+
+    def _write_sidecar(self, fname, kind, sha, optha, info):
+        '''Record the provenance and checksum of the artefact at fname.'''
+        meta = {'kind': kind,
+                'sha': sha,
+                'opthash': optha,
+                'created': datetime.datetime.now().strftime(CREATED_FORMAT),
+                'checksum': checksum(fname),
+                'bytes': os.path.getsize(fname),
+                'info': info}
+
+        with open(fname + SIDECAR_EXT, 'w') as f:
+            f.write(json.dumps(meta, sort_keys=True, indent=2,
+                               separators=(',', ': '), default=str))
+
+    def _verified_meta(self, fname, verify=None):
+        '''Read the sidecar for fname and check the artefact against it.
+        Raises KeyError if the artefact is missing or fails its check.'''
+        if verify is None:
+            verify = self.verify
+
+        try:
+            with open(fname + SIDECAR_EXT) as f:
+                meta = json.loads(f.read())
+        except (IOError, ValueError):
+            raise KeyError(fname)
+
+        try:
+            if verify == 'size':
+                valid = os.path.getsize(fname) == meta['bytes']
+            else:
+                valid = checksum(fname) == meta['checksum']
+        except (IOError, OSError):
+            valid = False
+
+        if not valid:
+            logging.warning("Artefact '%s' failed its integrity check.", fname)
+            raise KeyError(fname)
+
+        return meta
+
+    def _save(self, fname, kind, sha, optha, img, info):
+        '''Write img to fname, followed by its sidecar.'''
+        sitkstrats.write(img, fname)
+        info['file'] = fname
+        self._write_sidecar(fname, kind, sha, optha, info)
+
+        return info
+
+    def save(self, kind, sha, opts, img, info):
+        '''Store the image img, produced with options opts, along with its
+        info dict. Sets info['file'] to the artefact location.'''
+        return self._save(self.path(kind, sha, opts), kind, sha,
+                          opthash(opts), img, info)
+
+    def load(self, kind, sha, opts):
+        '''Load a stored image and its info dict. Raises KeyError if there is
+        no valid artefact for this kind, study and options.'''
+        fname = self.path(kind, sha, opts)
+        meta = self._verified_meta(fname)
+
+        return (sitkstrats.read(fname), meta['info'])
+
+    def save_json(self, kind, sha, opts, obj):
+        '''Store a JSON-able object, such as a table of seeds.'''
+        fname = self.path(kind, sha, opts, ext='.json')
+
+        try:
+            os.makedirs(os.path.dirname(fname))
+        except OSError:
+            pass
+
+        with open(fname, 'w') as f:
+            f.write(json.dumps(obj, sort_keys=True, default=str))
+        self._write_sidecar(fname, kind, sha, opthash(opts), {'file': fname})
+
+        return obj
+
+    def load_json(self, kind, sha, opts):
+        '''Load a stored JSON-able object. Raises KeyError if there is no
+        valid artefact for this kind, study and options.'''
+        fname = self.path(kind, sha, opts, ext='.json')
+        self._verified_meta(fname)
+
+        with open(fname) as f:
+            return json.loads(f.read())
+
+    def save_arrays(self, kind, sha, opts, arrays, info):
+        '''Store a dict of numpy arrays, such as a watershed hierarchy (see
+        hierarchy.WatershedHierarchy.to_arrays), along with its info dict.'''
+        fname = self.path(kind, sha, opts, ext='.npz')
+
+        try:
+            os.makedirs(os.path.dirname(fname))
+        except OSError:
+            pass
+
+        with open(fname, 'wb') as f:
+            np.savez(f, **arrays)
+        info['file'] = fname
+        self._write_sidecar(fname, kind, sha, opthash(opts), info)
+
+        return info
+
+    def load_arrays(self, kind, sha, opts):
+        '''Load a stored dict of arrays and its info dict. Raises KeyError if
+        there is no valid artefact for this kind, study and options.'''
+        fname = self.path(kind, sha, opts, ext='.npz')
+        meta = self._verified_meta(fname)
+
+        with np.load(fname) as arrays:
+            return (dict(arrays), meta['info'])
+
+    def fetch(self, kind, sha, opts, build):
+        '''Load the image artefact for (kind, sha, opts), or call build() to
+        produce (img, info) and store it if there isn't a valid one.'''
+        try:
+            (img, info) = self.load(kind, sha, opts)
+            logging.info("Loaded '%s' for %s from the artefact store.",
+                         kind, sha)
+        except KeyError:
+            # steps decorate the options dict they are given, so the key must
+            # be taken before building
+            (fname, optha) = (self.path(kind, sha, opts), opthash(opts))
+            (img, info) = build()
+            self._save(fname, kind, sha, optha, img, info)
+
+        return (img, info)
+
+    def entries(self, sha=None):
+        '''
+        List the artefacts (and orphaned sidecars) in the store, as dicts with
+        the keys kind, sha, opthash, file, bytes, created and status, where
+        status is one of 'ok', 'corrupt' or 'orphan'.
+        '''
+        entries = []
+
+        if not os.path.isdir(self.root):
+            return entries
+
+        for kind in sorted(os.listdir(self.root)):
+            kind_dir = os.path.join(self.root, kind)
+            if not os.path.isdir(kind_dir):
+                continue
+
+            for name in sorted(os.listdir(kind_dir)):
+                if not name.endswith(SIDECAR_EXT):
+                    continue
+
+                fname = os.path.join(kind_dir, name[:-len(SIDECAR_EXT)])
+
+                # sha and opthash are recoverable from the name even when the
+                # sidecar is unreadable
+                base = os.path.basename(fname)
+                entry = {'kind': kind, 'file': fname,
+                         'sha': base[:base.rfind('-')],
+                         'opthash': base[base.rfind('-')+1:].split('.')[0],
+                         'created': None, 'bytes': 0}
+
+                try:
+                    meta = self._verified_meta(fname, verify='checksum')
+                    entry.update((k, meta[k]) for k in
+                                 ['sha', 'opthash', 'created'])
+                    entry['status'] = 'ok'
+                except KeyError:
+                    entry['status'] = ('corrupt' if os.path.exists(fname)
+                                       else 'orphan')
+
+                if os.path.exists(fname):
+                    entry['bytes'] = os.path.getsize(fname)
+
+                if sha is None or entry['sha'] == sha:
+                    entries.append(entry)
+
+        return entries
+
+    def remove(self, entry):
+        '''Remove the artefact (and sidecars) described by entry.'''
+        for fname in [entry['file'], entry['file'] + SIDECAR_EXT,
+                      entry['file'] + sitkstrats.NPY_HEADER_EXT,
+                      entry['file'] + sitkstrats.CROP_HEADER_EXT]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def gc(self, older_than=None, sha=None, dry_run=False):
+        '''
+        Remove corrupt artefacts and orphaned sidecars, plus valid artefacts
+        created more than older_than days ago (if given). If sha is given,
+        only that study's artefacts are considered. Returns the removed
+        entries.
+        '''
+        now = datetime.datetime.now()
+        removed = []
+
+        for entry in self.entries(sha):
+            if entry['status'] == 'ok':
+                if older_than is None:
+                    continue
+
+                created = datetime.datetime.strptime(entry['created'],
+                                                     CREATED_FORMAT)
+                if (now - created).total_seconds() < older_than * 86400:
+                    continue
+
+            if not dry_run:
+                self.remove(entry)
+            removed.append(entry)
+
+        return removed
+
+
+def main(argv=None):
+    '''Run the driver script for this module. This code only runs if we're
+    being run as a script. Otherwise, it's silent and just exposes methods.'''
+    args = process_command_line(argv)
+    store = ArtefactStore(os.path.abspath(args.media_root))
+
+    if args.command == 'list':
+        entries = store.entries(args.sha)
+    else:
+        entries = store.gc(args.older_than, args.sha, args.dry_run)
+
+    for entry in entries:
+        print(entry['status'], entry['kind'], entry['sha'], entry['opthash'],
+              entry['bytes'], entry['created'], entry['file'])
+
+    print(len(entries), "artefacts,",
+          sum(e['bytes'] for e in entries), "bytes",
+          "removed" if args.command == 'gc' and not args.dry_run else "")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
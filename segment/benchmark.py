@@ -0,0 +1,758 @@
+'''Benchmarks for the segmentation pipeline. Everything runs on synthetic
+phantoms (see phantom.py), so no patient data is required.'''
+
+from __future__ import print_function
+import os
+import sys
+import subprocess
+import argparse
+import json
+import time
+import random
+import logging
+import resource
+import multiprocessing
+import tempfile
+import shutil
+
+import numpy as np
+import SimpleITK as sitk  # pylint: disable=F0401
+
+import bgwriter
+import lungseg
+import phantom
+import sitkstrats
+import masterseg
+import tracing
+from rle import RLEMask
+
+
+def process_command_line(argv):
+    '''Parse the command line and do a first-pass on processing them into a
+    format appropriate for the rest of the script.'''
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.
+                                     ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    lung = subparsers.add_parser(
+        'lungseg', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Compare the numpy and native-ITK connected-component steps " +
+        "of the lung segmentation.")
+    lung.add_argument(
+        '--size', default=[256, 256, 160], nargs=3, type=int,
+        metavar=('X', 'Y', 'Z'), help="The size of the phantom to segment.")
+    lung.add_argument(
+        '--repeats', default=3, type=int,
+        help="The number of times to run each implementation.")
+    lung.add_argument(
+        '--morphology', default='distance', choices=['kernel', 'distance'],
+        help="The morphology method used between the component steps.")
+
+    geo = subparsers.add_parser(
+        'geodesic', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Compare the whole-image and region-of-interest geodesic " +
+        "strategies for speed and agreement.")
+    geo.add_argument(
+        '--size', default=[192, 192, 128], nargs=3, type=int,
+        metavar=('X', 'Y', 'Z'), help="The size of the phantom to segment.")
+    geo.add_argument(
+        '--image', default=None,
+        help="Segment this image instead of a phantom. Requires --seed.")
+    geo.add_argument(
+        '--seed', default=None, nargs=3, type=int, action='append',
+        metavar=('X', 'Y', 'Z'),
+        help="A seed to segment from (may be given more than once). " +
+        "Defaults to the centers of the phantom's nodules.")
+    geo.add_argument(
+        '--convergence', default=False, action='store_true',
+        help="Run the region of interest strategy in convergence mode " +
+        "(the whole-image strategy is never run in it).")
+    geo.add_argument(
+        '--lung_size', default=None, type=int,
+        help="The lung volume in voxels, which bounds leaking contours " +
+        "in convergence mode.")
+
+    conf = subparsers.add_parser(
+        'confidence', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Compare growing confidence connected regions from every " +
+        "seed with reusing them for seeds inside an earlier seed's region.")
+    conf.add_argument(
+        '--size', default=[192, 192, 128], nargs=3, type=int,
+        metavar=('X', 'Y', 'Z'), help="The size of the phantom to segment.")
+    conf.add_argument(
+        '--nseeds', default=100, type=int,
+        help="The number of seeds, placed at random in the lungs.")
+
+    suite = subparsers.add_parser(
+        'strategies', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Time each sitkstrats strategy on a phantom with vessels and " +
+        "spiculated nodules, optionally against a stored baseline.")
+    suite.add_argument(
+        '--size', default=[192, 192, 128], nargs=3, type=int,
+        metavar=('X', 'Y', 'Z'),
+        help="The size of the phantom to segment (up to 512 512 400).")
+    suite.add_argument(
+        '--repeats', default=1, type=int,
+        help="The number of times to run each strategy.")
+    suite.add_argument(
+        '--nseeds', default=6, type=int,
+        help="The number of seeds each seed-dependent strategy is run on.")
+    suite.add_argument(
+        '--only', default=None, nargs='+', metavar='STEP',
+        help="Only run these steps (see STRATEGY_STEPS).")
+    suite.add_argument(
+        '--save', default=None, metavar='JSON',
+        help="Write the results to this file, eg. as a new baseline.")
+    suite.add_argument(
+        '--baseline', default=None, metavar='JSON',
+        help="Compare the results to a baseline written with --save.")
+    suite.add_argument(
+        '--tolerance', default=0.2, type=float,
+        help="The fractional slowdown over the baseline that counts as a " +
+        "regression.")
+
+    pipe = subparsers.add_parser(
+        'pipeline', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Time masterseg.run_img end to end on a phantom, phase by " +
+        "phase, as the number of seeds and threads grows.")
+    pipe.add_argument(
+        '--size', default=[128, 128, 96], nargs=3, type=int,
+        metavar=('X', 'Y', 'Z'), help="The size of the phantom to segment.")
+    pipe.add_argument(
+        '--nseeds', default=[10, 20, 40], nargs='+', type=int,
+        help="The numbers of seeds to run with.")
+    pipe.add_argument(
+        '--itk_threads', default=[1], nargs='+', type=int,
+        help="The numbers of threads ITK filters may use to run with.")
+    pipe.add_argument(
+        '--write_threads', default=[2], nargs='+', type=int,
+        help="The numbers of background media writers to run with.")
+    pipe.add_argument(
+        '--warm', default=False, action='store_true',
+        help="Also time a second run on each artefact store, so that the " +
+        "seed-independent steps are loaded rather than built.")
+    pipe.add_argument(
+        '--save', default=None, metavar='JSON',
+        help="Write the results to this file.")
+
+    copies = subparsers.add_parser(
+        'copies', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Count the bytes copied between SimpleITK images and numpy " +
+        "arrays by masterseg.run_img on a phantom, per seed.")
+    copies.add_argument(
+        '--size', default=[96, 96, 64], nargs=3, type=int,
+        metavar=('X', 'Y', 'Z'), help="The size of the phantom to segment.")
+    copies.add_argument(
+        '--nseeds', default=10, type=int,
+        help="The number of seeds to run with.")
+    copies.add_argument(
+        '--save', default=None, metavar='JSON',
+        help="Write the counts to this file, eg. to compare against those " +
+        "of another revision.")
+
+    startup = subparsers.add_parser(
+        'startup', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Time a fresh interpreter's import of each entry point, and " +
+        "whether it imports itk.")
+    startup.add_argument(
+        '--repeats', default=5, type=int,
+        help="The number of fresh interpreters to time each import in.")
+    startup.add_argument(
+        '--only', default=None, nargs='+', metavar='MODULE',
+        help="Only time these modules (see STARTUP_MODULES).")
+    startup.add_argument(
+        '--preload', default=False, action='store_true',
+        help="Also time itk_attach.preload(), if itk is installed.")
+
+    args = parser.parse_args(argv[1:])
+
+    return args
+
+
+def _measure_child(conn, func, args):
+    '''Run func in this (child) process and send timings back over conn.'''
+    try:
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu_start = time.clock()
+        wall_start = time.time()
+
+        returned = func(*args)
+
+        result = {'wall': time.time() - wall_start,
+                  'cpu': time.clock() - cpu_start,
+                  'peak_rss_kb': resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss - rss_start}
+        if isinstance(returned, dict):
+            result['returned'] = returned
+
+        conn.send(result)
+    except Exception as exc:  # pylint: disable=W0703
+        conn.send({'error': repr(exc)})
+    finally:
+        conn.close()
+
+
+def measure(func, *args):
+    '''
+    Run func(*args) in a forked child process, so that peak memory use can be
+    measured in isolation. Returns a dict with the wall and cpu time in
+    seconds, and the growth of the peak resident set size (in KiB) over what
+    the child inherited. If func returns a dict, it is included under the key
+    'returned'. Raises RuntimeError if func raised.
+    '''
+    (parent_conn, child_conn) = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_measure_child,
+                                   args=(child_conn, func, args))
+    proc.start()
+    result = parent_conn.recv()
+    proc.join()
+
+    if 'error' in result:
+        raise RuntimeError("Benchmarked function failed: " + result['error'])
+
+    return result
+
+
+def summarize(results):
+    '''Reduce a list of measure() results to the best (minimum) of each
+    quantity, which is the least noisy estimate of the cost.'''
+    return dict((k, min(r[k] for r in results)) for k in results[0]
+                if k != 'returned')
+
+
+LUNGSEG_IMPLS = {
+    'numpy': (lungseg.otsu_numpy,
+              lungseg.find_components_numpy,
+              lungseg.isolate_lung_field_numpy,
+              lungseg.isolate_not_biggest_numpy),
+    'native': (lungseg.otsu,
+               lungseg.find_components,
+               lungseg.isolate_lung_field,
+               lungseg.isolate_not_biggest)
+}
+
+
+def lungseg_pipeline(img, impl, probe_size=7, morphology='distance'):
+    '''Run the lung segmentation pipeline of sitkstrats.segment_lung using the
+    connected-component implementations named by impl.'''
+    (otsu, find_components, isolate_lung_field,
+     isolate_not_biggest) = LUNGSEG_IMPLS[impl]
+
+    img = otsu(img)
+    img = find_components(img)
+    img = isolate_lung_field(img)
+    img = lungseg.dialate(img, probe_size, morphology)
+    img = find_components(img)
+    img = isolate_not_biggest(img)
+    img = lungseg.erode(img, probe_size-2, morphology)
+
+    return img
+
+
+def bench_lungseg(args):
+    '''Compare time and peak memory of the lungseg implementations.'''
+    img = phantom.chest_phantom(size=args.size)
+
+    print("phantom size", args.size, "best of", args.repeats)
+    print("impl", "wall(s)", "cpu(s)", "peak_rss_delta(MiB)")
+
+    for impl in sorted(LUNGSEG_IMPLS):
+        res = summarize([measure(lungseg_pipeline, img, impl, 7,
+                                 args.morphology)
+                         for _ in range(args.repeats)])
+        print(impl, "%.3f" % res['wall'], "%.3f" % res['cpu'],
+              "%.1f" % (res['peak_rss_kb'] / 1024.0))
+
+
+def phantom_nodules(size):
+    '''Nodules of a few sizes placed in the lungs of a phantom of size.'''
+    (x, y, z) = size
+
+    return [((int(0.62 * x), y / 2, z / 2), max(x / 24, 2)),
+            ((int(0.30 * x), int(0.45 * y), int(0.4 * z)), max(x / 48, 1)),
+            ((int(0.70 * x), int(0.55 * y), int(0.6 * z)), max(x / 16, 3))]
+
+
+def dice(img1, img2):
+    '''The Dice coefficient of the foregrounds of two images.'''
+    (a1, a2) = [sitk.GetArrayViewFromImage(i) != 0 for i in (img1, img2)]
+    total = np.count_nonzero(a1) + np.count_nonzero(a2)
+
+    return 2.0 * np.count_nonzero(a1 & a2) / total if total else 1.0
+
+
+def bench_geodesic(args):
+    '''Compare time and agreement of the whole-image and ROI geodesic
+    strategies, seed by seed.'''
+    if args.image is not None:
+        if not args.seed:
+            raise ValueError("Seeds must be given with --image.")
+        img = sitkstrats.read(args.image)
+        seeds = args.seed
+    else:
+        nodules = phantom_nodules(args.size)
+        img = phantom.chest_phantom(size=args.size, nodules=nodules,
+                                    noise=20)
+        seeds = args.seed if args.seed else [list(n[0]) for n in nodules]
+
+    strats = {'full': masterseg.configure_strats()['geodesic'],
+              'roi': masterseg.configure_strats(
+                  geodesic_convergence=args.convergence,
+                  geodesic_roi=True)['geodesic']}
+
+    indep = strats['full']['seed-independent']
+    (feature, _) = indep['strategy'](img, dict(indep['opts']))
+
+    print("image size", img.GetSize(), "convergence", args.convergence)
+    print("seed", "full(s)", "roi(s)", "full_size", "roi_size", "dice")
+
+    for seed in seeds:
+        times = {}
+        outs = {}
+        for (name, strat) in strats.items():
+            opts = dict(strat['seed-dependent']['opts'])
+            opts['seed'] = seed
+            if args.lung_size is not None:
+                opts['lung_size'] = args.lung_size
+
+            start = time.time()
+            (outs[name], _) = strat['seed-dependent']['strategy'](feature,
+                                                                  opts)
+            times[name] = time.time() - start
+
+        print(seed, "%.3f" % times['full'], "%.3f" % times['roi'],
+              np.count_nonzero(sitk.GetArrayViewFromImage(outs['full'])),
+              np.count_nonzero(sitk.GetArrayViewFromImage(outs['roi'])),
+              "%.4f" % dice(outs['full'], outs['roi']))
+
+
+def bench_confidence(args):
+    '''Compare the time taken growing (and dilating) confidence connected
+    regions from every one of many seeds with that taken when seeds inside
+    an earlier seed's region reuse it, as masterseg's --confidence_memo
+    does (see masterseg.memo_lookup).'''
+    nodules = phantom_nodules(args.size)
+    img = phantom.chest_phantom(size=args.size, nodules=nodules, noise=20)
+
+    strat = masterseg.configure_strats()['confidence_connected']
+    indep = strat['seed-independent']
+    (smoothed, _) = indep['strategy'](img, dict(indep['opts']))
+
+    lung = sitk.GetImageFromArray(np.array(
+        sitk.GetArrayViewFromImage(img) == phantom.LUNG, dtype='uint8'))
+    random.seed(0)
+    seeds = [list(n[0]) for n in nodules] + \
+        sitkstrats.distribute_seeds(lung, args.nseeds - len(nodules))
+
+    opts = strat['seed-dependent']['opts']
+
+    start = time.time()
+    for seed in seeds:
+        sitkstrats.confidence_connected(smoothed, dict(opts, seed=seed))
+    per_seed = time.time() - start
+
+    memo = []
+    start = time.time()
+    for seed in seeds:
+        index = (seed[2], seed[1], seed[0])
+        if masterseg.memo_lookup(memo, 'region', smoothed, index) is None:
+            (region, info) = sitkstrats.confidence_connected(
+                smoothed, dict(opts, seed=seed))
+            masterseg.memo_store(memo, 'region', smoothed, index,
+                                 (RLEMask.from_image(region), seed, info))
+    memoised = time.time() - start
+
+    print("image size", img.GetSize(), "seeds", len(seeds))
+    print("per-seed(s)", "memoised(s)", "regions_grown")
+    print("%.3f" % per_seed, "%.3f" % memoised, len(memo))
+
+
+STRATEGY_STEPS = ['segment_lung', 'aniso_gauss', 'aniso_gauss_watershed',
+                  'aniso_gauss_sigmo', 'curvature_flow', 'com_calc',
+                  'confidence_connected', 'fastmarch_seeded_geocontour',
+                  'isolate_watershed', 'segmentation_union',
+                  'crop_to_segmentation']
+
+
+def suite_phantom(size):
+    '''A phantom of size with noise, a vascular tree and both smooth and
+    spiculated nodules, and the seeds at the nodules' centers.'''
+    nodules = phantom_nodules(size)
+    spiculated = [((int(0.35 * size[0]), int(0.55 * size[1]),
+                    int(0.55 * size[2])), max(size[0] / 32, 2), 8)]
+
+    img = phantom.chest_phantom(size=size, nodules=nodules, noise=20,
+                                vessels=phantom.random_vessels(size),
+                                spiculated=spiculated)
+
+    return (img, [list(n[0]) for n in nodules + spiculated])
+
+
+def run_seeds(strategy, img, opts, seeds):
+    '''Run a seed-dependent strategy from each of seeds in turn.'''
+    for seed in seeds:
+        strategy(img, dict(opts, seed=seed))
+
+
+def bench_step(step, func, args, repeats, work, unit):
+    '''Measure func(*args) repeats times, and report the best result with its
+    throughput as work units per second of wall time.'''
+    res = summarize([measure(func, *args) for _ in range(repeats)])
+    res['throughput'] = work / res['wall'] if res['wall'] else float('inf')
+    res['unit'] = unit
+
+    print(step, "%.3f" % res['wall'], "%.3f" % res['cpu'],
+          "%.1f" % (res['peak_rss_kb'] / 1024.0),
+          "%.3g" % res['throughput'], unit)
+
+    return res
+
+
+def compare_baseline(results, baseline, tolerance):
+    '''Print the change in wall time of each step present in both results and
+    baseline. Returns the steps that slowed down by more than tolerance.'''
+    regressions = []
+
+    print("step", "baseline(s)", "now(s)", "change")
+    for step in STRATEGY_STEPS:
+        if step not in results or step not in baseline:
+            continue
+
+        (now, then) = (results[step]['wall'], baseline[step]['wall'])
+        change = now / then - 1 if then else 0.0
+        flag = change > tolerance
+        if flag:
+            regressions.append(step)
+
+        print(step, "%.3f" % then, "%.3f" % now, "%+.1f%%" % (100 * change),
+              "REGRESSION" if flag else "")
+
+    return regressions
+
+
+def bench_strategies(args):
+    '''
+    Time each sitkstrats strategy in its own child process, in pipeline
+    order, on a phantom of args.size. Volume steps report their throughput
+    in megavoxels per second, seed-dependent steps in seeds per second.
+    Returns a dict of the results of each step run.
+    '''
+    steps = args.only if args.only else STRATEGY_STEPS
+    for step in steps:
+        if step not in STRATEGY_STEPS:
+            raise ValueError("Unknown step '" + step + "'.")
+
+    (img, seeds) = suite_phantom(args.size)
+    lung = sitk.GetImageFromArray(np.array(
+        sitk.GetArrayViewFromImage(img) == phantom.LUNG, dtype='uint8'))
+    random.seed(0)
+    seeds = (seeds + sitkstrats.distribute_seeds(lung, args.nseeds))[
+        :args.nseeds]
+
+    mvox = np.prod(args.size) / 1e6
+    strats = masterseg.configure_strats()
+    results = {}
+
+    print("phantom size", args.size, "seeds", len(seeds),
+          "best of", args.repeats)
+    print("step", "wall(s)", "cpu(s)", "peak_rss_delta(MiB)", "throughput")
+
+    # Volume steps run first: aniso_gauss keeps an in-process cache, which
+    # the children would inherit warm once the seed-dependent inputs below
+    # are built in this process.
+    volume_steps = [
+        ('segment_lung', sitkstrats.segment_lung, {'probe_size': 7}),
+        ('aniso_gauss', sitkstrats.aniso_gauss,
+         strats['watershed']['seed-independent']['opts'])]
+    volume_steps += [(strats[s]['seed-independent']['strategy'].__name__,
+                      strats[s]['seed-independent']['strategy'],
+                      strats[s]['seed-independent']['opts'])
+                     for s in ('watershed', 'geodesic',
+                               'confidence_connected')]
+
+    for (step, func, opts) in volume_steps:
+        if step in steps:
+            results[step] = bench_step(step, func, (img, dict(opts)),
+                                       args.repeats, mvox, 'Mvox/s')
+
+    if not [s for s in steps if s not in results]:
+        return results
+
+    # only build the seed-independent inputs the remaining steps need
+    combine = 'segmentation_union' in steps or \
+        'crop_to_segmentation' in steps
+    needed = [s for s in sorted(strats) if combine or
+              strats[s]['seed-dependent']['strategy'].__name__ in steps or
+              (s == 'watershed' and 'com_calc' in steps)]
+
+    (lung, lung_info) = sitkstrats.segment_lung(img, {'probe_size': 7})
+    indep = dict((s, strats[s]['seed-independent']['strategy'](
+        img, dict(strats[s]['seed-independent']['opts']))[0])
+                 for s in needed)
+
+    if 'com_calc' in steps:
+        results['com_calc'] = bench_step(
+            'com_calc', sitkstrats.com_calc,
+            (indep['watershed'], 0.05, 1e-5, lung), args.repeats, mvox,
+            'Mvox/s')
+
+    outs = {}
+    for sname in needed:
+        strat = strats[sname]['seed-dependent']
+        opts = dict(strat['opts'], lung_size=lung_info['size'])
+        step = strat['strategy'].__name__
+
+        if step in steps:
+            results[step] = bench_step(
+                step, run_seeds, (strat['strategy'], indep[sname], opts,
+                                  seeds), args.repeats, len(seeds), 'seeds/s')
+
+        if combine:
+            outs[sname] = strat['strategy'](indep[sname],
+                                            dict(opts, seed=seeds[0]))[0]
+
+    union_opts = {'threshold': 2.0/3.0, 'max_size': lung_info['size'] * 0.5,
+                  'min_size': lung_info['size'] * 1e-5}
+    if 'segmentation_union' in steps:
+        results['segmentation_union'] = bench_step(
+            'segmentation_union', sitkstrats.segmentation_union,
+            (outs.values(), union_opts), args.repeats, mvox, 'Mvox/s')
+
+    if 'crop_to_segmentation' in steps:
+        (consensus, _) = sitkstrats.segmentation_union(outs.values(),
+                                                       dict(union_opts))
+        results['crop_to_segmentation'] = bench_step(
+            'crop_to_segmentation', sitkstrats.crop_to_segmentation,
+            (img, consensus, None, 5), args.repeats, mvox, 'Mvox/s')
+
+    return results
+
+
+PIPELINE_PHASES = ['lungseg', 'seed-independent', 'seeds', 'seed-dependent',
+                   'consensus', 'crop', 'io', 'seed-loop']
+
+
+def run_pipeline(img, nseeds, media_root, itk_threads, write_threads):
+    '''Run masterseg.run_img on img as the masterseg script would, including
+    flushing its writes, and return the time spent in each phase and the
+    number of seeds segmented.'''
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(itk_threads)
+    masterseg.WRITER = bgwriter.BackgroundWriter(nthreads=write_threads)
+
+    random.seed(0)
+    info = masterseg.run_img(img, 'phantom', nseeds, media_root, None)
+
+    with masterseg.phase('io'):
+        masterseg.WRITER.close()
+
+    return {'phases': dict(masterseg.PHASE_TIMES),
+            'seeds': len(info['noduleseg'])}
+
+
+def bench_pipeline(args):
+    '''
+    Time run_img on a phantom of args.size for each combination of the
+    numbers of seeds and threads given, each in a fresh artefact store.
+    Phases (see masterseg.phase) are exclusive of the phases nested in them;
+    'seed-loop' is the per-seed bookkeeping outside of the other phases.
+    Returns a list of the results of each run.
+    '''
+    (img, _) = suite_phantom(args.size)
+    runs = []
+
+    print("phantom size", args.size)
+    print("nseeds", "itk_threads", "write_threads", "store", "wall(s)",
+          "peak_rss_delta(MiB)", "seeds/s", " ".join(PIPELINE_PHASES))
+
+    for nseeds in args.nseeds:
+        for itk_threads in args.itk_threads:
+            for write_threads in args.write_threads:
+                media_root = tempfile.mkdtemp()
+
+                try:
+                    for store in ['cold', 'warm'][:2 if args.warm else 1]:
+                        res = measure(run_pipeline, img, nseeds, media_root,
+                                      itk_threads, write_threads)
+                        phases = res.pop('returned')
+
+                        res.update({'nseeds': nseeds, 'store': store,
+                                    'itk_threads': itk_threads,
+                                    'write_threads': write_threads,
+                                    'seeds': phases['seeds'],
+                                    'phases': phases['phases'],
+                                    'seeds_per_s': nseeds / res['wall']})
+                        runs.append(res)
+
+                        print(nseeds, itk_threads, write_threads, store,
+                              "%.3f" % res['wall'],
+                              "%.1f" % (res['peak_rss_kb'] / 1024.0),
+                              "%.3f" % res['seeds_per_s'],
+                              " ".join("%.3f" % res['phases'].get(p, 0)
+                                       for p in PIPELINE_PHASES))
+                finally:
+                    shutil.rmtree(media_root)
+
+    return runs
+
+
+def bench_copies(args):
+    '''
+    Run run_img on a phantom of args.size under the tracer, and report the
+    image/array conversions (see tracing.CONVERSIONS) made by each strategy
+    and in the seed loop as a whole, per seed. Conversions that copy are
+    counted in bytes; views are counted by number only. Returns the counts.
+    '''
+    (img, _) = suite_phantom(args.size)
+    media_root = tempfile.mkdtemp()
+
+    tracer = tracing.enable()
+    try:
+        random.seed(0)
+        info = masterseg.run_img(img, 'phantom', args.nseeds, media_root,
+                                 None)
+    finally:
+        tracing.disable()
+        shutil.rmtree(media_root)
+
+    nseeds = len(info['noduleseg'])
+    counts = {'nseeds': nseeds, 'total': {}, 'per_seed': {}}
+
+    print("phantom size", args.size, "seeds", nseeds)
+    print("span", "n", "copies", "views", "MiB_copied", "MiB_copied/seed")
+
+    for (key, entry) in sorted(tracing.summarize(tracer).items()):
+        if not key.startswith(('strategy:', 'seed:', 'image:')):
+            continue
+
+        counts['total'][key] = dict((k, entry[k]) for k in (
+            'n', 'conversions', 'views', 'bytes_copied'))
+        counts['per_seed'][key] = entry['bytes_copied'] / float(nseeds)
+
+        print(key, entry['n'], entry['conversions'], entry['views'],
+              "%.2f" % (entry['bytes_copied'] / 2.0**20),
+              "%.3f" % (counts['per_seed'][key] / 2.0**20))
+
+    return counts
+
+
+STARTUP_MODULES = ['itk_attach', 'segstrats', 'geodesic_segment',
+                   'watershed_segment', 'simple_region_growing_segmentation',
+                   'sitkstrats', 'masterseg']
+
+# run in a fresh interpreter: time the statement, then report the time and
+# whether itk was imported, as JSON
+STARTUP_PROBE = '''
+import time, json, sys
+start = time.time()
+%s
+print(json.dumps([time.time() - start, 'itk' in sys.modules]))
+'''
+
+
+def time_startup(statement):
+    '''Run statement in a fresh interpreter in this directory. Returns the
+    wall time of the whole process, that of statement alone and whether itk
+    was imported.'''
+    start = time.time()
+    out = subprocess.check_output(
+        [sys.executable, '-c', STARTUP_PROBE % statement],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    process = time.time() - start
+
+    (elapsed, itk_loaded) = json.loads(out.splitlines()[-1])
+
+    return (process, elapsed, itk_loaded)
+
+
+def bench_startup(args):
+    '''
+    Time the import of each entry point in args.repeats fresh interpreters,
+    reporting the best process wall time (interpreter startup included) and
+    import time. With args.preload, also time itk_attach.preload(), which is
+    where the cost of itk moves to. Returns a dict of the results.
+    '''
+    statements = [(m, 'import ' + m) for m in (args.only or STARTUP_MODULES)]
+    if args.preload:
+        statements.append(('itk_attach.preload',
+                           'import itk_attach; itk_attach.preload()'))
+
+    results = {}
+
+    print("best of", args.repeats)
+    print("entry_point", "process(s)", "import(s)", "imports_itk")
+
+    for (name, statement) in statements:
+        try:
+            runs = [time_startup(statement) for _ in range(args.repeats)]
+        except subprocess.CalledProcessError:
+            print(name, "failed")
+            results[name] = 'failed'
+            continue
+
+        results[name] = {'process': min(r[0] for r in runs),
+                         'import': min(r[1] for r in runs),
+                         'imports_itk': any(r[2] for r in runs)}
+
+        print(name, "%.3f" % results[name]['process'],
+              "%.3f" % results[name]['import'], results[name]['imports_itk'])
+
+    return results
+
+
+def main(argv=None):
+    '''Run the driver script for this module. This code only runs if we're
+    being run as a script. Otherwise, it's silent and just exposes methods.'''
+    args = process_command_line(argv)
+
+    if args.benchmark == 'lungseg':
+        bench_lungseg(args)
+    elif args.benchmark == 'geodesic':
+        bench_geodesic(args)
+    elif args.benchmark == 'confidence':
+        bench_confidence(args)
+    elif args.benchmark == 'startup':
+        bench_startup(args)
+    elif args.benchmark == 'copies':
+        counts = bench_copies(args)
+
+        if args.save is not None:
+            with open(args.save, 'w') as f:
+                f.write(json.dumps(dict(counts, size=args.size),
+                                   sort_keys=True, indent=2,
+                                   separators=(',', ': ')))
+    elif args.benchmark == 'pipeline':
+        runs = bench_pipeline(args)
+
+        if args.save is not None:
+            with open(args.save, 'w') as f:
+                f.write(json.dumps({'size': args.size, 'runs': runs},
+                                   sort_keys=True, indent=2,
+                                   separators=(',', ': ')))
+    elif args.benchmark == 'strategies':
+        results = bench_strategies(args)
+        record = {'size': args.size, 'nseeds': args.nseeds,
+                  'repeats': args.repeats, 'results': results}
+
+        if args.save is not None:
+            with open(args.save, 'w') as f:
+                f.write(json.dumps(record, sort_keys=True, indent=2,
+                                   separators=(',', ': ')))
+
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                baseline = json.loads(f.read())
+            if baseline['size'] != args.size:
+                logging.warning("The baseline was measured on a phantom " +
+                                "of size %s, not %s.", baseline['size'],
+                                args.size)
+
+            if compare_baseline(results, baseline['results'],
+                                args.tolerance):
+                return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,122 @@
+'''Write images to disk from background threads, so that compression and I/O
+overlap with computation on the critical path.'''
+
+import threading
+import logging
+import Queue
+
+import sitkstrats
+
+
+def memory_available():
+    '''The memory available to new allocations in bytes, as reported by
+    /proc/meminfo, or None where that isn't available.'''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    return None
+
+
+class BackgroundWriter(object):
+    '''
+    A pool of threads writing images with sitkstrats.write. write() queues an
+    image and returns immediately, unless the writer is backed up: it blocks
+    while max_pending images (or max_pending_bytes of pixel data) are already
+    queued, or while the system has less than min_available_bytes free. Write
+    errors are collected and raised by the next call to flush() or close().
+    With nthreads=0 images are written synchronously.
+    '''
+
+    def __init__(self, nthreads=2, max_pending=16, max_pending_bytes=2**30,
+                 min_available_bytes=2**29):
+        self.nthreads = nthreads
+        self.max_pending_bytes = max_pending_bytes
+        self.min_available_bytes = min_available_bytes
+
+        self.queue = Queue.Queue(maxsize=max_pending)
+        self.errors = []
+
+        # pending_bytes is guarded by the condition, which is notified
+        # whenever an image finishes writing
+        self.pending_bytes = 0
+        self.written = threading.Condition()
+
+        self.threads = [threading.Thread(target=self._work,
+                                         name="bgwriter-" + str(i))
+                        for i in range(nthreads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        '''Write queued images until a None sentinel is received.'''
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                self.queue.task_done()
+                return
+
+            (img, fname, kwargs, nbytes) = item
+            try:
+                sitkstrats.write(img, fname, **kwargs)
+            except Exception as exc:  # pylint: disable=W0703
+                logging.error("Background write of %s failed: %s",
+                              fname, exc)
+                self.errors.append((fname, exc))
+            finally:
+                with self.written:
+                    self.pending_bytes -= nbytes
+                    self.written.notify_all()
+                self.queue.task_done()
+
+    def _backed_up(self):
+        '''True if another image shouldn't be queued yet.'''
+        if self.pending_bytes == 0:
+            return False
+        elif self.pending_bytes >= self.max_pending_bytes:
+            return True
+
+        available = memory_available()
+        return available is not None and available < self.min_available_bytes
+
+    def write(self, img, fname, **kwargs):
+        '''Queue img to be written to fname. Keyword arguments are passed on
+        to sitkstrats.write.'''
+        if not self.threads:
+            sitkstrats.write(img, fname, **kwargs)
+            return
+
+        nbytes = sitkstrats.image_nbytes(img)
+
+        with self.written:
+            while self._backed_up():
+                self.written.wait(1.0)
+            self.pending_bytes += nbytes
+
+        self.queue.put((img, fname, kwargs, nbytes))
+
+    def flush(self):
+        '''Block until every queued image is written. Raises IOError if any
+        write has failed since the last flush.'''
+        self.queue.join()
+
+        if self.errors:
+            (errors, self.errors) = (self.errors, [])
+            raise IOError(str(len(errors)) + " background writes failed, " +
+                          "first " + errors[0][0] + ": " + str(errors[0][1]))
+
+    def close(self):
+        '''Flush the writer and stop its threads.'''
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        self.flush()
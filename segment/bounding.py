@@ -7,13 +7,16 @@ def bounding_cube(arr):
     to the limits along each of the axes 0, 1, and 2.
     '''
     assert len(arr.shape) == 3
-    a0_columns = np.any(arr, axis=0)
-    (a2lim, a1lim) = bounding_box(a0_columns)
 
-    (a2lim_extra, a0lim) = bounding_box(np.any(arr, axis=1))
+    # one pass over the volume gives the limits along axes 1 and 2
+    (a2lim, a1lim) = bounding_box(np.any(arr, axis=0))
 
-    assert a2lim == a2lim_extra
-    assert bounding_box(np.any(arr, axis=2)) == (a1lim, a0lim)
+    # those along axis 0 are found by scanning planes in from either end, so
+    # only the empty planes outside the box are read again
+    planes = range(arr.shape[0])
+    a0lim = (next((i for i in planes if np.any(arr[i])), 0),
+             next((i + 1 for i in reversed(planes) if np.any(arr[i])),
+                  arr.shape[0]))
 
     return (a0lim, a1lim, a2lim)
 
@@ -45,3 +48,161 @@ def bounding_line(arr):
     last_true = len(arr) - np.argmax(arr[::-1])
 
     return (first_true, last_true)
+
+
+def label_bounding_boxes(labels, index=None):
+    '''
+    Find the bounding box of every positive label of the integer array
+    labels in a single pass (see scipy.ndimage.find_objects). Returns a dict
+    from each label present to its limits, as (first, last+1) pairs along
+    each axis like bounding_cube. If index is given, only the labels in it
+    are reported.
+    '''
+    from scipy.ndimage import find_objects
+
+    if index is not None:
+        index = set(int(i) for i in index)
+        if not index:
+            return {}
+        max_label = max(index)
+    else:
+        max_label = 0
+
+    boxes = {}
+    for (i, box) in enumerate(find_objects(labels, max_label)):
+        if box is not None and (index is None or i + 1 in index):
+            boxes[i + 1] = tuple((int(s.start), int(s.stop)) for s in box)
+
+    return boxes
+
+
+def stacked_bounding_boxes(masks):
+    '''
+    Find the bounding boxes of a sequence (or iterable) of masks of the same
+    shape, all at once. Each mask is reduced to its projections onto the axes
+    as it arrives, so the masks are never stacked or copied. Returns a list of
+    limits like bounding_cube, with None for empty masks.
+    '''
+    projections = []
+
+    for mask in masks:
+        # a pass over the mask projects out its first axis, from which the
+        # remaining axes' projections are found; a second gives the first's
+        rest = np.any(mask, axis=0)
+        projected = [np.any(np.reshape(mask, (len(mask), -1)), axis=1)]
+        projected += [np.any(rest, axis=tuple(a for a in range(rest.ndim)
+                                              if a != axis))
+                      for axis in range(rest.ndim)]
+
+        if not projections:
+            projections = [[] for _ in projected]
+        for (axis, line) in enumerate(projected):
+            projections[axis].append(line)
+
+    if not projections:
+        return []
+
+    projections = [np.array(p) for p in projections]
+    n_masks = len(projections[0])
+
+    lower = np.array([np.argmax(p, axis=1) for p in projections]).T
+    upper = np.array([p.shape[1] - np.argmax(p[:, ::-1], axis=1)
+                      for p in projections]).T
+    present = projections[0].any(axis=1)
+
+    return [tuple((int(l), int(u)) for (l, u) in zip(lower[i], upper[i]))
+            if present[i] else None for i in range(n_masks)]
+
+
+class LabelIndex(object):
+    '''
+    An index of the voxels holding each label of an integer label array,
+    built once (by sorting the array) so that any label's voxels, bounding
+    box or mask can be found in time proportional to the label's size rather
+    than the array's.
+    '''
+
+    def __init__(self, arr):
+        self.shape = arr.shape
+
+        flat = arr.ravel()
+
+        # a stable sort keeps each label's voxels in raster order
+        order = np.argsort(flat, kind='mergesort')
+        (self.labels, self.starts, self.counts) = np.unique(
+            flat[order], return_index=True, return_counts=True)
+
+        # the bounding box of every label, in numpy axis order, computed an
+        # axis at a time to limit the temporary arrays to one
+        self.lower = np.empty((len(self.labels), len(self.shape)),
+                              dtype='int64')
+        self.upper = np.empty(self.lower.shape, dtype='int64')
+
+        stride = flat.size
+        for (axis, n) in enumerate(self.shape):
+            stride //= n
+            coords = order // stride
+            coords %= n
+            self.lower[:, axis] = np.minimum.reduceat(coords, self.starts)
+            self.upper[:, axis] = np.maximum.reduceat(coords, self.starts) + 1
+
+        # flat indices fit in 32 bits for any image we're likely to see
+        index_type = 'uint32' if flat.size < 2**32 else 'int64'
+        self.order = order.astype(index_type)
+
+    @property
+    def nbytes(self):
+        '''The memory held by the index's arrays.'''
+        return sum(a.nbytes for a in (self.order, self.labels, self.starts,
+                                      self.counts, self.lower, self.upper))
+
+    @classmethod
+    def from_image(cls, img):
+        '''Index the labels of the SimpleITK image img.'''
+        import views
+
+        return cls(views.array_view(img))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        i = np.searchsorted(self.labels, label)
+        return i < len(self.labels) and self.labels[i] == label
+
+    def __repr__(self):
+        # this appears in options dicts, so must be stable between runs
+        return "LabelIndex(shape=" + str(self.shape) + ", labels=" + \
+            str(len(self.labels)) + ")"
+
+    def _position(self, label):
+        '''The position of label in self.labels. Raises KeyError if label
+        doesn't appear in the array.'''
+        if label not in self:
+            raise KeyError(label)
+
+        return np.searchsorted(self.labels, label)
+
+    def voxels(self, label):
+        '''The flat (raster order) indices of the voxels holding label.'''
+        i = self._position(label)
+
+        return self.order[self.starts[i]:self.starts[i] + self.counts[i]]
+
+    def bounding_box(self, label):
+        '''The limits of the smallest box containing label, as (first,
+        last+1) pairs along each axis like bounding_cube.'''
+        i = self._position(label)
+
+        return tuple(zip(self.lower[i], self.upper[i]))
+
+    def mask(self, label):
+        '''A uint8 mask of label, cropped to its bounding box, along with the
+        bounding box.'''
+        lims = self.bounding_box(label)
+
+        mask = np.zeros([u - l for (l, u) in lims], dtype='uint8')
+        coords = np.unravel_index(self.voxels(label), self.shape)
+        mask[tuple(c - l for (c, (l, _)) in zip(coords, lims))] = 1
+
+        return (mask, lims)
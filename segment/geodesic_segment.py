@@ -44,6 +44,9 @@ def process_command_line(argv):
     parser.add_argument('--intermediate_images', action="store_true",
                         default=False, help="Produce pipeline intermediate " +
                         "images (i.e. after each filter stage.")
+    parser.add_argument('--preload', action="store_true", default=False,
+                        help="Load itk and the filters used before " +
+                        "segmenting, rather than with the first image.")
 
     args = parser.parse_args(argv[1:])
 
@@ -74,6 +77,10 @@ def main(argv=None):
     allstart = datetime.datetime.now()
     args = process_command_line(argv)
 
+    if args.preload:
+        import itk_attach
+        print "Loaded itk in", itk_attach.preload(), "seconds"
+
     print "Segmenting", len(args.images), "images"
     times = []
     skipped = []
@@ -1,18 +1,78 @@
-'''A library of itk-attach functions, to be used to build out itk pipelines.'''
+'''A library of itk-attach functions, to be used to build out itk pipelines.
+itk is slow to import, so it is only imported once a pipeline is built (or
+preload is called); importing this module doesn't import it.'''
+
+import time
+import datetime
+
+# Template instantiations and the type combinations templates are
+# instantiated for. Looking these up in ITK's wrapping is slow, so each is
+# resolved once per process and reused by every pipeline built thereafter.
+_INSTANTIATIONS = {}
+_TEMPLATE_TYPES = {}
+_IMAGE_TYPES = {}
+
+# The itk filters used by the pipelines in segstrats, loaded by preload.
+PRELOAD = ['ImageFileReader', 'ImageFileWriter', 'StatisticsImageFilter',
+           'CastImageFilter', 'CurvatureFlowImageFilter',
+           'CurvatureAnisotropicDiffusionImageFilter',
+           'GradientMagnitudeImageFilter',
+           'GradientMagnitudeRecursiveGaussianImageFilter',
+           'SigmoidImageFilter', 'FastMarchingImageFilter',
+           'GeodesicActiveContourLevelSetImageFilter',
+           'BinaryThresholdImageFilter', 'WatershedImageFilter',
+           'ConfidenceConnectedImageFilter', 'BinaryFillholeImageFilter',
+           'VotingBinaryIterativeHoleFillingImageFilter']
+
+
+def instantiation(template, *types):
+    '''The class instantiating the itk template for the given types, resolved
+    once per (template, types) and cached.'''
+    key = (template, types)
+
+    if key not in _INSTANTIATIONS:
+        _INSTANTIATIONS[key] = template[types if len(types) > 1 else types[0]]
+
+    return _INSTANTIATIONS[key]
+
+
+def template_types(template):
+    '''The type combinations for which template is instantiated, resolved
+    once per template and cached.'''
+    if template not in _TEMPLATE_TYPES:
+        _TEMPLATE_TYPES[template] = [t for t in template]
+
+    return _TEMPLATE_TYPES[template]
 
 
 def IMG_UC(dim=3):  # pylint: disable=invalid-name
     '''dynamically load unsigned character 3d image type to preven super long
     loads on import.'''
     from itk import UC, Image  # pylint: disable=no-name-in-module
-    return Image[UC, dim]
+    return instantiation(Image, UC, dim)
 
 
 def IMG_F(dim=3):  # pylint: disable=invalid-name
     '''dynamically load 3d float image type to preven super long loads when
     on import.'''
     from itk import F, Image  # pylint: disable=no-name-in-module
-    return Image[F, dim]
+    return instantiation(Image, F, dim)
+
+
+def preload(names=None):
+    '''Import itk and load the given filters (by default those in PRELOAD)
+    and the image types, resolving the type combinations of each, so that
+    pipelines built afterwards pay none of the cost of loading them. Useful
+    in long-running batch processes. Returns the time taken, in seconds.'''
+    start = time.time()
+    import itk
+
+    for name in PRELOAD if names is None else names:
+        template_types(getattr(itk, name))
+    IMG_F()
+    IMG_UC()
+
+    return time.time() - start
 
 
 def extract_image_type(img_type):
@@ -20,29 +80,95 @@ def extract_image_type(img_type):
     an itk Image its PixelType'''
     import itk
 
-    type_abbrev = img_type.__name__[img_type.__name__.rfind("Image")+5:-1]
-    dim = int(img_type.__name__[-1])
+    if img_type not in _IMAGE_TYPES:
+        type_abbrev = img_type.__name__[img_type.__name__.rfind("Image")+5:-1]
+        dim = int(img_type.__name__[-1])
+
+        _IMAGE_TYPES[img_type] = (getattr(itk, type_abbrev), dim)
+
+    return _IMAGE_TYPES[img_type]
+
+
+def graph(sink):
+    '''The stages of the pipeline graph ending at sink, each once, with every
+    stage after the stages it takes input from.'''
+    order = []
+
+    def visit(stage):  # pylint: disable=C0111
+        if any(s is stage for s in order):
+            return
+        for upstream in (getattr(stage, 'prev', None),
+                         getattr(stage, 'prev_feature', None)):
+            if upstream is not None:
+                visit(upstream)
+        order.append(stage)
+
+    visit(sink)
+
+    return order
+
+
+def validate(sink):
+    '''Resolve the types of every stage of the graph ending at sink and
+    instantiate their filters, upstream stages first, before anything is
+    executed. Raises a TypeError listing every stage that can't be
+    resolved.'''
+    errors = []
+
+    for stage in graph(sink):
+        try:
+            stage.resolve()
+        except (TypeError, KeyError, AttributeError, IndexError) as exc:
+            errors.append(type(stage).__name__ + ": " + str(exc))
+
+    if errors:
+        raise TypeError("Invalid pipeline:\n" + "\n".join(errors))
+
+
+class Pipeline(object):
+    '''
+    A validated pipeline graph, ready to execute. The time spent building the
+    graph (loading itk, resolving templates and instantiating filters, from
+    the construction of its first stage until it was validated here) is
+    reported separately from the time spent executing it.
+    '''
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.stages = graph(sink)
 
-    return (getattr(itk, type_abbrev), dim)
+        validate(sink)
+
+        self.build_time = datetime.timedelta(
+            seconds=time.time() - min(s.created for s in self.stages))
+        self.run_time = None
+
+    def execute(self):
+        '''Execute the pipeline, returning the output of its sink.'''
+        start = time.time()
+        out = self.sink.execute()
+        self.run_time = datetime.timedelta(seconds=time.time() - start)
+
+        return out
+
+    def times(self):
+        '''The build and run times of the pipeline, as a JSON-able dict (with
+        the repo's DateTimeEncoder).'''
+        return {'build_time': self.build_time, 'run_time': self.run_time}
 
 
 class PipeStage(object):
-    '''A stub itk pipeline stage, to be inherited from by other classes.'''
+    '''A stub itk pipeline stage, to be inherited from by other classes. The
+    wrapped filter is instantiated when the stage is resolved (see validate),
+    or at the latest when it is executed, rather than when it is built.'''
 
     def __init__(self, template, previous_stage, params=None):
+        self.created = time.time()
         self.prev = previous_stage
         self.template = template
-        self.instance = self._instantiate(template)
-
-        if params is not None:
-            try:
-                for param in params:
-                    set_method = getattr(self.instance, param)
-                    set_method(params[param])
-            except TypeError:
-                print "Failed to set the parameter", param, "on", \
-                      type(self.instance)
-                raise
+        self.params = params if params is not None else {}
+        self.instance = None
+        self.types = None
 
     def in_type(self):
         '''Get the itk type that is input for this pipe stage. Default
@@ -59,10 +185,44 @@ class PipeStage(object):
     def _instantiate(self, template):
         '''Instantiate an instance of the wrapped class template for use.
         Useful to override in cases where there is unusual templating.'''
-        instance = template[self.in_type(), self.out_type()].New()
+        instance = instantiation(template, self.in_type(),
+                                 self.out_type()).New()
 
         return instance
 
+    def _configure(self, instance):
+        '''A hook for configuring the instance once it has been instantiated
+        and its params set.'''
+        pass
+
+    def resolve(self):
+        '''Resolve the types flowing into this stage and, the first time,
+        instantiate the wrapped filter for them and set its params. Raises a
+        TypeError if no instantiation matches, or if the types have changed
+        since the filter was instantiated.'''
+        types = (self.in_type(), self.out_type())
+
+        if self.instance is None:
+            try:
+                instance = self._instantiate(self.template)
+            except KeyError:
+                raise TypeError("no instantiation of " + str(self.template) +
+                                " for " + str(types))
+
+            for param in self.params:
+                try:
+                    getattr(instance, param)(self.params[param])
+                except TypeError:
+                    print "Failed to set the parameter", param, "on", \
+                          type(instance)
+                    raise
+
+            self._configure(instance)
+            (self.instance, self.types) = (instance, types)
+        elif types != self.types:
+            raise TypeError("instantiated for " + str(self.types) +
+                            " but given " + str(types))
+
     def _finished(self, instance):
         '''A hook for asking questions about the instance after instance.
         Update() has been run. Useful for debugging or printing informative
@@ -80,6 +240,8 @@ class PipeStage(object):
         from this pipeline stage. Returns the result of a GetOutput call to
         the wrapped itk object.'''
 
+        self.resolve()
+
         # this can't happen in the constructor since it requires a call to
         # execute()
         self._bind_input()
@@ -99,7 +261,7 @@ class StatsStage(PipeStage):
         super(StatsStage, self).__init__(stats, previous_stage)
 
     def _instantiate(self, template):
-        return template[self.in_type()].New()
+        return instantiation(template, self.in_type()).New()
 
     def max(self):
         '''Get the maximum value of the input pipestage. Induces a call to
@@ -136,7 +298,7 @@ class BinaryStage(PipeStage):
     '''A generic superclass to manage one-templated binary image filters.'''
 
     def _instantiate(self, template):
-        return template[self.in_type()].New()
+        return instantiation(template, self.in_type()).New()
 
     def _bind_input(self):
         # at the last possible second, determine the appropriate forground
@@ -156,13 +318,13 @@ class VotingIterativeBinaryFillholeStage(BinaryStage):
         # pylint: disable=no-name-in-module,no-member
         from itk import VotingBinaryIterativeHoleFillingImageFilter as fillhole
 
+        params = {"SetMaximumNumberOfIterations": kwargs.get('iterations', 10),
+                  "SetMajorityThreshold": kwargs.get('threshold', 3)}
+
         super(VotingIterativeBinaryFillholeStage, self).__init__(
             fillhole,
-            previous_stage)
-
-        self.instance.SetMaximumNumberOfIterations(
-            kwargs.get('iterations', 10))
-        self.instance.SetMajorityThreshold(kwargs.get('threshold', 3))
+            previous_stage,
+            params)
 
 
 class BinaryFillholeStage(BinaryStage):
@@ -172,9 +334,8 @@ class BinaryFillholeStage(BinaryStage):
         # pylint: disable=no-name-in-module,no-member
         from itk import BinaryFillholeImageFilter as fillhole
 
-        super(BinaryFillholeStage, self).__init__(fillhole, previous_stage)
-
-        self.instance.SetForegroundValue(1)
+        super(BinaryFillholeStage, self).__init__(fillhole, previous_stage,
+                                                  {"SetForegroundValue": 1})
 
 
 class CurvatureFlowStage(PipeStage):
@@ -217,7 +378,8 @@ class ConfidenceConnectStage(PipeStage):
     def out_type(self):
         '''ConfidenceConnectedImageFilter is only able to output as unsigned
         characters.'''
-        availiable_out_types = [pair[1] for pair in self.template
+        availiable_out_types = [pair[1] for pair in
+                                template_types(self.template)
                                 if pair[0] == self.in_type()]
 
         if len(availiable_out_types) == 0:
@@ -235,21 +397,30 @@ class FileReader(object):
     '''A PipeStage that can initiate a pipeline using an itk ImageFileReader.
     '''
 
-    def __init__(self, fname, img_type=IMG_F()):
+    def __init__(self, fname, img_type=None):
+        self.created = time.time()
         self.fname = fname
         self.img_type = img_type
 
     def out_type(self):
         '''Get type of image read by the wrapped ImageFileReader. This is
-        determined based upon user choice at construction.'''
+        determined based upon user choice at construction, and is IMG_F() by
+        default.'''
+        if self.img_type is None:
+            self.img_type = IMG_F()
+
         return self.img_type
 
+    def resolve(self):
+        '''Resolve the ImageFileReader instantiation this stage uses.'''
+        from itk import ImageFileReader  # pylint: disable=no-name-in-module
+
+        return instantiation(ImageFileReader, self.out_type())
+
     def execute(self):
         '''Execute this pipeline stage--that is, read the image from file and
         build the data into the appropriate itk Image object.'''
-        from itk import ImageFileReader  # pylint: disable=no-name-in-module
-
-        reader = ImageFileReader[self.out_type()].New()
+        reader = self.resolve().New()
 
         reader.SetFileName(self.fname)
 
@@ -263,6 +434,7 @@ class FileWriter(object):
     ImageFileWriter.'''
 
     def __init__(self, previous_stage, fname):
+        self.created = time.time()
         self.fname = fname
         self.prev = previous_stage
 
@@ -271,12 +443,16 @@ class FileWriter(object):
         '''
         return self.prev.out_type()
 
+    def resolve(self):
+        '''Resolve the ImageFileWriter instantiation this stage uses.'''
+        from itk import ImageFileWriter  # pylint: disable=no-name-in-module
+
+        return instantiation(ImageFileWriter, self.in_type())
+
     def execute(self):
         '''Execute this pipeline stage--that is, write to file the itk Image
         provided by the input to this pipeline.'''
-        from itk import ImageFileWriter  # pylint: disable=no-name-in-module
-
-        writer = ImageFileWriter[self.in_type()].New()
+        writer = self.resolve().New()
         writer.SetFileName(self.fname)
 
         writer.SetInput(self.prev.execute())
@@ -360,11 +536,15 @@ class FastMarchingStage(PipeStage):
         if imageless:
             params["SetSpeedConstant"] = 1.0
 
+        self.seeds = seeds
+        self.seed_value = seed_value
+
         template = FastMarchingImageFilter
         super(FastMarchingStage, self).__init__(template, previous_stage,
                                                 params)
 
-        self.instance.SetTrialPoints(self.build_seeds(seeds, seed_value))
+    def _configure(self, instance):
+        instance.SetTrialPoints(self.build_seeds(self.seeds, self.seed_value))
 
     def _bind_input(self):
         output = self.prev.execute()
@@ -421,16 +601,25 @@ class LevelSetFilterStage(PipeStage):
         img_type = self.in_type()
         feature_type = self.prev_feature.out_type()
 
-        for avail_templ in self.template:
+        for avail_templ in template_types(self.template):
             if avail_templ[0] == img_type and avail_templ[1] == feature_type:
-                return template[avail_templ].New()
+                self.feature_type = feature_type
+                return instantiation(template, *avail_templ).New()
 
         s = " ".join(["Could not instantiate", str(self.template), "because ",
                       "no valid template combination of", str(img_type), "and",
                       str(feature_type), "could be found. Possibilites were:",
-                      str([t for t in self.template])])
+                      str(template_types(self.template))])
         raise TypeError(s)
 
+    def resolve(self):
+        super(LevelSetFilterStage, self).resolve()
+
+        if self.prev_feature.out_type() != self.feature_type:
+            raise TypeError("instantiated for feature type " +
+                            str(self.feature_type) + " but given " +
+                            str(self.prev_feature.out_type()))
+
 
 class ShapeDetectionStage(LevelSetFilterStage):
     '''An itk PipeStage that implements the ShapeDetectionLevelSetImageFilter
@@ -476,7 +665,6 @@ class BinaryThreshStage(PipeStage):
     def __init__(self, previous_stage, threshold):
         # pylint: disable=no-name-in-module,no-member
         from itk import BinaryThresholdImageFilter as BinThresh
-        from itk import NumericTraits
 
         params = {'SetLowerThreshold': threshold[0],
                   'SetUpperThreshold': threshold[1]}
@@ -484,21 +672,22 @@ class BinaryThreshStage(PipeStage):
         super(BinaryThreshStage, self).__init__(BinThresh, previous_stage,
                                                 params)
 
-        # the superclass configures the in_type and out_type stuff to work
-        # so we have to wait until after the superclass constructor to access
-        # the previous PipeStage in a nice way.
+    def _configure(self, instance):
+        from itk import NumericTraits  # pylint: disable=no-name-in-module
+
+        # the types are only known once the stage is resolved
         px_type = extract_image_type(self.out_type())[0]
 
         # you'd think that this would lead to high-valued surround, but the
         # opposite turns out to be true. I flipped them and now it's working.
         # could investigate later...
-        self.instance.SetOutsideValue(NumericTraits[px_type].max())
-        self.instance.SetInsideValue(NumericTraits[px_type].min())
+        instance.SetOutsideValue(NumericTraits[px_type].max())
+        instance.SetInsideValue(NumericTraits[px_type].min())
 
     def out_type(self):
         preferred = IMG_UC()
 
-        avail_templ = [t[1] for t in self.template
+        avail_templ = [t[1] for t in template_types(self.template)
                        if t[0] == self.in_type()]
 
         if preferred in avail_templ:
@@ -534,7 +723,7 @@ class WatershedStage(PipeStage):
         # return extract_image_type(self.instance.GetOutput())
 
     def _instantiate(self, template):
-        return template[self.in_type()].New()
+        return instantiation(template, self.in_type()).New()
 
 
 class ConverterStage(PipeStage):
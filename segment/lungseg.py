@@ -8,6 +8,36 @@ import SimpleITK as sitk  # pylint: disable=F0401
 import os
 import numpy as np
 
+import views
+
+
+def _npix(img):
+    '''The number of voxels in img.'''
+    return reduce(lambda x, y: x * y, img.GetSize())
+
+
+def _corner(img):
+    '''The value of img at the origin voxel, i.e. (0, 0, 0) in 3D.'''
+    return img.GetPixel(*([0] * img.GetDimension()))
+
+
+def label_counts(img):
+    '''Count the voxels carrying each label in an integer label image,
+    including the background label zero, without leaving ITK. Returns a dict
+    from label to voxel count, omitting labels with no voxels.'''
+
+    shape = sitk.LabelShapeStatisticsImageFilter()
+    shape.ComputePerimeterOff()
+    shape.Execute(img)
+
+    counts = dict((l, shape.GetNumberOfPixels(l)) for l in shape.GetLabels())
+
+    background = _npix(img) - sum(counts.values())
+    if background > 0:
+        counts[0] = background
+
+    return counts
+
 
 def otsu(img):
     '''Use an 'otsu' thresholding to segment out high- and low-attenuation
@@ -15,32 +45,53 @@ def otsu(img):
     a "soft tissue + bone" region, but a constrast CT might produce different
     results.'''
 
-    array = sitk.GetArrayFromImage(img)
-    minval = np.min(array)
+    minmax = sitk.MinimumMaximumImageFilter()
+    minmax.Execute(img)
 
-    frac_minval = np.count_nonzero(array == minval) / float(array.size)
+    # the mask is needed to compute the fraction of minimum-valued voxels
+    # anyway, so build it as a uint8 image and reuse it for the threshold
+    mask = img != minmax.GetMinimum()
+
+    stats = sitk.StatisticsImageFilter()
+    stats.Execute(mask)
+    frac_minval = 1 - stats.GetSum() / float(_npix(img))
 
     filt = sitk.OtsuThresholdImageFilter()
 
     if frac_minval > .1:
-        mask = np.logical_not(array == minval)
-        mask = mask.astype('uint8')
-
         filt.SetMaskValue(1)
         filt.SetMaskOutput(False)
 
-        mask = sitk.GetImageFromArray(mask)
-        mask.CopyInformation(img)
-
         return filt.Execute(img, mask)
     else:
         return filt.Execute(img)
 
 
-def dialate(img, probe_size):
+def distance_map(img):
+    '''Compute the signed euclidean distance (in voxels, negative inside) from
+    each voxel to the boundary of the nonzero region of img. The cost is linear
+    in the number of voxels, irrespective of how far the distances reach.'''
+    return sitk.SignedMaurerDistanceMap(img, insideIsPositive=False,
+                                        squaredDistance=False,
+                                        useImageSpacing=False)
+
+
+def dialate(img, probe_size, method='kernel'):
     '''Once lungs are segmented out specifically, there's a tendency to get
     little islands in the lung fields. This dialatest the selection to remove
-    islands and to generate a smoother segmentation.'''
+    islands and to generate a smoother segmentation.
+
+    With method='kernel' this is a binary dilation with a Ball structuring
+    element, whose cost grows with the cube of probe_size. With
+    method='distance' the same result is produced by thresholding a distance
+    map, which costs the same at any radius. (An ITK Ball of radius r contains
+    exactly the voxels within r + 0.5 of its center.)'''
+    if method == 'distance':
+        out = distance_map(img) <= probe_size + 0.5
+        return sitk.Cast(out, img.GetPixelID())
+    elif method != 'kernel':
+        raise ValueError("Unknown morphology method '" + str(method) + "'")
+
     filt = sitk.BinaryDilateImageFilter()
     filt.SetKernelType(filt.Ball)
     filt.SetKernelRadius(probe_size)
@@ -48,21 +99,34 @@ def dialate(img, probe_size):
     return filt.Execute(img, 0, 1, False)
 
 
+def erode(img, radius, method='kernel'):
+    '''Erode the nonzero region of img with a ball of the given radius. The
+    method argument is as for dialate; the distance version erodes by dilating
+    the complement.'''
+    if method == 'distance':
+        out = distance_map(img == 0) > radius + 0.5
+        return sitk.Cast(out, img.GetPixelID())
+    elif method != 'kernel':
+        raise ValueError("Unknown morphology method '" + str(method) + "'")
+
+    return sitk.BinaryErode(img, radius, sitk.BinaryErodeImageFilter.Ball)
+
+
+def close(img, radius, method='kernel'):
+    '''Morphologically close img (dialate, then erode) with a ball of the
+    given radius. The method argument is as for dialate.'''
+    return erode(dialate(img, radius, method), radius, method)
+
+
 def find_components(img):
     '''Produce a separate label for each region in the binary image. Takes the
     type at the edge of the image (specifically at 0,0,0) to be 1 and zero for
     all other labels.'''
 
-    array = sitk.GetArrayFromImage(img)
-
-    bg_fixed = array == array[0, 0, 0]
-    bg_fixed = bg_fixed.astype(array.dtype)
-
-    new_img = sitk.GetImageFromArray(bg_fixed)
-    new_img.CopyInformation(img)
+    bg_fixed = img == _corner(img)
 
     filt = sitk.ConnectedComponentImageFilter()
-    return filt.Execute(new_img)
+    return filt.Execute(bg_fixed)
 
 
 def dump(img, name):
@@ -86,6 +150,133 @@ def isolate_lung_field(img):
     the chest wall (identified as 0 due to Otsu filtering) or outside air
     (identified by appearing at the border).'''
 
+    counts = label_counts(img)
+
+    outside = _corner(img)
+    chest_wall = 0
+
+    candidates = [l for l in sorted(counts) if l not in [outside, chest_wall]]
+
+    if candidates:
+        lung = max(candidates, key=counts.get)
+    else:
+        lung = 0
+
+    return img == lung
+
+
+def isolate_not_biggest(img):
+    '''Takes an sitk image with labels for many regions and produces a binary
+    mask with zero for the largest region (by number of voxels) and one
+    everywhere else.'''
+
+    counts = label_counts(img)
+
+    big = max(sorted(counts), key=counts.get)
+
+    return img != big
+
+
+def shrink(img, factor):
+    '''Downsample img by an integer factor along every axis by averaging
+    each block of voxels into one. Physical extent is preserved, so the result
+    can be resampled back onto the grid of img.'''
+    return sitk.BinShrink(img, [factor]*img.GetDimension())
+
+
+def refine_boundary(mask, img, margin=0, band_eps=1e-3, method='kernel'):
+    '''Bring a mask computed on a shrunk copy of img back onto the grid of
+    img. The mask is linearly interpolated, and voxels that come out as
+    unambiguously inside or outside keep that value. Only the band of voxels
+    straddling the low-resolution boundary is revisited: these are taken to be
+    inside if they lie within margin voxels of full-resolution air (air being
+    the otsu class that appears at the image corner, as in find_components).
+    margin should be the net growth of the mask relative to the lung field, and
+    method selects the morphology used to apply it (see dialate).'''
+
+    frac = sitk.Resample(sitk.Cast(mask, sitk.sitkFloat32), img,
+                         sitk.Transform(), sitk.sitkLinear, 0.0,
+                         sitk.sitkFloat32)
+    frac = views.array_view(frac)
+
+    band = np.logical_and(frac > band_eps, frac < 1 - band_eps)
+
+    air = otsu(img)
+    air = sitk.Equal(air, air.GetPixel(0, 0, 0))
+    if margin > 0:
+        air = dialate(air, margin, method)
+    air = views.array_view(air)
+
+    (refined_img, refined) = views.new_image(img, sitk.sitkUInt8)
+    refined[...] = frac >= 1 - band_eps
+    refined[band] = air[band]
+
+    return sitk.Cast(refined_img, mask.GetPixelID())
+
+
+def checkdist(seeds):
+    '''UNDER CONSTRUCTION'''
+
+    dists = {}
+
+    for (i, seed) in enumerate(seeds):
+        for oseed in seeds[i+1:]:
+            dist = sum([(seed[k] - oseed[k])**2
+                        for k in range(len(seed))])**0.5
+
+            dists[(seed, oseed)] = dist
+
+    raise NotImplementedError("Checkdist is under construction.")
+
+
+# The numpy implementations of the connected-component steps above, which
+# round-trip every step through full-volume arrays. They are kept as a
+# reference for tests and for benchmark.py.
+
+
+def otsu_numpy(img):
+    '''numpy reference implementation of otsu.'''
+
+    array = sitk.GetArrayFromImage(img)
+    minval = np.min(array)
+
+    frac_minval = np.count_nonzero(array == minval) / float(array.size)
+
+    filt = sitk.OtsuThresholdImageFilter()
+
+    if frac_minval > .1:
+        mask = np.logical_not(array == minval)
+        mask = mask.astype('uint8')
+
+        filt.SetMaskValue(1)
+        filt.SetMaskOutput(False)
+
+        mask = sitk.GetImageFromArray(mask)
+        mask.CopyInformation(img)
+
+        return filt.Execute(img, mask)
+    else:
+        return filt.Execute(img)
+
+
+def find_components_numpy(img):
+    '''numpy reference implementation of find_components.'''
+
+    array = sitk.GetArrayFromImage(img)
+
+    bg_fixed = array == array[0, 0, 0]
+    bg_fixed = bg_fixed.astype(array.dtype)
+
+    new_img = sitk.GetImageFromArray(bg_fixed)
+    new_img.CopyInformation(img)
+
+    filt = sitk.ConnectedComponentImageFilter()
+    return filt.Execute(new_img)
+
+
+def isolate_lung_field_numpy(img):
+    '''numpy reference implementation of isolate_lung_field.'''
+
     array = sitk.GetArrayFromImage(img)
 
     counts = np.bincount(np.ravel(array))
@@ -107,10 +298,8 @@ def isolate_lung_field(img):
     return lung_only
 
 
-def isolate_not_biggest(img):
-    '''Takes an sitk image with labels for many regions and produces a binary
-    mask with zero for the largest region (by number of voxels) and one
-    everywhere else.'''
+def isolate_not_biggest_numpy(img):
+    '''numpy reference implementation of isolate_not_biggest.'''
     array = sitk.GetArrayFromImage(img)
 
     counts = np.bincount(np.ravel(array))
@@ -124,21 +313,6 @@ def isolate_not_biggest(img):
     return not_big
 
 
-def checkdist(seeds):
-    '''UNDER CONSTRUCTION'''
-
-    dists = {}
-
-    for (i, seed) in enumerate(seeds):
-        for oseed in seeds[i+1:]:
-            dist = sum([(seed[k] - oseed[k])**2
-                        for k in range(len(seed))])**0.5
-
-            dists[(seed, oseed)] = dist
-
-    raise NotImplementedError("Checkdist is under construction.")
-
-
 def lungseg(img, options):
     '''Segment lung.'''
     img = otsu(img)
@@ -147,7 +321,6 @@ def lungseg(img, options):
     img = dialate(img, options['probe_size'])
     img = find_components(img)
     img = isolate_not_biggest(img)
-    img = sitk.BinaryErode(img, options['probe_size']/2,
-                           sitk.BinaryErodeImageFilter.Ball)
+    img = erode(img, options['probe_size']/2)
 
     return img
@@ -2,19 +2,42 @@ import sys
 import argparse
 import os
 import datetime
+import time
 import json
 import logging
-
-import SimpleITK as sitk
-import numpy as np
+from functools import partial
+from contextlib import contextmanager
 
 import sitkstrats
 import bounding
+import bgwriter
+import hierarchy
+import tracing
+import memory
+from artefacts import ArtefactStore, opthash
+from rle import RLEMask
 
 # a flag to run the script in debug mode. ONLY SET in process_command_line.
 global DEBUG  # pylint: disable=W0604
 DEBUG = False
 
+# The file format (by extension, see sitkstrats.write) for each kind of media
+# written to media_root. Seed-independent intermediates are re-read on every
+# run, so they are stored raw to be memory-mapped; final labels are
+# compressed. ONLY SET in process_command_line.
+MEDIA_FORMATS = {'intermediate': '.npy',
+                 'label': '.nii.gz'}
+
+# the writer mediadir_log uses to put media on disk. Synchronous unless
+# replaced (as it is in main) by one with background threads.
+global WRITER  # pylint: disable=W0604
+WRITER = bgwriter.BackgroundWriter(nthreads=0)
+
+# the wall time (in seconds) spent in each phase of the latest run_img call,
+# and the phases currently open; see phase.
+PHASE_TIMES = {}
+_PHASE_STACK = []
+
 def process_command_line(argv):
     '''Parse the command line and do a first-pass on processing them into a
     format appropriate for the rest of the script.'''
@@ -34,6 +57,11 @@ def process_command_line(argv):
     parser.add_argument(
         '--profile', default=False, action='store_true',
         help="Run cProfile on script execution.")
+    parser.add_argument(
+        '--trace', default=None, metavar='JSON',
+        help="Trace the run (see tracing.py) and write the trace to JSON " +
+        "in the Chrome trace event format. A summary of the trace is added " +
+        "to the run JSON.")
     parser.add_argument(
         '--log', default="logs/",
         help="The directory to place logs in.")
@@ -41,6 +69,54 @@ def process_command_line(argv):
         '--seed', default=None, nargs=3, type=int, metavar=('X', 'Y', 'Z'),
         help="Add an additional, manually determined seed to the " +
         "calculation. Seed should be image-indexed (x, y, z not z, y, x).")
+    parser.add_argument(
+        '--lung_downsample', default=1, type=int,
+        help="Compute the lung segmentation on an image shrunk by this " +
+        "factor, refining only its boundary at full resolution.")
+    parser.add_argument(
+        '--lung_morphology', default='kernel', choices=['kernel', 'distance'],
+        help="Compute lung dilation/erosion with ball kernels or by " +
+        "thresholding a distance map (faster for large probes).")
+    parser.add_argument(
+        '--geodesic_convergence', default=False, action='store_true',
+        help="With --geodesic_roi, stop each geodesic contour once its " +
+        "size stabilises or it leaks past the consensus size limit, " +
+        "rather than running the full iteration budget. The contour is " +
+        "restarted at every check, which costs a pass over its region: " +
+        "cheap for small regions of interest, but slower than running " +
+        "the full budget on the whole image, so it is ignored without " +
+        "--geodesic_roi.")
+    parser.add_argument(
+        '--geodesic_roi', default=False, action='store_true',
+        help="Evolve each geodesic contour only in a region of interest " +
+        "around its seed, grown as needed, rather than the whole image.")
+    parser.add_argument(
+        '--confidence_memo', default=False, action='store_true',
+        help="Reuse the confidence connected region of an earlier seed for " +
+        "seeds that fall inside it, rather than growing it again.")
+    parser.add_argument(
+        '--seed_levels', default=None, type=float, nargs='+', metavar='LEVEL',
+        help="Take deterministic seeds from the watershed at each of these " +
+        "levels, cut from a watershed hierarchy computed once per study, " +
+        "rather than from the watershed strategy's single level.")
+    parser.add_argument(
+        '--max_memory', default=None, type=int, metavar='MIB',
+        help="Keep the large images held by the run within MIB mebibytes " +
+        "where possible, by clearing caches and spilling seed-independent " +
+        "images to (memory-mapped) disk. Memory use is reported in the " +
+        "run JSON either way.")
+    parser.add_argument(
+        '--intermediate_format', default=MEDIA_FORMATS['intermediate'],
+        choices=['.npy', '.nii', '.nii.gz'],
+        help="The file format for seed-independent intermediate images.")
+    parser.add_argument(
+        '--label_format', default=MEDIA_FORMATS['label'],
+        choices=['.npy', '.nii', '.nii.gz'],
+        help="The file format for per-seed and consensus labels.")
+    parser.add_argument(
+        '--write_threads', default=2, type=int,
+        help="The number of background threads writing media output. " +
+        "With 0, media is written synchronously.")
     parser.add_argument(
         '--debug', default=False, action="store_true",
         help="Set the script to run in debug mode, where it produces FAR " +
@@ -54,9 +130,38 @@ def process_command_line(argv):
     global DEBUG #pylint: disable=W0603
     DEBUG = args.debug
 
+    MEDIA_FORMATS['intermediate'] = args.intermediate_format
+    MEDIA_FORMATS['label'] = args.label_format
+
     return args
 
 
+@contextmanager
+def phase(name):
+    '''
+    Accumulate the wall time spent in the block into PHASE_TIMES[name].
+    Phases nest, and time spent in an inner phase counts only towards it, so
+    the phase times of a run add up to its total time. The block is also
+    traced as a span of category 'phase'.
+    '''
+    now = time.time()
+    if _PHASE_STACK:
+        (outer, start) = _PHASE_STACK[-1]
+        PHASE_TIMES[outer] = PHASE_TIMES.get(outer, 0) + now - start
+
+    _PHASE_STACK.append((name, now))
+    try:
+        with tracing.span(name, 'phase'):
+            yield
+    finally:
+        now = time.time()
+        (name, start) = _PHASE_STACK.pop()
+        PHASE_TIMES[name] = PHASE_TIMES.get(name, 0) + now - start
+
+        if _PHASE_STACK:
+            _PHASE_STACK[-1] = (_PHASE_STACK[-1][0], now)
+
+
 def set_label(fname, label, labsep='-'):
     '''Set the label (a string addition of labsep + label) for this filename.
     '''
@@ -66,16 +171,6 @@ def set_label(fname, label, labsep='-'):
     return fname
 
 
-def opthash(options):
-    '''Produce a short hash of the input options.'''
-    import hashlib
-
-    sha = hashlib.sha1()
-    sha.update(str(options))
-
-    return sha.hexdigest()[0:8]
-
-
 def debug_log(func, arg, *args, **kwargs):
     '''
     Wrapper for mediadir_log that writes to disk only if DEBUG is set to true.
@@ -86,12 +181,15 @@ def debug_log(func, arg, *args, **kwargs):
         return func(*arg)
 
 
-def mediadir_log(func, (in_img, in_opts), mediadir, sha, subdir=None):
+def mediadir_log(func, (in_img, in_opts), mediadir, sha, subdir=None,
+                 crop=False):
     '''
     Invoke some image processing step in the pipeline and write the resulting
     file to the directory appropriate to the algorithm/step
     that generated it using its sha and the function. Also decorates the info
-    object with information about the file's location.
+    object with information about the file's location. If crop is set, only
+    the bounding box of the output's foreground is stored (see
+    sitkstrats.write).
     '''
     optha = opthash(in_opts)
     label = func.__name__
@@ -101,20 +199,31 @@ def mediadir_log(func, (in_img, in_opts), mediadir, sha, subdir=None):
     if subdir is None:
         subdir = label
 
-    out_fname = os.path.join(mediadir, subdir, sha+"-"+optha+'.nii')
+    out_fname = os.path.join(mediadir, subdir,
+                             sha+"-"+optha+MEDIA_FORMATS['label'])
 
-    sitkstrats.write(img, out_fname)
+    with phase('io'):
+        WRITER.write(img, out_fname, crop=crop)
 
     opts['file'] = out_fname
 
     return (img, opts)
 
 
-def configure_strats():
+def configure_strats(geodesic_convergence=False, geodesic_roi=False,
+                     confidence_memo=False):
     '''
     Construct a dictionary that represents the configuration of all
     segmentation strategies to be used in the script using command line
-    arguments. CURRENTLY ACCEPTS NO INPUT.
+    arguments. If geodesic_roi is set, the geodesic contour is evolved only
+    in a region around the seed, and if geodesic_convergence is also set it
+    stops once it converges or leaks instead of always running every
+    iteration (see sitkstrats._converge_geocontour). Convergence checks
+    restart the contour, which over the whole image costs more than they
+    save, so geodesic_convergence is ignored without geodesic_roi.
+    If confidence_memo is set, seeds inside an earlier seed's confidence
+    connected region reuse that region (see memo_lookup), so that a region
+    holding many seeds is grown only once.
     '''
 
     strats = {
@@ -162,34 +271,108 @@ def configure_strats():
             },
             'seed-dependent': {
                 'strategy': sitkstrats.isolate_watershed,
+                'index': bounding.LabelIndex.from_image,
+                'memo': 'label',
                 'opts': {}
             }
         }
     }
 
-    return strats
+    if confidence_memo:
+        strats['confidence_connected']['seed-dependent']['memo'] = 'region'
+
+    if geodesic_roi:
+        geodesic = strats['geodesic']['seed-dependent']
+        geodesic['strategy'] = sitkstrats.roi_seeded_geocontour
+        geodesic['opts']['roi'] = {'radius': 16,
+                                   'max_radius': 128,
+                                   'margin': 2}
+
+        if geodesic_convergence:
+            geodesic['opts']['geodesic']['convergence'] = {
+                'check_interval': 50,
+                'tolerance': 0.005,
+                'patience': 1,
+                'max_size_frac': 0.5}
+    elif geodesic_convergence:
+        logging.warning("Geodesic convergence mode only applies to the " +
+                        "region of interest strategy; running the full " +
+                        "iteration budget on the whole image.")
 
+    return strats
 
-def seeddep(imgs, seeds, root_dir, sha, segstrats, lung_size, img_in):
 
-    # pick an image, basically at random, from imgs to initialize an array
-    # that tracks which areas of the image have already been segmented out
-    segmented = np.zeros(sitk.GetArrayFromImage(  # pylint: disable=E1101
-        imgs.values()[0]).shape)
+def memo_lookup(memo, kind, img, index):
+    '''
+    Find the memoised result of a strategy that can stand in for running it
+    at the (numpy-ordered) index. With kind 'label', memo is a dict of
+    results keyed by the label of the seed-independent image img under their
+    seed, and any seed on the same label gets the same result. With kind
+    'region', memo is a list of results, and a seed inside an earlier
+    result's region gets that result. Returns None if there is no such
+    result.
+    '''
+    if kind == 'label':
+        return memo.get(img.GetPixel(*[int(i) for i in reversed(index)]))
+    elif kind == 'region':
+        for result in memo:
+            if result[0].contains(index):
+                return result
+
+    return None
+
+
+def memo_store(memo, kind, img, index, result):
+    '''Record result, a tuple of the run-length encoded output, seed name
+    and info dict of a strategy run at index, in memo (see memo_lookup).'''
+    if kind == 'label':
+        memo[img.GetPixel(*[int(i) for i in reversed(index)])] = result
+    elif kind == 'region':
+        memo.append(result)
+
+
+def seeddep(imgs, seeds, root_dir, sha, segstrats, lung_size, img_in,
+            ledger=None):
+    '''Segment img_in from each of seeds with each of segstrats, given their
+    seed-independent images imgs. Large buffers are accounted for in ledger
+    (a memory.MemoryLedger), if given.'''
+    if ledger is None:
+        ledger = memory.MemoryLedger()
+
+    # the consensus masks found so far, which track the areas of the image
+    # that have already been segmented out. They are run-length encoded, so
+    # looking up a seed is a binary search rather than a dense volume.
+    segmented = []
+    shape = tuple(reversed(img_in.GetSize()))
+
+    # strategies that look things up in their seed-independent image get an
+    # index of it, built once for all the seeds
+    with phase('seed-dependent'):
+        indices = dict((sname, segstrats[sname]['seed-dependent']['index'](
+            imgs[sname])) for sname in segstrats
+                       if 'index' in segstrats[sname]['seed-dependent'])
+    for (sname, index) in indices.items():
+        ledger.hold('index:' + sname, index.nbytes)
+
+    # results of strategies that are memoised between seeds (see memo_lookup)
+    memos = dict((sname, {} if segstrats[sname]['seed-dependent'].get(
+        'memo') == 'label' else []) for sname in segstrats)
 
     out_info = {}
 
-    for seed in seeds:
+    for seed in tracing.iterspans(seeds, 'seed', 'seed',
+                                  label=lambda s: "-".join(str(k) for k in s)):
         try:
-            if segmented[seed[2], seed[1], seed[0]] >= 2:
+            index = (seed[2], seed[1], seed[0])
+            if sum(mask.contains(index) for mask in segmented) >= 2:
                 logging.info(
                     "Tried to segment %s but it was already segmented", seed)
                 continue
         except IndexError as err:
             sys.stderr.write("Tried to access " + str(seed) + " as " +
                              str(list(reversed(seed))) + " in img of size " +
-                             str(segmented.shape)+"\n")
-            logging.error(" ".join([str(seed), str(segmented.shape)]))
+                             str(shape)+"\n")
+            logging.error(" ".join([str(seed), str(shape)]))
             logging.error(str(err))
             raise
 
@@ -197,28 +380,64 @@ def seeddep(imgs, seeds, root_dir, sha, segstrats, lung_size, img_in):
         # and we want to automagically store the info we put in seed_info into
         # out_info for returning later => use setdefault
         out_imgs = {}
-        seed_info = out_info.setdefault("-".join([str(k) for k in seed]), {})
+        seed_name = "-".join([str(k) for k in seed])
+        seed_info = out_info.setdefault(seed_name, {})
 
         # for each strategy we want to segment with, get its name and the
         # function that executes it.
         for (sname, strat) in [(strnam, segstrats[strnam]['seed-dependent'])
                                for strnam in segstrats]:
 
-            img_in = imgs[sname]
+            # a spilled image is read back once, and kept until the ledger
+            # needs to spill it again, rather than re-read for every seed
+            if isinstance(imgs, memory.SpillableImages):
+                img_in = imgs.restore(sname, ledger,
+                                      'seed-independent:' + sname)
+            else:
+                img_in = imgs[sname]
+
+            memo_kind = strat.get('memo')
+            hit = memo_lookup(memos[sname], memo_kind, img_in, index)
+            if hit is not None:
+                (mask, memo_seed, memo_info) = hit
+
+                out_imgs[sname] = mask.to_image()
+                seed_info[sname] = dict(memo_info)
+                seed_info[sname].update({'seed': seed,
+                                         'memo_from': memo_seed})
+
+                logging.info("Reused %s's %s result for %s", memo_seed,
+                             sname, seed)
+                continue
 
             opts = dict(strat['opts'])
             opts['seed'] = seed
-
-            (tmp_img, tmp_info) = debug_log(strat['strategy'],
-                                            (img_in, opts),
-                                            root_dir,
-                                            sha)
+            opts['lung_size'] = lung_size
+            if sname in indices:
+                opts['label_index'] = indices[sname]
+
+            # per-seed outputs are small blobs in a full-size volume, so
+            # only their bounding boxes are stored
+            with phase('seed-dependent'):
+                (tmp_img, tmp_info) = debug_log(strat['strategy'],
+                                                (img_in, opts),
+                                                root_dir,
+                                                sha,
+                                                crop=True)
 
             out_imgs[sname] = tmp_img
             seed_info[sname] = tmp_info
 
+            if memo_kind is not None:
+                memo_store(memos[sname], memo_kind, img_in, index,
+                           (RLEMask.from_image(tmp_img), seed_name,
+                            tmp_info))
+
             logging.info("Segmented %s with %s", seed, sname)
 
+        ledger.hold('seed-outputs', sum(sitkstrats.image_nbytes(i)
+                                        for i in out_imgs.values()))
+
         # we need the names of the input files so that our options hash is
         # dependent on the input images.
         seed_indep_hashes = [sitkstrats.hash_img(i)[0:8]
@@ -226,28 +445,27 @@ def seeddep(imgs, seeds, root_dir, sha, segstrats, lung_size, img_in):
 
         try:
             # First, we compute the segmentation union
-            (consensus, consensus_info) = mediadir_log(
-                sitkstrats.segmentation_union,
-                (out_imgs.values(),
-                 {'threshold': 2.0/3.0,
-                  'max_size': lung_size * 0.5,
-                  'min_size': lung_size * 1e-5,
-                  'indep_img_hashes': seed_indep_hashes}),
-                root_dir,
-                sha)
+            with phase('consensus'):
+                (consensus, consensus_info) = mediadir_log(
+                    sitkstrats.segmentation_union,
+                    (out_imgs.values(),
+                     {'threshold': 2.0/3.0,
+                      'max_size': lung_size * 0.5,
+                      'min_size': lung_size * 1e-5,
+                      'indep_img_hashes': seed_indep_hashes}),
+                    root_dir,
+                    sha,
+                    crop=True)
 
             # Then we crop down both the initial image ("img_in") AND the
-            # segmentation based upon the size of the segmentation.
-            (crop_seg, crop_seg_info) = sitkstrats.crop_to_segmentation(
-                img=consensus, seg_img=consensus, padding_px=5)
-            (crop_img, crop_img_info) = sitkstrats.crop_to_segmentation(
-                img=img_in, seg_img=consensus, padding_px=5)
-
-            # Because we used the image "consensus" for both croppings,
-            # the images should be cropped the same way
-            assert crop_seg.GetSize() == crop_img.GetSize()
-            assert crop_seg_info['origin'] == crop_img_info['origin']
-            assert crop_seg_info['padding'] == crop_img_info['padding']
+            # segmentation based upon the size of the segmentation, in one
+            # go so that both are cropped the same way.
+            with phase('crop'):
+                ((crop_seg, crop_img), crop_seg_info) = \
+                    sitkstrats.crop_to_segmentation(
+                        img=[consensus, img_in], seg_img=consensus,
+                        padding_px=5)
+            crop_img_info = dict(crop_seg_info)
 
             logging.info("Cropped %s to %s.", seed, crop_img.GetSize())
 
@@ -278,21 +496,73 @@ def seeddep(imgs, seeds, root_dir, sha, segstrats, lung_size, img_in):
 
         logging.info("Finished segmenting %s", seed)
 
-        segmented += sitk.GetArrayFromImage(consensus)
+        segmented.append(RLEMask.from_image(consensus))
+        ledger.hold('segmented', sum(m.starts.nbytes + m.stops.nbytes
+                                     for m in segmented))
 
         seed_info['consensus'] = consensus_info
 
+    ledger.release('seed-outputs')
+
     return out_info
 
 
-def run_img(img, sha, nseeds, root_dir, addl_seed):  # pylint: disable=C0111
-    '''Run the entire protocol on a particular image starting with sha hash'''
-    img_info = {}
+def fetch_hierarchy(store, img, sha, watershed_opts, base_level=0):
+    '''Load the watershed hierarchy of img for the featurization in
+    watershed_opts from store, or build and store it if there isn't one.'''
+    hier_opts = {'anisodiff': dict(watershed_opts['anisodiff']),
+                 'gauss': dict(watershed_opts['gauss']),
+                 'watershed': {'base_level': base_level}}
+    kind = sitkstrats.aniso_gauss_hierarchy.__name__
 
-    lung_img, lung_info = debug_log(sitkstrats.segment_lung,
-                                    (img, {'probe_size': 7}),
-                                    root_dir, sha)
+    try:
+        (arrays, info) = store.load_arrays(kind, sha, hier_opts)
+        hier = hierarchy.WatershedHierarchy.from_arrays(arrays)
+        logging.info("Loaded '%s' for %s from the artefact store.", kind, sha)
+    except KeyError:
+        (hier, info) = sitkstrats.aniso_gauss_hierarchy(
+            img, {k: dict(v) for (k, v) in hier_opts.items()})
+        store.save_arrays(kind, sha, hier_opts, hier.to_arrays(), info)
+
+    return (hier, info)
+
+
+@tracing.traced('image')
+def run_img(img, sha, nseeds, root_dir, addl_seed,  # pylint: disable=C0111
+            lung_opts=None, strat_opts=None, seed_levels=None,
+            max_memory=None):
+    '''Run the entire protocol on a particular image starting with sha hash.
+    strat_opts are passed to configure_strats as keyword arguments. If
+    seed_levels is given, deterministic seeds are drawn from the watershed
+    at each of those levels, cut from the study's watershed hierarchy. If
+    max_memory is given, caches and seed-independent images are spilled to
+    keep the images held within that many bytes (see memory.MemoryLedger).'''
+    img_info = {}
+    PHASE_TIMES.clear()
+
+    # every large buffer the run holds is accounted for here
+    ledger = memory.MemoryLedger(max_memory)
+    ledger.hold_image('image', img)
+
+    if lung_opts is None:
+        lung_opts = {'probe_size': 7}
+    if strat_opts is None:
+        strat_opts = {}
+
+    # Everything up to the seed loop depends only on the image and options,
+    # so it is drawn from the artefact store where possible. Steps are given
+    # copies of their options, since they decorate them with run info.
+    # Only sizes are verified on load, so that memory-mapped artefacts aren't
+    # read in full; artefacts.py list/gc does full checksums.
+    store = ArtefactStore(root_dir, image_ext=MEDIA_FORMATS['intermediate'],
+                          verify='size')
+
+    with phase('lungseg'):
+        lung_img, lung_info = store.fetch(
+            sitkstrats.segment_lung.__name__, sha, lung_opts,
+            partial(sitkstrats.segment_lung, img, dict(lung_opts)))
     img_info['lungseg'] = lung_info
+    ledger.hold_image('lungseg', lung_img)
 
     # (img, tmp_info) = debug_log(sitkstrats.crop_to_segmentation,
     #                             (img_in, lung_img),
@@ -300,45 +570,82 @@ def run_img(img, sha, nseeds, root_dir, addl_seed):  # pylint: disable=C0111
     # lung_img = sitkstrats.crop_to_segmentation(lung_img, lung_img)[0]
     # img_info['crop'] = tmp_info
 
-    segstrats = configure_strats()
-    seed_indep_imgs = {}
+    segstrats = configure_strats(**strat_opts)
+    seed_indep_imgs = memory.SpillableImages()
     seed_indep_info = {}
 
     for (sname, strat) in [(strnam, segstrats[strnam]['seed-independent'])
                            for strnam in segstrats]:
 
-        try:
-            optha = opthash(strat['opts'])
-            fname = os.path.join(root_dir, strat['strategy'].__name__,
-                                 sha + "-" + optha + ".nii")
-            tmp_img = sitkstrats.read(fname)
-            tmp_info = strat['opts']
-            tmp_info['file'] = os.path.join(fname)
-            logging.info(
-                "Loaded seed-independent image for '%s', '%s' from file",
-                sname, fname)
-        except RuntimeError:
-            logging.debug(
-                "Building seed-independent image '%s', '%s'.", sname, fname)
-            (tmp_img, tmp_info) = debug_log(strat['strategy'],
-                                            (img, strat['opts']),
-                                            root_dir,
-                                            sha)
-            logging.info(
-                "Built seed-independent image '%s', '%s' in %s",
-                sname, fname, tmp_info['time'])
+        with phase('seed-independent'):
+            (tmp_img, tmp_info) = store.fetch(
+                strat['strategy'].__name__, sha, strat['opts'],
+                partial(strat['strategy'], img, dict(strat['opts'])))
+        logging.info("Seed-independent image '%s' is '%s' (built in %s)",
+                     sname, tmp_info['file'], tmp_info['time'])
 
         seed_indep_imgs[sname] = tmp_img
         seed_indep_info[sname] = tmp_info
 
+        # seed-independent images are all in the artefact store, so they
+        # can be dropped and re-read. The diffusion cache can be rebuilt, but
+        # only at great cost and is shared between these steps, so it is kept
+        # until they are done.
+        with ledger.pinned('cache:aniso_gauss'):
+            ledger.hold_image('seed-independent:' + sname, tmp_img,
+                              spill=partial(seed_indep_imgs.spill, sname,
+                                            tmp_info['file']))
+            ledger.hold('cache:aniso_gauss',
+                        sitkstrats.aniso_gauss.cache_nbytes(),
+                        spill=sitkstrats.clear_caches)
+
+    # ...and the first once they are done
+    ledger.hold('cache:aniso_gauss', sitkstrats.aniso_gauss.cache_nbytes(),
+                spill=sitkstrats.clear_caches, priority=0)
+
     # compute seeds, first by taking the centers of mass of a bunch of the
     # watershed segemented regions, then by adding a bunch of random ones that
     # are inside the lung field.
-    (seeds, tmp_info) = sitkstrats.com_calc(img=seed_indep_imgs['watershed'],
-                                            max_size=0.05, min_size=1e-5,
-                                            lung_img=lung_img)
-    img_info['deterministic-seeds'] = tmp_info
-    seeds.extend(sitkstrats.distribute_seeds(lung_img, nseeds-len(seeds)))
+    with phase('seeds'):
+        seed_opts = {'max_size': 0.05, 'min_size': 1e-5,
+                     'lungseg': opthash(lung_opts),
+                     'watershed': opthash(
+                         segstrats['watershed']['seed-independent']['opts'])}
+        if seed_levels:
+            seed_opts['levels'] = sorted(seed_levels)
+
+        try:
+            tmp_info = store.load_json('com_calc', sha, seed_opts)
+            seeds = [list(s) for s in tmp_info['seeds']]
+            logging.info("Loaded %s deterministic seeds from the artefact " +
+                         "store", len(seeds))
+        except KeyError:
+            if seed_levels:
+                (hier, hier_info) = fetch_hierarchy(
+                    store, img, sha,
+                    segstrats['watershed']['seed-independent']['opts'])
+                img_info['watershed-hierarchy'] = hier_info
+
+                (seeds, tmp_info) = ([], {'levels': {}})
+                for level in seed_opts['levels']:
+                    (level_seeds, level_info) = sitkstrats.com_calc(
+                        img=hier.cut(level), max_size=seed_opts['max_size'],
+                        min_size=seed_opts['min_size'], lung_img=lung_img)
+                    for seed in level_seeds:
+                        if seed not in seeds:
+                            seeds.append(seed)
+                    tmp_info['levels'][str(level)] = level_info
+
+                tmp_info['nseeds'] = len(seeds)
+                tmp_info['seeds'] = [list(s) for s in seeds]
+            else:
+                (seeds, tmp_info) = sitkstrats.com_calc(
+                    img=seed_indep_imgs['watershed'],
+                    max_size=seed_opts['max_size'],
+                    min_size=seed_opts['min_size'], lung_img=lung_img)
+            store.save_json('com_calc', sha, seed_opts, tmp_info)
+        img_info['deterministic-seeds'] = tmp_info
+        seeds.extend(sitkstrats.distribute_seeds(lung_img, nseeds-len(seeds)))
 
     if addl_seed is not None:
         # additional seed is given in terms of the input image, and must
@@ -358,9 +665,13 @@ def run_img(img, sha, nseeds, root_dir, addl_seed):  # pylint: disable=C0111
     # with many deterministic seeds, this list can be longer than nseeds.
     seeds = seeds[0:nseeds]
 
-    seg_info = seeddep(seed_indep_imgs, seeds,
-                       root_dir, sha, segstrats, img_info['lungseg']['size'],
-                       img)
+    # every seed needs every seed-independent image, so once read back they
+    # are kept for the whole loop rather than spilled by one seed and re-read
+    # by the next
+    with phase('seed-loop'), ledger.pinned(*['seed-independent:' + sname
+                                             for sname in segstrats]):
+        seg_info = seeddep(seed_indep_imgs, seeds, root_dir, sha, segstrats,
+                           img_info['lungseg']['size'], img, ledger)
 
     img_info['noduleseg'] = {}
     for seed in seg_info:
@@ -373,6 +684,9 @@ def run_img(img, sha, nseeds, root_dir, addl_seed):  # pylint: disable=C0111
             img_info['noduleseg'].setdefault(
                 seed, {})[segstrat] = combined_info
 
+    img_info['phase_times'] = dict(PHASE_TIMES)
+    img_info['memory'] = ledger.report()
+
     return img_info
 
 
@@ -430,12 +744,49 @@ def main(argv=None):
 
     logging.info("Beginning image %s", args.image)
 
+    global WRITER  # pylint: disable=W0603
+    WRITER = bgwriter.BackgroundWriter(nthreads=args.write_threads)
+
+    if args.trace is not None:
+        tracing.enable()
+
+    completed = False
     try:
         run_info = run_img(sitkstrats.read(args.image), sha,
-                           args.nseeds, args.media_root, args.seed)
+                           args.nseeds, args.media_root, args.seed,
+                           lung_opts={'probe_size': 7,
+                                      'downsample': args.lung_downsample,
+                                      'morphology': args.lung_morphology},
+                           strat_opts={'geodesic_convergence':
+                                       args.geodesic_convergence,
+                                       'geodesic_roi': args.geodesic_roi,
+                                       'confidence_memo':
+                                       args.confidence_memo},
+                           seed_levels=args.seed_levels,
+                           max_memory=(args.max_memory * 2**20
+                                       if args.max_memory else None))
+        completed = True
     except Exception as exc:  # pylint: disable=W0703
         logging.critical("Encountered critical exception:\n%s", exc)
         raise
+    finally:
+        try:
+            # everything queued must reach disk before we exit, and any
+            # failed writes are raised here, unless the run has already
+            # failed, in which case they mustn't mask its exception.
+            try:
+                WRITER.close()
+            except Exception as exc:  # pylint: disable=W0703
+                if completed:
+                    raise
+                logging.error("Background writes also failed:\n%s", exc)
+        finally:
+            tracer = tracing.disable()
+            if tracer is not None:
+                tracing.export_chrome(tracer, os.path.abspath(args.trace))
+
+    if tracer is not None:
+        run_info['trace'] = tracing.summarize(tracer)
 
     write_info(run_info, filename=os.path.join(args.log, sha+"-seg.json"))
 
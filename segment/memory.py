@@ -0,0 +1,174 @@
+'''Accounting for the large buffers a masterseg run holds, and enforcement of a
+memory budget by spilling what can be rebuilt or re-read from disk.'''
+
+import logging
+import resource
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial
+
+import sitkstrats
+
+
+class Spilled(object):
+    '''A stand-in for an image that has been dropped from memory and can be
+    read back from fname (see sitkstrats.read).'''
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def load(self):
+        '''Read the image back from disk.'''
+        return sitkstrats.read(self.fname)
+
+
+class SpillableImages(dict):
+    '''
+    A dict of images, any of which can be spilled: dropped from memory and
+    re-read from disk on every access thereafter. Raw .npy images are
+    memory-mapped when read (see sitkstrats.read), so a spilled image costs
+    one transient copy per access rather than a permanent one. An image that
+    is used over and over should be restored instead.
+    '''
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        return value.load() if isinstance(value, Spilled) else value
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def spill(self, key, fname):
+        '''Drop the image at key, to be re-read from fname when needed.'''
+        dict.__setitem__(self, key, Spilled(fname))
+
+    def spilled(self, key):
+        '''True if the image at key has been spilled.'''
+        return isinstance(dict.__getitem__(self, key), Spilled)
+
+    def restore(self, key, ledger, name):
+        '''The image at key. If it has been spilled, it is read back and kept
+        in memory, accounted for in ledger (a MemoryLedger) under name so that
+        the ledger can spill it again, rather than being re-read on every
+        access.'''
+        value = dict.__getitem__(self, key)
+        if not isinstance(value, Spilled):
+            return value
+
+        img = value.load()
+        dict.__setitem__(self, key, img)
+        ledger.hold_image(name, img, spill=partial(self.spill, key,
+                                                   value.fname))
+
+        return img
+
+
+class MemoryLedger(object):
+    '''
+    An account of the large buffers held by a run, by name. Each entry may
+    have a spill function that releases it (eg. by clearing a cache, or
+    dropping an image that is also on disk). Whenever more than budget bytes
+    are held, entries are spilled, lowest priority first and largest first
+    within a priority, until the run is back under budget. Empty entries, and
+    those pinned while they are in use, are never spilled. With no budget,
+    the ledger only keeps accounts.
+
+    Each entry's spills are counted, and the last max_actions of them are
+    kept in order, so that a long run's record stays small.
+    '''
+
+    def __init__(self, budget=None, max_actions=50):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.held = 0
+        self.peak = 0
+        self.actions = deque(maxlen=max_actions)
+        self.spills = {}
+        self.pins = {}
+        self.over_budget = False
+
+    def hold(self, name, nbytes, spill=None, priority=1):
+        '''Account for nbytes held under name, replacing any earlier entry of
+        that name, then enforce the budget.'''
+        self.release(name)
+
+        self.entries[name] = (int(nbytes), spill, priority)
+        self.held += int(nbytes)
+        self.peak = max(self.peak, self.held)
+
+        self.enforce()
+
+    def hold_image(self, name, img, spill=None, priority=1):
+        '''Account for the pixel buffer of img under name (see hold).'''
+        self.hold(name, sitkstrats.image_nbytes(img), spill, priority)
+
+        return img
+
+    def release(self, name):
+        '''Drop the entry for name, if there is one.'''
+        if name in self.entries:
+            self.held -= self.entries.pop(name)[0]
+
+    @contextmanager
+    def pinned(self, *names):
+        '''Keep the entries of names (including any made while pinned) from
+        being spilled within the block, eg. because they are about to be used
+        again and would only be rebuilt or re-read.'''
+        for name in names:
+            self.pins[name] = self.pins.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            for name in names:
+                self.pins[name] -= 1
+                if not self.pins[name]:
+                    del self.pins[name]
+
+    def enforce(self):
+        '''Spill entries until no more than budget bytes are held, or nothing
+        more can be spilled.'''
+        if self.budget is None or self.held <= self.budget:
+            return
+
+        spillable = sorted([(priority, -nbytes, name) for (name, (
+            nbytes, spill, priority)) in self.entries.items()
+                            if spill and nbytes and name not in self.pins])
+
+        for (_, _, name) in spillable:
+            if self.held <= self.budget:
+                break
+
+            (nbytes, spill, _) = self.entries[name]
+            spill()
+            self.release(name)
+
+            self.actions.append({'spilled': name, 'bytes': nbytes,
+                                 'held': self.held})
+            (times, total) = self.spills.get(name, (0, 0))
+            self.spills[name] = (times + 1, total + nbytes)
+            logging.info("Spilled '%s' (%s bytes) to stay within the memory " +
+                         "budget; %s bytes held.", name, nbytes, self.held)
+
+        if self.held > self.budget and not self.over_budget:
+            self.over_budget = True
+            logging.warning("Holding %s bytes with nothing left to spill, " +
+                            "over the memory budget of %s bytes.",
+                            self.held, self.budget)
+
+    def report(self):
+        '''A JSON-able summary of the run's memory use.'''
+        return {'budget_bytes': self.budget,
+                'held_bytes': self.held,
+                'peak_held_bytes': self.peak,
+                'peak_rss_bytes': resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss * 1024,
+                'over_budget': self.over_budget,
+                'held': dict((name, e[0]) for (name, e) in
+                             self.entries.items()),
+                'spills': dict((name, {'times': times, 'bytes': total})
+                               for (name, (times, total)) in
+                               self.spills.items()),
+                'actions': list(self.actions)}
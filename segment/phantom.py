@@ -0,0 +1,157 @@
+'''Build synthetic chest-CT-like phantoms for testing and benchmarking the
+segmentation pipeline without access to real patient data.'''
+
+import SimpleITK as sitk  # pylint: disable=F0401
+import numpy as np
+
+AIR = -1000
+LUNG = -850
+TISSUE = 40
+
+
+def _ellipsoid(grid, center, radii):
+    '''Produce a boolean array that is true inside the axis-aligned ellipsoid
+    with the given center and radii. All arguments are in numpy (z, y, x)
+    order.'''
+    dist = sum(((grid[i] - center[i]) / float(radii[i]))**2
+               for i in range(len(center)))
+
+    return dist <= 1
+
+
+def _capsule(grid, start, end, radius):
+    '''Produce a boolean array that is true within radius of the line segment
+    from start to end. All arguments are in numpy (z, y, x) order.'''
+    axis = [end[i] - start[i] for i in range(len(start))]
+    rel = [grid[i] - start[i] for i in range(len(start))]
+    length2 = float(sum(a**2 for a in axis))
+
+    # the position along the segment of the closest point to each voxel
+    along = np.clip(sum(rel[i] * axis[i] for i in range(len(start))) /
+                    length2, 0, 1) if length2 else 0
+
+    dist2 = sum((rel[i] - along * axis[i])**2 for i in range(len(start)))
+
+    return dist2 <= radius**2
+
+
+def _paint(arr, value, lower, upper, inside):
+    '''Set the voxels of arr within the box [lower, upper] (numpy order) for
+    which inside(grid) is true to value, where grid is an open grid of the
+    indices of the box. Only the box is ever computed on, which keeps small
+    features cheap to draw in large phantoms.'''
+    box = tuple(slice(max(int(np.floor(lo)), 0), min(int(np.ceil(hi)) + 1, n))
+                for (lo, hi, n) in zip(lower, upper, arr.shape))
+
+    if any(b.start >= b.stop for b in box):
+        return
+
+    arr[box][inside(np.ogrid[box])] = value
+
+
+def random_vessels(size, n_vessels=12, seed=0):
+    '''
+    Produce a crude vascular tree for a phantom of the (image-indexed) size:
+    n_vessels vessels per lung running from its hilum to random points in
+    the lung, each with two thinner branches. Vessels are returned as
+    (start, end, radius) triples in image-indexed voxels, suitable for the
+    vessels argument of chest_phantom.
+    '''
+    rand = np.random.RandomState(seed)
+    (nx, ny, nz) = size
+    scale = max(nx / 256.0, 0.5)
+
+    def in_lung(side):  # pylint: disable=C0111
+        direction = rand.normal(size=3)
+        point = direction / np.linalg.norm(direction) * rand.uniform() ** 0.33
+        return (nx * (side + 0.15 * 0.9 * point[0]),
+                ny * (0.5 + 0.3 * 0.9 * point[1]),
+                nz * (0.5 + 0.4 * 0.9 * point[2]))
+
+    vessels = []
+    for side in (0.3, 0.7):
+        hilum = (nx * (0.4 if side < 0.5 else 0.6), ny * 0.5, nz * 0.5)
+
+        for _ in range(n_vessels):
+            end = in_lung(side)
+            radius = rand.uniform(1.0, 2.0) * scale
+            vessels.append((hilum, end, radius))
+
+            for _ in range(2):
+                branch = tuple(e + (p - e) * 0.5 for (e, p) in
+                               zip(end, in_lung(side)))
+                vessels.append((end, branch, radius * 0.6))
+
+    return vessels
+
+
+def chest_phantom(size=(96, 96, 64), nodules=(), spacing=(1.0, 1.0, 1.0),
+                  noise=0, vessels=(), spiculated=()):
+    '''
+    Produce an image (image-indexed size, i.e. (x, y, z)) containing an
+    elliptical soft-tissue body in air, with two ellipsoidal lungs inside it.
+    Nodules are given as a sequence of ((x, y, z), radius) pairs in voxels and
+    are drawn as soft-tissue spheres. Spiculated nodules are given as
+    ((x, y, z), radius, n_spicules) triples, and are drawn as spheres with
+    n_spicules thin spikes of twice their radius radiating from them. Vessels
+    are (start, end, radius) triples (see random_vessels), drawn as soft
+    tissue tubes. If noise is nonzero, gaussian noise of that standard
+    deviation (in HU) is added.
+    '''
+    shape = tuple(reversed(size))
+    grid = np.ogrid[[slice(0, n) for n in shape]]
+    (nz, ny, nx) = shape
+
+    arr = np.empty(shape, dtype='int16')
+    arr.fill(AIR)
+
+    # the body spans the full height of the volume, so the chest is an
+    # elliptic cylinder rather than an ellipsoid
+    body = _ellipsoid(grid[1:], (ny/2.0, nx/2.0), (ny*0.42, nx*0.45))
+    arr[np.broadcast_to(body, shape)] = TISSUE
+
+    for side in (0.3, 0.7):
+        center = (nz/2.0, ny/2.0, nx*side)
+        radii = (nz*0.4, ny*0.3, nx*0.15)
+        _paint(arr, LUNG, np.subtract(center, radii), np.add(center, radii),
+               lambda g, c=center, r=radii: _ellipsoid(g, c, r))
+
+    # a crude pair of bronchi joins the lungs, so they form a single air
+    # component as they do in a real chest
+    bronchi = _ellipsoid(grid, (nz/2.0, ny/2.0, nx/2.0),
+                         (nz*0.05, ny*0.05, nx*0.25))
+    arr[bronchi] = LUNG
+
+    for (start, end, radius) in vessels:
+        (start, end) = (tuple(reversed(start)), tuple(reversed(end)))
+        _paint(arr, TISSUE, np.minimum(start, end) - radius,
+               np.maximum(start, end) + radius,
+               lambda g, s=start, e=end, r=radius: _capsule(g, s, e, r))
+
+    rand = np.random.RandomState(1)
+    for (center, radius, n_spicules) in spiculated:
+        center = tuple(reversed(center))
+        for _ in range(n_spicules):
+            direction = rand.normal(size=3)
+            tip = tuple(np.add(center, direction / np.linalg.norm(direction) *
+                               2 * radius))
+            thickness = max(radius / 5.0, 0.75)
+            _paint(arr, TISSUE, np.minimum(center, tip) - thickness,
+                   np.maximum(center, tip) + thickness,
+                   lambda g, t=tip, c=center, r=thickness:
+                   _capsule(g, c, t, r))
+
+    for (center, radius) in list(nodules) + [n[:2] for n in spiculated]:
+        center = tuple(reversed(center))
+        _paint(arr, TISSUE, np.subtract(center, radius),
+               np.add(center, radius),
+               lambda g, c=center, r=radius: _ellipsoid(g, c, (r,)*3))
+
+    if noise:
+        rand = np.random.RandomState(0)
+        arr = arr + rand.normal(0, noise, shape).astype('int16')
+
+    img = sitk.GetImageFromArray(arr)
+    img.SetSpacing(spacing)
+
+    return img
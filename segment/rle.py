@@ -0,0 +1,194 @@
+'''A run-length encoded binary mask. Nodule segmentations cover a tiny fraction
+of the volume, so storing and combining them as runs of foreground voxels is
+far cheaper than doing the same with dense arrays.'''
+
+import numpy as np
+import SimpleITK as sitk  # pylint: disable=F0401
+
+import views
+
+
+class RLEMask(object):
+    '''
+    A binary mask of the given (numpy-ordered, ie. z, y, x) shape stored as
+    sorted, disjoint half-open runs [starts[i], stops[i]) of foreground voxels.
+
+    Runs never cross the end of a row (the last axis): positions are indices
+    into the array flattened with a one voxel gap appended to every row, so
+    the voxel (z, y, x) is at (z*ny + y)*(nx + 1) + x. The gap keeps runs in
+    neighbouring rows from merging, which keeps bounding boxes cheap.
+    '''
+
+    def __init__(self, shape, starts=(), stops=(), geometry=None):
+        self.shape = tuple(int(s) for s in shape)
+        self.starts = np.asarray(starts, dtype='int64')
+        self.stops = np.asarray(stops, dtype='int64')
+
+        # origin, spacing and direction of the image the mask came from
+        self.geometry = geometry
+
+        assert len(self.starts) == len(self.stops)
+
+    @property
+    def row_length(self):
+        '''The distance between the starts of consecutive rows.'''
+        return self.shape[-1] + 1
+
+    @classmethod
+    def from_array(cls, arr, geometry=None):
+        '''Encode the nonzero voxels of the array arr.'''
+        index = np.flatnonzero(arr)
+        index += index // arr.shape[-1]
+
+        # a run breaks wherever consecutive foreground voxels aren't adjacent
+        breaks = np.flatnonzero(np.diff(index) != 1) + 1
+        starts = index[np.concatenate(([0], breaks))] if len(index) else index
+        stops = (index[np.concatenate((breaks - 1, [len(index) - 1]))] + 1
+                 if len(index) else index)
+
+        return cls(arr.shape, starts, stops, geometry)
+
+    @classmethod
+    def full(cls, shape, geometry=None):
+        '''A mask of the given shape in which every voxel is foreground.'''
+        rows = int(np.prod(shape[:-1]))
+        starts = np.arange(rows, dtype='int64') * (shape[-1] + 1)
+
+        return cls(shape, starts, starts + shape[-1], geometry)
+
+    @classmethod
+    def from_image(cls, img):
+        '''Encode the nonzero voxels of the SimpleITK image img.'''
+        geometry = (img.GetOrigin(), img.GetSpacing(), img.GetDirection())
+
+        return cls.from_array(views.array_view(img), geometry)
+
+    def to_array(self, dtype='uint8', out=None):
+        '''Decode the mask into a dense array of the given type, or into the
+        array out if one is given.'''
+        edges = np.zeros(int(np.prod(self.shape[:-1])) * self.row_length + 1,
+                         dtype='int8')
+        np.add.at(edges, self.starts, 1)
+        np.add.at(edges, self.stops, -1)
+
+        arr = np.cumsum(edges[:-1], dtype='int8').reshape(
+            self.shape[:-1] + (self.row_length,))
+
+        if out is None:
+            return np.array(arr[..., :-1], dtype=dtype)
+
+        out[...] = arr[..., :-1]
+        return out
+
+    def to_image(self):
+        '''Decode the mask into a uint8 SimpleITK image, in place.'''
+        img = sitk.Image(list(reversed(self.shape)), sitk.sitkUInt8)
+        self.to_array(out=views.writeable_view(img))
+
+        if self.geometry is not None:
+            (origin, spacing, direction) = self.geometry
+            img.SetOrigin(origin)
+            img.SetSpacing(spacing)
+            img.SetDirection(direction)
+
+        return img
+
+    def count(self):
+        '''The number of foreground voxels.'''
+        return int(np.sum(self.stops - self.starts))
+
+    def _position(self, index):
+        '''The position of the (numpy-ordered) index in the run coordinates.
+        Raises IndexError if index is outside the mask.'''
+        if len(index) != len(self.shape) or \
+           any(not 0 <= i < s for (i, s) in zip(index, self.shape)):
+            raise IndexError("Index " + str(index) + " is outside a mask " +
+                             "of shape " + str(self.shape))
+
+        return int(np.ravel_multi_index(index[:-1], self.shape[:-1]) *
+                   self.row_length + index[-1])
+
+    def contains(self, index):
+        '''True if the voxel at the numpy-ordered index is foreground.'''
+        pos = self._position(index)
+        i = np.searchsorted(self.starts, pos, side='right') - 1
+
+        return i >= 0 and pos < self.stops[i]
+
+    def bounding_box(self):
+        '''
+        The bounding box of the foreground, as a list of (first, last+1) pairs
+        in numpy axis order like bounding.bounding_cube, or None if the mask
+        is empty.
+        '''
+        if len(self.starts) == 0:
+            return None
+
+        rows = self.starts // self.row_length
+        lims = [(int(ax.min()), int(ax.max()) + 1) for ax in
+                np.unravel_index(rows, self.shape[:-1])]
+
+        lims.append((int((self.starts % self.row_length).min()),
+                     int((self.stops - rows * self.row_length).max())))
+
+        return tuple(lims)
+
+    def union(self, *others):
+        '''The voxels in this mask or any of others.'''
+        return vote((self,) + others, 1)
+
+    def intersection(self, *others):
+        '''The voxels in this mask and all of others.'''
+        return vote((self,) + others, len(others) + 1)
+
+    def __eq__(self, other):
+        return (self.shape == other.shape and
+                np.array_equal(self.starts, other.starts) and
+                np.array_equal(self.stops, other.stops))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "RLEMask(shape=" + str(self.shape) + ", runs=" + \
+            str(len(self.starts)) + ", count=" + str(self.count()) + ")"
+
+
+def vote(masks, k):
+    '''
+    The voxels present in at least k of masks, which must all have the same
+    shape. Runs in time proportional to the total number of runs rather than
+    the volume of the masks. If k is less than one, every voxel is present.
+    '''
+    masks = list(masks)
+
+    if not masks:
+        raise ValueError("Can't vote amongst zero masks.")
+    for mask in masks[1:]:
+        if mask.shape != masks[0].shape:
+            raise ValueError("Mask shapes " + str(mask.shape) + " and " +
+                             str(masks[0].shape) + " differ.")
+
+    if k < 1:
+        return RLEMask.full(masks[0].shape, masks[0].geometry)
+
+    if not any(len(m.starts) for m in masks):
+        return RLEMask(masks[0].shape, geometry=masks[0].geometry)
+
+    # sweep the run boundaries in order, tracking how many masks cover the
+    # voxels between each boundary and the next
+    events = np.concatenate([m.starts for m in masks] +
+                            [m.stops for m in masks])
+    deltas = np.concatenate([np.ones(len(m.starts), dtype='int64')
+                             for m in masks] +
+                            [-np.ones(len(m.stops), dtype='int64')
+                             for m in masks])
+
+    (positions, inverse) = np.unique(events, return_inverse=True)
+    cover = np.cumsum(np.bincount(inverse, weights=deltas).astype('int64'))
+
+    inside = cover >= k
+    entered = np.concatenate(([False], inside[:-1]))
+
+    return RLEMask(masks[0].shape, positions[inside & ~entered],
+                   positions[~inside & entered], masks[0].geometry)
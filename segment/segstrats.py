@@ -66,6 +66,12 @@ def batch_segment(seg_alg, seg_label, outpath,
     times = [stats[f]['time'] for f in stats if 'time' in stats[f]]
     skipped = [f for f in stats if stats[f] == 'skipped']
 
+    # itk templates are resolved once per process, so only the first
+    # pipeline built should pay much build time
+    for key in ['build_time', 'run_time']:
+        stats['run'][key] = sum([stats[f][key] for f in stats
+                                 if key in stats[f]], datetime.timedelta())
+
     stats['run']['total_time'] = datetime.datetime.now() - allstart
 
     return stats
@@ -109,7 +115,7 @@ def aniso_gauss_watershed(in_image, out_image, **kwargs):
 
     pipe = itk_attach.ConverterStage(pipe, "UC")
 
-    pipe = itk_attach.FileWriter(pipe, out_image)
+    pipe = itk_attach.Pipeline(itk_attach.FileWriter(pipe, out_image))
 
     pipe.execute()
 
@@ -127,7 +133,7 @@ def aniso_gauss_watershed(in_image, out_image, **kwargs):
 
     medpy.io.save(img, out_image, hdr)
 
-    return {}
+    return pipe.times()
 
 
 def aniso_gauss_sigmo_geocontour(in_image, out_image, **kwargs):
@@ -167,12 +173,15 @@ def aniso_gauss_sigmo_geocontour(in_image, out_image, **kwargs):
 
     pipe = itk_attach.BinaryThreshStage(geo, binary['threshold'])
 
-    pipe = itk_attach.FileWriter(pipe, out_image)
+    pipe = itk_attach.Pipeline(itk_attach.FileWriter(pipe, out_image))
 
     # run the pipeline
     pipe.execute()
 
-    return {'geodesic_iterations': geo.instance.GetElapsedIterations()}
+    res = pipe.times()
+    res['geodesic_iterations'] = geo.instance.GetElapsedIterations()
+
+    return res
 
 
 def aniso_gauss_confidence(in_image, out_image, **kwargs):
@@ -204,10 +213,12 @@ def aniso_gauss_confidence(in_image, out_image, **kwargs):
                                              connect_param['stddevs'],
                                              connect_param['neighborhood'])
 
-    pipe = itk_attach.FileWriter(pipe, out_image)
+    pipe = itk_attach.Pipeline(itk_attach.FileWriter(pipe, out_image))
 
     pipe.execute()
 
+    return pipe.times()
+
 
 def flow_confidence(in_image, out_image, **kwargs):
     '''Perform a curvatureflow + confidence connected segmentation strategy.'''
@@ -246,6 +257,8 @@ def flow_confidence(in_image, out_image, **kwargs):
 
     pipe = itk_attach.BinaryFillholeStage(pipe)
 
-    pipe = itk_attach.FileWriter(pipe, out_image)
+    pipe = itk_attach.Pipeline(itk_attach.FileWriter(pipe, out_image))
 
     pipe.execute()
+
+    return pipe.times()
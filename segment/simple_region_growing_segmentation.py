@@ -48,6 +48,9 @@ def process_command_line(argv):
                         "images (i.e. after each filter stage.")
     parser.add_argument('--no_overwrite', default=False, action="store_true",
                         help="Do not overwrite existing files.")
+    parser.add_argument('--preload', action="store_true", default=False,
+                        help="Load itk and the filters used before " +
+                        "segmenting, rather than with the first image.")
 
     args = parser.parse_args(argv[1:])
 
@@ -62,6 +65,7 @@ def process_command_line(argv):
     configs.label = args.label
     configs.path = args.path
     configs.no_overwrite = args.no_overwrite
+    configs.preload = args.preload
 
     configs.intermediate_images = args.intermediate_images
 
@@ -99,6 +103,10 @@ def main(argv=None):
     allstart = datetime.datetime.now()
     configs = process_command_line(argv)
 
+    if configs.preload:
+        import itk_attach
+        print "Loaded itk in", itk_attach.preload(), "seconds"
+
     print "Segmenting", len(configs.images), "images"
     times = []
     skipped = []
@@ -3,17 +3,47 @@ import SimpleITK as sitk  # pylint: disable=F0401
 import numpy as np
 import datetime
 import os
+import copy
+import weakref
 
 from functools import wraps
+from collections import OrderedDict
 import logging
 
 import lungseg
+import hierarchy
+import bounding
+import tracing
+import views
 
 
-def write(img, fname, compression=True):
+# The suffix of the sidecar holding image geometry for raw .npy images.
+NPY_HEADER_EXT = '.hdr.json'
+
+# The suffix of the sidecar describing where a cropped image sits in its
+# full-size original.
+CROP_HEADER_EXT = '.crop.json'
+
+# The statistics computed by segment_stats, by the id of the image they were
+# computed of, alongside a weak reference to that image.
+_STATS = {}
+
+# The pixel types whose nonzero values segment_stats can take as labels.
+LABEL_PIXEL_IDS = (sitk.sitkUInt8, sitk.sitkInt8, sitk.sitkUInt16,
+                   sitk.sitkInt16, sitk.sitkUInt32, sitk.sitkInt32,
+                   sitk.sitkUInt64, sitk.sitkInt64)
+
+
+def write(img, fname, compression=True, crop=False):
     '''
     A wrapper for sitk WriteImage that defaults to using compression and
-    creates directories where required.
+    creates directories where required. The format is chosen by extension;
+    use .nii.gz for compressed NIfTI, .nii for uncompressed NIfTI, or .npy for
+    a raw array that can be memory-mapped when read back (see write_npy).
+
+    If crop is set, only the bounding box of the nonzero voxels of img is
+    written, and read restores the full-size image. This is appropriate for
+    segmentations of small objects in large volumes.
     '''
 
     # ImageFileWriter fails if the directory doesn't exist. Create if req'd
@@ -22,14 +52,178 @@ def write(img, fname, compression=True):
     except OSError:
         pass
 
-    sitk.WriteImage(img, fname, compression)
+    if crop:
+        img = _write_crop_header(img, fname)
+    elif os.path.exists(fname + CROP_HEADER_EXT):
+        # left by an earlier, cropped, write of the same name, it would make
+        # read paste this image into the old geometry
+        os.remove(fname + CROP_HEADER_EXT)
+
+    if fname.endswith('.npy'):
+        write_npy(img, fname)
+    else:
+        sitk.WriteImage(img, fname, compression)
+
+
+def write_npy(img, fname):
+    '''Write img as a raw numpy .npy array, with its geometry (origin,
+    spacing and direction) in a JSON sidecar named fname + NPY_HEADER_EXT.'''
+    import json
+
+    np.save(fname, views.array_view(img))
+
+    with open(fname + NPY_HEADER_EXT, 'w') as f:
+        f.write(json.dumps({'origin': img.GetOrigin(),
+                            'spacing': img.GetSpacing(),
+                            'direction': img.GetDirection()}))
+
+
+def read_array(fname):
+    '''Memory-map a raw image written by write_npy. Returns the read-only
+    array (in numpy (z, y, x) order) and its geometry dict, without reading
+    any voxels from disk until they are used.'''
+    import json
+
+    with open(fname + NPY_HEADER_EXT) as f:
+        geometry = json.loads(f.read())
+
+    return (np.load(fname, mmap_mode='r'), geometry)
+
+
+def read(fname, full=True):
+    '''Read an image written by write. Raw .npy images are memory-mapped and
+    copied once into the SimpleITK image, without any decompression. Images
+    written cropped are restored to full size unless full is False, in which
+    case the cropped image (whose origin places it correctly in physical
+    space) is returned.'''
+    if fname.endswith('.npy'):
+        (arr, geometry) = read_array(fname)
+
+        img = sitk.GetImageFromArray(arr)
+        img.SetOrigin(geometry['origin'])
+        img.SetSpacing(geometry['spacing'])
+        img.SetDirection(geometry['direction'])
+    else:
+        img = sitk.ReadImage(fname)
 
+    if full and os.path.exists(fname + CROP_HEADER_EXT):
+        img = _uncrop(img, fname)
 
-def read(fname):
-    img = sitk.ReadImage(fname)
     return img
 
 
+def segment_stats(img):
+    '''
+    Compute the number of nonzero voxels of img, their bounding box and their
+    centroid in a single LabelShapeStatistics pass, without leaving ITK. The
+    nonzero values of an integer image are taken as labels and their
+    statistics combined. Returns a dict of 'size', 'bbox' ((index, size) in
+    image (x, y, z) order) and 'centroid' (a continuous index); the latter two
+    are None if img is entirely zero.
+
+    The statistics are cached for as long as the image object img lives, so
+    asking again of the same image is free. Copies of img, and images read
+    back from disk, don't share the cache. img mustn't be changed in place
+    once asked about.
+    '''
+    key = id(img)
+
+    if key in _STATS and _STATS[key][0]() is img:
+        return copy.deepcopy(_STATS[key][1])
+
+    shape = sitk.LabelShapeStatisticsImageFilter()
+    shape.ComputePerimeterOff()
+    shape.Execute(img if img.GetPixelID() in LABEL_PIXEL_IDS else img != 0)
+
+    dim = img.GetDimension()
+    (size, lower, upper, moment) = (0, [], [], np.zeros(dim))
+
+    for label in shape.GetLabels():
+        n_vox = shape.GetNumberOfPixels(label)
+        bbox = shape.GetBoundingBox(label)
+
+        size += n_vox
+        lower.append(bbox[:dim])
+        upper.append([i + n for (i, n) in zip(bbox[:dim], bbox[dim:])])
+        moment += n_vox * np.array(img.TransformPhysicalPointToContinuousIndex(
+            shape.GetCentroid(label)))
+
+    stats = {'size': size, 'bbox': None, 'centroid': None}
+    if size:
+        (lower, upper) = (np.min(lower, axis=0), np.max(upper, axis=0))
+        stats['bbox'] = [[int(i) for i in lower],
+                         [int(u - l) for (l, u) in zip(lower, upper)]]
+        stats['centroid'] = list(moment / size)
+
+    _STATS[key] = (weakref.ref(img, lambda _: _STATS.pop(key, None)),
+                   copy.deepcopy(stats))
+
+    return stats
+
+
+def nonzero_bounding_box(img):
+    '''Compute the bounding box of the nonzero voxels of img without leaving
+    ITK. Returns (index, size) in image (x, y, z) order, or None if img is
+    entirely zero.'''
+    bbox = segment_stats(img)['bbox']
+
+    return tuple(bbox) if bbox is not None else None
+
+
+def _write_crop_header(img, fname):
+    '''Crop img to its nonzero bounding box, recording the full-size geometry
+    and crop position in a sidecar at fname + CROP_HEADER_EXT.'''
+    import json
+
+    bbox = nonzero_bounding_box(img)
+    if bbox is None:
+        # sitk has no empty images, so keep a single (zero) voxel
+        bbox = ([0] * img.GetDimension(), [1] * img.GetDimension())
+
+    with open(fname + CROP_HEADER_EXT, 'w') as f:
+        f.write(json.dumps({'size': img.GetSize(),
+                            'index': bbox[0],
+                            'origin': img.GetOrigin(),
+                            'spacing': img.GetSpacing(),
+                            'direction': img.GetDirection()}))
+
+    return sitk.RegionOfInterest(img, bbox[1], bbox[0])
+
+
+def _uncrop(img, fname):
+    '''Paste the cropped image img, read from fname, back into a zero image
+    of the full size recorded in its crop sidecar.'''
+    import json
+
+    with open(fname + CROP_HEADER_EXT) as f:
+        header = json.loads(f.read())
+
+    full = sitk.Image(header['size'], img.GetPixelID())
+    full.SetOrigin(header['origin'])
+    full.SetSpacing(header['spacing'])
+    full.SetDirection(header['direction'])
+
+    return sitk.Paste(full, img, img.GetSize(), [0] * img.GetDimension(),
+                      header['index'])
+
+
+# Bytes per pixel component for each SimpleITK pixel type.
+_COMPONENT_BYTES = {sitk.sitkUInt8: 1, sitk.sitkInt8: 1,
+                    sitk.sitkUInt16: 2, sitk.sitkInt16: 2,
+                    sitk.sitkUInt32: 4, sitk.sitkInt32: 4,
+                    sitk.sitkUInt64: 8, sitk.sitkInt64: 8,
+                    sitk.sitkFloat32: 4, sitk.sitkFloat64: 8,
+                    sitk.sitkVectorFloat32: 4, sitk.sitkVectorFloat64: 8}
+
+
+def image_nbytes(img):
+    '''The size in bytes of the pixel buffer of img, computed without
+    touching the buffer. Unusual pixel types are assumed to be 8 bytes.'''
+    npix = reduce(lambda x, y: x * y, img.GetSize())
+    return (npix * img.GetNumberOfComponentsPerPixel() *
+            _COMPONENT_BYTES.get(img.GetPixelID(), 8))
+
+
 def hash_img(img, provenance=""):
     '''
     Calculate the hash of an image and the options that would be used to
@@ -39,25 +233,28 @@ def hash_img(img, provenance=""):
     import hashlib
 
     sha = hashlib.sha512()
-    sha.update(sitk.GetArrayFromImage(img))
+    sha.update(views.array_view(img))
     sha.update(provenance)
 
     return sha.hexdigest()
 
 
 def log_size(func):
-    '''A decorator that calculates the size of a segmentation.'''
+    '''A decorator that calculates the size, bounding box and centroid of a
+    segmentation (see segment_stats).'''
     @wraps(func)
     def exec_func(img, opts=None):
-        '''Execute func from outer context and compute the size of the image
-        func produces.'''
+        '''Execute func from outer context and compute the size, bounding box
+        and centroid of the image func produces.'''
         if opts is None:
             opts = {}
 
         (img_out, opts_out) = func(img, opts)
 
-        opts['size'] = np.count_nonzero(  # pylint: disable=E1101
-            sitk.GetArrayFromImage(img_out))
+        stats = segment_stats(img_out)
+        opts['size'] = stats['size']
+        opts['bbox'] = stats['bbox']
+        opts['centroid'] = stats['centroid']
 
         return (img_out, opts_out)
 
@@ -66,16 +263,16 @@ def log_size(func):
 
 def options_log(func):
     '''A decorator that will modify the incoming options object to also include
-    information about runtime and algorithm choice.'''
+    information about runtime and algorithm choice. Each call is traced as a
+    span of category 'strategy' (see tracing.py).'''
     @wraps(func)
     def exec_func(*args, **kwargs):
         '''The inner function for options_log'''
-        start = datetime.datetime.now()
-
-        (img, out_opts) = func(*args, **kwargs)
+        with tracing.span(func.__name__, 'strategy') as timer:
+            (img, out_opts) = func(*args, **kwargs)
 
         out_opts['algorithm'] = func.__name__
-        out_opts['time'] = datetime.datetime.now() - start
+        out_opts['time'] = datetime.timedelta(seconds=timer.wall)
 
         return (img, out_opts)
 
@@ -84,7 +281,8 @@ def options_log(func):
 
 def cached(relevant_opts, max_cache_size=1):
     '''A decorator that uses options and input image to cache an image for
-    possible later reuse.'''
+    possible later reuse. The decorated function gains cache_clear(), which
+    empties the cache, and cache_nbytes(), the pixel bytes it holds.'''
 
     def cached_decorator(func):
         '''
@@ -132,6 +330,11 @@ def cached(relevant_opts, max_cache_size=1):
                 cache.popitem(last=True)
 
             return (img, opts)
+
+        exec_func.cache_clear = cache.clear
+        exec_func.cache_nbytes = lambda: sum(image_nbytes(i)
+                                             for i in cache.values())
+
         return exec_func
     return cached_decorator
 
@@ -145,8 +348,8 @@ def com_calc(img, max_size, min_size, lung_img):
     from scipy.ndimage.measurements import center_of_mass as com
     # pylint: disable=E1101
 
-    arr = sitk.GetArrayFromImage(img)
-    lung_arr = sitk.GetArrayFromImage(lung_img)
+    arr = views.array_view(img)
+    lung_arr = views.array_view(lung_img)
 
     # Take elements from arr only when lung_arr is not zero, i.e. take only
     # regions in the lung.
@@ -190,7 +393,7 @@ def com_calc(img, max_size, min_size, lung_img):
     # these are array-indexed and we take our seeds to be image-indexed
     # plus, they're floats and need to be cast back to integers
     seeds = [[int(k) for k in reversed(s)] for s in com_list
-             if lung_arr[s] == 1]
+             if lung_arr[tuple(int(k) for k in s)] == 1]
 
     info = {'nseeds': len(seeds),
             'max_size': max_size,
@@ -208,17 +411,37 @@ def crop_to_segmentation(img, seg_img, padding_ratio=None, padding_px=None):
     Given an image and a segmentation of that image, crop the image to include
     only the portions of the image present in that segmentation. Only one of
     padding_px and padding_ratio can be specified.
+
+    img may also be a list of images on the same grid, which are all cropped
+    the same way (and returned as a list) for the cost of one bounding box.
+    In place of seg_img, the bounding box of the segmentation may be given
+    directly, as (index, size) in image (x, y, z) order (see segment_stats).
     '''
-    from bounding import bounding_cube
+    several = isinstance(img, (list, tuple))
+    imgs = img if several else [img]
 
     # it's not allowed to specify both padding_ratio and padding_px
     assert not ((padding_px is not None) and (padding_ratio is not None))
 
-    assert img.GetSize() == seg_img.GetSize()
-    assert img.GetSpacing() == seg_img.GetSpacing()
+    img = imgs[0]
+    for other in imgs[1:]:
+        assert other.GetSize() == img.GetSize()
+        assert other.GetSpacing() == img.GetSpacing()
+
+    if isinstance(seg_img, sitk.Image):
+        assert img.GetSize() == seg_img.GetSize()
+        assert img.GetSpacing() == seg_img.GetSpacing()
+
+        # the bounding box is usually already known from log_size
+        bbox = segment_stats(seg_img)['bbox']
+    else:
+        bbox = seg_img
 
-    # calculate the bounding cube of the lung segmentation in numpy coordinates
-    lims = bounding_cube(sitk.GetArrayFromImage(seg_img))
+    if bbox is None:
+        raise ValueError("Can't crop to an empty segmentation.")
+
+    # the bounding cube of the segmentation in numpy coordinates
+    lims = tuple((i, i + n) for (i, n) in reversed(zip(*bbox)))
 
     # calculate the amount of each image to be removed (in itk indexing)
     lower_remove = [l[0] for l in reversed(lims)]
@@ -242,7 +465,9 @@ def crop_to_segmentation(img, seg_img, padding_ratio=None, padding_px=None):
         raise ValueError("Padded removes " + str(padded_removes) +
                          " are invalid.")
 
-    return (sitk.Crop(img, *padded_removes),
+    cropped = [sitk.Crop(i, *padded_removes) for i in imgs]
+
+    return (cropped if several else cropped[0],
             {"origin": (lims[0][0], lims[1][0], lims[2][0]),
              "padding": padding})
 
@@ -251,7 +476,7 @@ def distribute_seeds(img, n_pts=100):
     '''Randomly distribute n seeds amongst all points where img != 0'''
     import random
 
-    array = sitk.GetArrayFromImage(img)
+    array = views.array_view(img)
 
     seeds = list()
     while len(seeds) < n_pts:
@@ -288,62 +513,87 @@ def aniso_gauss(img_in, options):
 @log_size
 @options_log
 def segmentation_union(imgs, options):
-    '''Compute a consensus segmentation amongst a small set of segmentations'''
-    # pylint: disable=E1101
-    # Sadly, images and arrays have a different coordinate system (z, y, x) vs
-    # (x, y, z) so it's safest just to convert here. Don't worry, it's fast.
-    incl_count = np.zeros(sitk.GetArrayFromImage(imgs[0]).shape)
-    n_img = 0
-
-    # This would be memory-expensive for large numbers of images, but it's only
-    # a couple so ith's hopefully ok.
-    for img in [sitk.GetArrayFromImage(i) for i in imgs]:
-        assert img.shape == incl_count.shape
-
-        img_size = np.count_nonzero(img)
+    '''Compute a consensus segmentation amongst a small set of segmentations:
+    the voxels in at least options['threshold'] of those that pass the size
+    gates, as a fraction. A threshold of zero gives every voxel.'''
+    from rle import RLEMask, vote
+
+    # segmentations are a tiny fraction of the volume, so sizing and voting
+    # on them as run-length encoded masks is much cheaper than dense arrays
+    # (the sizes of strategy outputs are usually known from log_size)
+    masks = []
+    for img in imgs:
+        assert img.GetSize() == imgs[0].GetSize()
+
+        img_size = segment_stats(img)['size']
         if img_size < options['max_size'] and \
            img_size > options['min_size']:
-            n_img += 1
-            incl_count += (img != 0)
+            masks.append(RLEMask.from_image(img))
 
     # store the number of images that passed QC
+    n_img = len(masks)
     options['n_imgs'] = n_img
 
     if n_img == 0:
         raise RuntimeWarning("No images satisifed image size thresholds" +
                              str((options['min_size'], options['max_size'])))
 
-    # sitk is pretty particular about the datatypes that come in to
-    # GetImageFromArray, and the default output from the following (bool?)
-    # isn't acceptable apparently
-    consensus = np.array(incl_count >= options['threshold'] * n_img,
-                         dtype='uint8')
+    # the smallest number of votes satisfying votes >= threshold * n_img
+    consensus = vote(masks, int(np.ceil(options['threshold'] * n_img)))
 
-    consensus_size = np.count_nonzero(consensus)
+    consensus_size = consensus.count()
     if consensus_size < options['min_size']:
         raise RuntimeWarning("Consensus image failed size threshold.  " +
                              "Image too small at " + str(consensus_size))
 
-    consensus = sitk.GetImageFromArray(consensus)
+    consensus = consensus.to_image()
     consensus.CopyInformation(imgs[0])
-    consensus = sitk.Cast(consensus, sitk.sitkUInt8)
 
     return (consensus, options)
 
 
-@log_size
-@options_log
-def segment_lung(img, options):
-    '''Produce a lung segmentation from an input image.'''
+def _lung_mask(img, dialate_radius, erode_radius, method='kernel'):
+    '''Run the lungseg pipeline on img with the given morphology radii and
+    morphology method (see lungseg.dialate).'''
 
     img = lungseg.otsu(img)
     img = lungseg.find_components(img)
     img = lungseg.isolate_lung_field(img)
-    img = lungseg.dialate(img, options['probe_size'])
+    img = lungseg.dialate(img, dialate_radius, method)
     img = lungseg.find_components(img)
     img = lungseg.isolate_not_biggest(img)
-    img = sitk.BinaryErode(img, options['probe_size']-2,
-                           sitk.BinaryErodeImageFilter.Ball)
+    img = lungseg.erode(img, erode_radius, method)
+
+    return img
+
+
+@log_size
+@options_log
+def segment_lung(img, options):
+    '''Produce a lung segmentation from an input image. If
+    options['downsample'] is an integer greater than one, the segmentation is
+    computed on a copy of the image shrunk by that factor (with the morphology
+    radii scaled to match) and only the boundary band is refined at full
+    resolution. The result agrees with the full-resolution mask up to the
+    boundary band, which is good enough for gating seeds and sizes.
+
+    options['morphology'] selects how the dilation and erosion are computed,
+    either 'kernel' (the default) or 'distance'; see lungseg.dialate.'''
+
+    factor = options.get('downsample', 1)
+    method = options.get('morphology', 'kernel')
+
+    if factor > 1:
+        lowres = lungseg.shrink(img, factor)
+        mask = _lung_mask(
+            lowres,
+            max(1, int(round(options['probe_size'] / float(factor)))),
+            max(0, int(round((options['probe_size']-2) / float(factor)))),
+            method)
+        img = lungseg.refine_boundary(mask, img, margin=2, method=method)
+    else:
+        img = _lung_mask(img, options['probe_size'], options['probe_size']-2,
+                         method)
 
     return (img, options)
 
@@ -357,6 +607,10 @@ def curvature_flow(img_in, options):
         options['curvature_flow']['timestep'],
         options['curvature_flow']['iterations'])
 
+    # CurvatureFlow computes (and returns) doubles whatever its input, which
+    # is twice the memory of the single precision it was given
+    img = sitk.Cast(img, sitk.sitkFloat32)
+
     return (img, options)
 
 
@@ -394,20 +648,56 @@ def aniso_gauss_watershed(img_in, options_in):
     return (img, options)
 
 
+@options_log
+def aniso_gauss_hierarchy(img_in, options_in):
+    '''Compute CurvatureAnisotropicDiffusion +
+    GradientMagnitudeRecursiveGaussian featurization of the image, and the
+    hierarchy of its watershed at options['watershed']['base_level'], from
+    which the watershed at any higher level can be cut. Returns a
+    hierarchy.WatershedHierarchy rather than an image.'''
+
+    (img, options) = aniso_gauss(img_in, options_in)
+
+    hier = hierarchy.WatershedHierarchy.from_image(
+        img, options['watershed']['base_level'])
+    options['basins'] = len(hier)
+
+    return (hier, options)
+
+
 @log_size
 @options_log
 def isolate_watershed(img_in, options):
-    '''Isolate a particular one of the watershed segmentations.'''
+    '''Isolate a particular one of the watershed segmentations. If
+    options['label_index'] is a bounding.LabelIndex of img_in, the label's
+    voxels are looked up there rather than found by scanning img_in.
+    Otherwise the label's bounding box is found in one scan of img_in, and
+    only that box is compared against the label.'''
     seed = options['seed']
 
-    arr = sitk.GetArrayFromImage(img_in)
+    # the index is shared between seeds, and isn't something to log
+    index = options.pop('label_index', None)
 
-    label = arr[seed[2], seed[1], seed[0]]
+    label = img_in.GetPixel(*[int(s) for s in seed])
     options['label'] = int(label)
 
-    lab_arr = np.array(arr == label, dtype='float32')  # pylint: disable=E1101
-
-    out_img = sitk.GetImageFromArray(lab_arr)
+    if index is not None:
+        (mask, lims) = index.mask(label)
+    elif img_in.GetPixelID() in LABEL_PIXEL_IDS and label > 0:
+        arr = views.array_view(img_in)
+        lims = bounding.label_bounding_boxes(arr, [label])[label]
+        mask = (arr[tuple(slice(l, u) for (l, u) in lims)] == label)
+        mask = mask.astype('uint8')
+    else:
+        # the background, or a non-integer image, has no box to crop to
+        return (sitk.Cast(img_in == label, sitk.sitkUInt8), options)
+
+    mask = sitk.GetImageFromArray(mask)
+
+    out_img = sitk.Image(img_in.GetSize(), sitk.sitkUInt8)
+    out_img = sitk.Paste(out_img, mask, mask.GetSize(),
+                         [0]*mask.GetDimension(),
+                         [int(l[0]) for l in reversed(lims)])
     out_img.CopyInformation(img_in)
 
     return (out_img, options)
@@ -428,54 +718,282 @@ def aniso_gauss_sigmo(img_in, opts_in):
     return (img, options)
 
 
-@log_size
-@options_log
-def fastmarch_seeded_geocontour(img_in, options):
-    '''Segment img_in using a GeodesicActiveContourLevelSetImageFilter with an
-    inital level set built using FastMarchingImageFilter at options['seed']'''
+def _converge_geocontour(geodesic, level_set, img_in, options):
+    '''
+    Evolve level_set with the geodesic filter in chunks of
+    options['geodesic']['convergence']['check_interval'] iterations, stopping
+    once the contour's voxel count has changed by less than a fraction
+    'tolerance' for 'patience' consecutive chunks, or once it has leaked past
+    a fraction 'max_size_frac' of options['lung_size'] (if given). Stops at
+    the latest after options['geodesic']['iterations'] iterations. The reason
+    for stopping, the iteration count and the size at each check are recorded
+    in options['geodesic'].
+
+    Each chunk restarts the filter, which initialises the level set over all
+    of img_in again. That is cheap for a region of interest, but over a whole
+    image it costs more than stopping early saves unless the contour leaks.
+    '''
+    conv = options['geodesic']['convergence']
+    budget = options['geodesic']['iterations']
+
+    max_size = None
+    if 'lung_size' in options:
+        max_size = conv['max_size_frac'] * options['lung_size']
+
+    elapsed = 0
+    stable_checks = 0
+    sizes = []
+    reason = 'iterations'
+
+    while elapsed < budget:
+        chunk = min(conv['check_interval'], budget - elapsed)
+        geodesic.SetNumberOfIterations(chunk)
+
+        # each chunk restarts from the level set the last one finished with
+        level_set = geodesic.Execute(level_set, img_in)
+        elapsed += geodesic.GetElapsedIterations()
+
+        sizes.append(int(np.count_nonzero(
+            views.array_view(level_set) < 0)))
+
+        if geodesic.GetElapsedIterations() < chunk:
+            # the filter's own RMS criterion was met
+            reason = 'rms'
+            break
+        elif max_size is not None and sizes[-1] > max_size:
+            # segmentation_union would discard this contour anyway
+            reason = 'leak'
+            break
+        elif len(sizes) > 1 and \
+                abs(sizes[-1] - sizes[-2]) <= conv['tolerance'] * sizes[-2]:
+            stable_checks += 1
+            if stable_checks >= conv['patience']:
+                reason = 'stable'
+                break
+        else:
+            stable_checks = 0
+
+    options['geodesic']['elapsed_iterations'] = elapsed
+    options['geodesic']['rms_change'] = geodesic.GetRMSChange()
+    options['geodesic']['termination'] = reason
+    options['geodesic']['size_trace'] = sizes
+
+    return level_set
+
+
+# Caches for _seed_level_set: distance stencils, keyed by spacing, radius,
+# shift and pixel type, and the constant background that stencils are pasted
+# into, keyed by size, pixel type and value. Each holds only a few entries.
+_STENCIL_CACHE = OrderedDict()
+_BACKGROUND_CACHE = OrderedDict()
+_LEVEL_SET_CACHE_SIZE = 2
 
-    # The speed of wave propagation should be one everywhere, so we produce
-    # an appropriately sized np array of all ones and convert it into an img
-    ones_img = sitk.GetImageFromArray(np.ones(  # pylint: disable=E1101
-        sitk.GetArrayFromImage(img_in).shape))
-    ones_img.CopyInformation(img_in)
 
-    fastmarch = sitk.FastMarchingImageFilter()
+def clear_caches():
+    '''Empty every in-process image cache of this module, eg. to release
+    memory.'''
+    aniso_gauss.cache_clear()
+    _STENCIL_CACHE.clear()
+    _BACKGROUND_CACHE.clear()
+
+
+def _cache_get(cache, key, build):
+    '''Fetch key from cache, or build and add it, evicting the least
+    recently used entry if the cache is full.'''
+    if key in cache:
+        value = cache.pop(key)
+    else:
+        value = build()
+
+    cache[key] = value
+    while len(cache) > _LEVEL_SET_CACHE_SIZE:
+        cache.popitem(last=False)
+
+    return value
+
+
+def _distance_stencil(spacing, radius, seed_shift, pixel_id):
+    '''
+    The FastMarchingImageFilter distance (in physical units) from the centre
+    of a cube of voxels with the given spacing, out to radius, less
+    seed_shift. Beyond radius the distance is clamped to radius. Returns the
+    stencil image and the index of its centre.
+    '''
+    def build():  # pylint: disable=C0111
+        center = [int(np.ceil(radius / sp)) + 1 for sp in spacing]
+
+        # unit speed everywhere, in double precision as FastMarching was
+        # always run on np.ones
+        speed = sitk.Image([2*c + 1 for c in center], sitk.sitkFloat64) + 1
+        speed.SetSpacing(spacing)
+
+        fastmarch = sitk.FastMarchingImageFilter()
+        fastmarch.SetStoppingValue(radius)
+        fastmarch.SetTrialPoints([center])
+
+        dist = sitk.Minimum(fastmarch.Execute(speed), radius)
+        dist = sitk.Cast(dist - seed_shift, pixel_id)
+        dist.SetSpacing((1,) * len(spacing))
+
+        return (dist, center)
+
+    return _cache_get(_STENCIL_CACHE,
+                      (tuple(spacing), radius, seed_shift, pixel_id), build)
+
+
+def _seed_level_set(img_in, seed, seed_shift):
+    '''
+    Build an initial level set for img_in: the distance from seed less
+    seed_shift, so that the zero level set is a small sphere around seed.
+
+    Level set filters only use the values next to the zero level set, so
+    distances are computed (once, and cached) in a stencil a couple of voxels
+    larger than the sphere, and everywhere else is given the stencil's
+    largest value. The level set is the cached stencil pasted into a cached
+    constant image the size of img_in, which avoids a full-volume
+    FastMarching run and several full-volume arrays for every seed. Within
+    the stencil the values are those fastmarching over img_in produced.
+    '''
+    spacing = img_in.GetSpacing()
+    radius = seed_shift + 2 * max(spacing)
+    (stencil, center) = _distance_stencil(spacing, radius, seed_shift,
+                                          img_in.GetPixelID())
 
-    # to save time, we limit the distances we calculate to a quarter of the
-    # image size away (i.e. a region no more than half the image in diameter).
-    fastmarch.SetStoppingValue(max(img_in.GetSize())*0.25)
-    seeds = sitk.VectorUIntList()
-    seeds.append(options['seed'])
-    fastmarch.SetTrialPoints(seeds)
+    outside = radius - seed_shift
+    size = img_in.GetSize()
 
-    seed_img = fastmarch.Execute(ones_img)
+    def build_background():  # pylint: disable=C0111
+        background = sitk.Image(size, img_in.GetPixelID()) + outside
+        return background
 
-    # FastMarch won't output the right PixelType, so we have to cast.
-    seed_img = sitk.Cast(seed_img, img_in.GetPixelID())
+    background = _cache_get(_BACKGROUND_CACHE,
+                            (size, img_in.GetPixelID(), outside),
+                            build_background)
 
-    # Generally speaking, you're supposed to subtract an amount from the
-    # input level set, so that growing algorithm doesn't need to go as far
-    img_shifted = sitk.GetImageFromArray(
-        sitk.GetArrayFromImage(seed_img) - options['seed_shift'])
-    img_shifted.CopyInformation(seed_img)
-    seed_img = img_shifted
+    # clip the stencil where it falls off the edge of the image
+    dest_index = [max(s - c, 0) for (s, c) in zip(seed, center)]
+    src_index = [d - s + c for (s, c, d) in zip(seed, center, dest_index)]
+    paste_size = [min(s + c + 1, n) - d for (s, c, n, d)
+                  in zip(seed, center, size, dest_index)]
+
+    level_set = sitk.Paste(background, stencil, paste_size, src_index,
+                           dest_index)
+    level_set.CopyInformation(img_in)
+
+    return level_set
+
+
+def _geocontour(level_set, img_in, options):
+    '''Evolve level_set over the speed image img_in with a
+    GeodesicActiveContourLevelSetImageFilter configured by
+    options['geodesic'], and return the binary segmentation it encloses.'''
+
+    # the geodesic options are shared between seeds, so copy them before
+    # recording this run's statistics in them
+    options['geodesic'] = dict(options['geodesic'])
 
     geodesic = sitk.GeodesicActiveContourLevelSetImageFilter()
     geodesic.SetPropagationScaling(
         options['geodesic']['propagation_scaling'])
-    geodesic.SetNumberOfIterations(
-        options['geodesic']['iterations'])
     geodesic.SetCurvatureScaling(
         options['geodesic']['curvature_scaling'])
     geodesic.SetMaximumRMSError(
         options['geodesic']['max_rms_change'])
 
-    out = geodesic.Execute(seed_img, img_in)
+    if 'convergence' in options['geodesic']:
+        out = _converge_geocontour(geodesic, level_set, img_in, options)
+    else:
+        geodesic.SetNumberOfIterations(
+            options['geodesic']['iterations'])
 
-    options['geodesic']['elapsed_iterations'] = geodesic.GetElapsedIterations()
-    options['geodesic']['rms_change'] = geodesic.GetRMSChange()
+        out = geodesic.Execute(level_set, img_in)
+
+        options['geodesic']['elapsed_iterations'] = \
+            geodesic.GetElapsedIterations()
+        options['geodesic']['rms_change'] = geodesic.GetRMSChange()
 
-    out = sitk.BinaryThreshold(out, insideValue=0, outsideValue=1)
+    return sitk.BinaryThreshold(out, insideValue=0, outsideValue=1)
+
+
+@log_size
+@options_log
+def fastmarch_seeded_geocontour(img_in, options):
+    '''Segment img_in using a GeodesicActiveContourLevelSetImageFilter with an
+    inital level set built using FastMarchingImageFilter at options['seed'].
+    If options['geodesic'] has a 'convergence' dict, the contour is stopped
+    early once it converges or leaks (see _converge_geocontour).'''
+
+    seed_img = _seed_level_set(img_in, options['seed'],
+                               options['seed_shift'])
+
+    out = _geocontour(seed_img, img_in, options)
 
     return (out, options)
+
+
+def _touches_roi_border(seg, roi_index, roi_size, img_size, margin):
+    '''True if the foreground of seg, a segmentation of the region of
+    interest at roi_index of size roi_size in an image of img_size, comes
+    within margin voxels of a side of the region that isn't also a side of
+    the image.'''
+    bbox = nonzero_bounding_box(seg)
+    if bbox is None:
+        return False
+
+    for (d, (lo, n)) in enumerate(zip(*bbox)):
+        if lo < margin and roi_index[d] > 0:
+            return True
+        if lo + n > roi_size[d] - margin and \
+           roi_index[d] + roi_size[d] < img_size[d]:
+            return True
+
+    return False
+
+
+@log_size
+@options_log
+def roi_seeded_geocontour(img_in, options):
+    '''
+    Segment img_in like fastmarch_seeded_geocontour, but only within a
+    region of interest around options['seed'], so that the cost of each
+    seed scales with the size of the nodule rather than the volume. The
+    region extends options['roi']['radius'] voxels from the seed and is
+    doubled (up to 'max_radius') whenever the contour comes within 'margin'
+    voxels of its border, unless it has already leaked (see
+    _converge_geocontour). The segmentation is returned at full size.
+    '''
+    roi_opts = options['roi']
+    seed = options['seed']
+    img_size = img_in.GetSize()
+
+    radius = roi_opts['radius']
+    while True:
+        index = [max(s - radius, 0) for s in seed]
+        size = [min(s + radius + 1, n) - i
+                for (s, n, i) in zip(seed, img_size, index)]
+
+        roi = sitk.RegionOfInterest(img_in, size, index)
+        seed_img = _seed_level_set(
+            roi, [s - i for (s, i) in zip(seed, index)],
+            options['seed_shift'])
+
+        out = _geocontour(seed_img, roi, options)
+
+        touches = _touches_roi_border(out, index, size, img_size,
+                                      roi_opts['margin'])
+        leaked = options['geodesic'].get('termination') == 'leak'
+        if not touches or leaked or radius >= roi_opts['max_radius'] or \
+           list(size) == list(img_size):
+            break
+
+        radius = min(2 * radius, roi_opts['max_radius'])
+
+    options['roi'] = dict(roi_opts)
+    options['roi'].update({'final_radius': radius, 'index': index,
+                           'size': size, 'touches_border': touches})
+
+    full = sitk.Image(img_size, out.GetPixelID())
+    full.CopyInformation(img_in)
+
+    return (sitk.Paste(full, out, out.GetSize(), [0]*len(index), index),
+            options)
@@ -0,0 +1,130 @@
+import unittest
+import tempfile
+import shutil
+import os
+import SimpleITK as sitk  # pylint: disable=F0401
+import numpy as np
+
+import artefacts
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class TestArtefactStore(unittest.TestCase):
+    '''test artefacts.ArtefactStore round trips, integrity checks and gc'''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = artefacts.ArtefactStore(self.root)
+
+        arr = np.zeros((8, 9, 10), dtype='uint8')
+        arr[2:5, 3:6, 4:7] = 1
+        self.img = sitk.GetImageFromArray(arr)
+
+        self.opts = {'probe_size': 7}
+        self.builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def build(self):
+        self.builds += 1
+        opts = dict(self.opts)
+        opts['size'] = 27
+        return (self.img, opts)
+
+    def test_fetch(self):
+        (img, info) = self.store.fetch('lung', 'abc', self.opts, self.build)
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(info['size'], 27)
+
+        (img, info) = self.store.fetch('lung', 'abc', self.opts, self.build)
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(info['size'], 27)
+        self.assertEqual(info['file'], self.store.path('lung', 'abc',
+                                                       self.opts))
+        self.assertTrue(np.array_equal(sitk.GetArrayFromImage(img),
+                                       sitk.GetArrayFromImage(self.img)))
+
+        # different options are a different artefact
+        self.store.fetch('lung', 'abc', {'probe_size': 5}, self.build)
+        self.assertEqual(self.builds, 2)
+
+    def test_json(self):
+        with self.assertRaises(KeyError):
+            self.store.load_json('seeds', 'abc', self.opts)
+
+        self.store.save_json('seeds', 'abc', self.opts, {'seeds': [[1, 2, 3]]})
+        self.assertEqual(self.store.load_json('seeds', 'abc', self.opts),
+                         {'seeds': [[1, 2, 3]]})
+
+    def test_arrays(self):
+        with self.assertRaises(KeyError):
+            self.store.load_arrays('hier', 'abc', self.opts)
+
+        arrays = {'labels': np.arange(24).reshape(2, 3, 4),
+                  'levels': np.array([0.5, 2.0])}
+        self.store.save_arrays('hier', 'abc', self.opts, arrays, {'n': 2})
+
+        (loaded, info) = self.store.load_arrays('hier', 'abc', self.opts)
+        self.assertEqual(info['n'], 2)
+        self.assertEqual(sorted(loaded), ['labels', 'levels'])
+        for key in arrays:
+            self.assertTrue(np.array_equal(loaded[key], arrays[key]))
+
+    def test_corruption(self):
+        self.store.save('lung', 'abc', self.opts, self.img, {})
+
+        with open(self.store.path('lung', 'abc', self.opts), 'ab') as f:
+            f.write('garbage')
+
+        with self.assertRaises(KeyError):
+            self.store.load('lung', 'abc', self.opts)
+
+        self.assertEqual([e['status'] for e in self.store.entries()],
+                         ['corrupt'])
+
+    def test_gc(self):
+        self.store.save('lung', 'abc', self.opts, self.img, {})
+        self.store.save('lung', 'def', self.opts, self.img, {})
+        self.store.save_json('seeds', 'abc', self.opts, [])
+
+        self.assertEqual(len(self.store.entries()), 3)
+        self.assertEqual(len(self.store.entries(sha='abc')), 2)
+
+        # nothing is invalid or old enough to collect
+        self.assertEqual(self.store.gc(), [])
+        self.assertEqual(len(self.store.gc(older_than=0, sha='abc',
+                                           dry_run=True)), 2)
+        self.assertEqual(len(self.store.entries()), 3)
+
+        removed = self.store.gc(older_than=0, sha='abc')
+        self.assertEqual(sorted(e['kind'] for e in removed), ['lung', 'seeds'])
+        self.assertEqual([e['sha'] for e in self.store.entries()], ['def'])
+
+    def test_npy(self):
+        store = artefacts.ArtefactStore(self.root, image_ext='.npy',
+                                        formats={'labels': '.nii.gz'},
+                                        verify='size')
+        self.assertTrue(store.path('lung', 'abc', {}).endswith('.npy'))
+        self.assertTrue(store.path('labels', 'abc', {}).endswith('.nii.gz'))
+
+        store.save('lung', 'abc', self.opts, self.img, {})
+        (img, _) = store.load('lung', 'abc', self.opts)
+        self.assertTrue(np.array_equal(sitk.GetArrayFromImage(img),
+                                       sitk.GetArrayFromImage(self.img)))
+
+        # truncation is caught by the size check
+        fname = store.path('lung', 'abc', self.opts)
+        with open(fname, 'r+b') as f:
+            f.truncate(100)
+        with self.assertRaises(KeyError):
+            store.load('lung', 'abc', self.opts)
+
+        store.gc()
+        self.assertEqual(os.listdir(os.path.join(self.root, 'lung')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
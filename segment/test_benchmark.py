@@ -0,0 +1,36 @@
+import unittest
+
+import benchmark
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class TestBenchmarks(unittest.TestCase):
+    '''smoke test the benchmark harnesses on small phantoms'''
+
+    def test_strategies(self):
+        args = benchmark.process_command_line(
+            ['benchmark.py', 'strategies', '--size', '48', '48', '32',
+             '--nseeds', '2', '--only', 'com_calc', 'isolate_watershed'])
+
+        results = benchmark.bench_strategies(args)
+
+        self.assertEqual(sorted(results), ['com_calc', 'isolate_watershed'])
+        for res in results.values():
+            self.assertGreater(res['throughput'], 0)
+
+    def test_copies(self):
+        args = benchmark.process_command_line(
+            ['benchmark.py', 'copies', '--size', '48', '48', '32',
+             '--nseeds', '2'])
+
+        counts = benchmark.bench_copies(args)
+
+        self.assertGreater(counts['nseeds'], 0)
+        self.assertIn('image:run_img', counts['total'])
+        self.assertIn('strategy:isolate_watershed', counts['per_seed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import tempfile
+import shutil
+import os
+import SimpleITK as sitk  # pylint: disable=F0401
+import numpy as np
+
+import bgwriter
+import sitkstrats
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class TestBackgroundWriter(unittest.TestCase):
+    '''test bgwriter.BackgroundWriter writes, back-pressure and errors'''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.imgs = [sitk.GetImageFromArray(
+            np.full((10, 10, 10), i, dtype='int16')) for i in range(6)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_written(self, fnames):
+        for (i, fname) in enumerate(fnames):
+            arr = sitk.GetArrayFromImage(sitkstrats.read(fname))
+            self.assertTrue(np.all(arr == i))
+
+    def test_write(self):
+        for nthreads in (0, 1, 3):
+            writer = bgwriter.BackgroundWriter(nthreads=nthreads)
+            fnames = [os.path.join(self.dir, str(nthreads), str(i) + '.nii.gz')
+                      for i in range(len(self.imgs))]
+
+            for (img, fname) in zip(self.imgs, fnames):
+                writer.write(img, fname)
+            writer.close()
+
+            self.check_written(fnames)
+
+    def test_backpressure(self):
+        # every image exceeds the byte budget, so each write has to wait for
+        # the previous one to finish
+        writer = bgwriter.BackgroundWriter(nthreads=2, max_pending=1,
+                                           max_pending_bytes=1)
+        fnames = [os.path.join(self.dir, str(i) + '.npy')
+                  for i in range(len(self.imgs))]
+
+        for (img, fname) in zip(self.imgs, fnames):
+            writer.write(img, fname)
+            self.assertLessEqual(writer.pending_bytes, 2000)
+        writer.flush()
+
+        self.assertEqual(writer.pending_bytes, 0)
+        self.check_written(fnames)
+        writer.close()
+
+    def test_errors(self):
+        # there's no ImageIO for this extension, so sitk raises
+        writer = bgwriter.BackgroundWriter(nthreads=1)
+        writer.write(self.imgs[0], os.path.join(self.dir, 'a.unknown'))
+        writer.write(self.imgs[0], os.path.join(self.dir, 'ok.nii'))
+
+        with self.assertRaises(IOError):
+            writer.flush()
+
+        # the error is only reported once, and the good write went through
+        writer.close()
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'ok.nii')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import SimpleITK as sitk  # pylint: disable=F0401
+import numpy as np
+
+import bounding
+import sitkstrats
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class TestBoundingCube(unittest.TestCase):
+    '''test bounding.bounding_cube against the coordinates of true values'''
+
+    def test_bounding_cube(self):
+        rng = np.random.RandomState(0)
+
+        for p in (0.001, 0.01, 0.5):
+            arr = rng.rand(9, 10, 11) < p
+            nonzero = np.argwhere(arr)
+
+            self.assertEqual(bounding.bounding_cube(arr), tuple(zip(
+                nonzero.min(axis=0), nonzero.max(axis=0) + 1)))
+
+    def test_empty(self):
+        self.assertEqual(bounding.bounding_cube(np.zeros((3, 4, 5))),
+                         ((0, 3), (0, 4), (0, 5)))
+
+
+class TestBatchedBoxes(unittest.TestCase):
+    '''test the batched bounding boxes against bounding.bounding_cube'''
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.arr = rng.randint(0, 6, size=(7, 8, 9)).astype('uint32')
+        self.arr[self.arr == 4] = 0
+        self.arr[2:4, 1:5, 3:6] = 9
+
+    def test_label_bounding_boxes(self):
+        boxes = bounding.label_bounding_boxes(self.arr)
+
+        self.assertEqual(sorted(boxes), [1, 2, 3, 5, 9])
+        for (label, box) in boxes.items():
+            self.assertEqual(box, bounding.bounding_cube(self.arr == label))
+
+        self.assertEqual(bounding.label_bounding_boxes(self.arr, [2, 4, 9]),
+                         dict((l, boxes[l]) for l in (2, 9)))
+        self.assertEqual(bounding.label_bounding_boxes(self.arr, []), {})
+
+    def test_stacked_bounding_boxes(self):
+        masks = [self.arr == label for label in range(10)]
+        boxes = bounding.stacked_bounding_boxes(m for m in masks)
+
+        for (mask, box) in zip(masks, boxes):
+            if mask.any():
+                self.assertEqual(box, bounding.bounding_cube(mask))
+            else:
+                self.assertEqual(box, None)
+
+        self.assertEqual(bounding.stacked_bounding_boxes([]), [])
+
+
+class TestLabelIndex(unittest.TestCase):
+    '''test bounding.LabelIndex lookups against scanning the label array'''
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.arr = rng.randint(0, 6, size=(7, 8, 9)).astype('uint32')
+        self.arr[2:4, 1:5, 3:6] = 9
+        self.index = bounding.LabelIndex(self.arr)
+
+    def test_lookups(self):
+        self.assertEqual(len(self.index), 7)
+        self.assertNotIn(7, self.index)
+
+        for label in np.unique(self.arr):
+            self.assertTrue(np.array_equal(
+                self.index.voxels(label),
+                np.flatnonzero(self.arr == label)))
+            self.assertEqual(self.index.bounding_box(label),
+                             bounding.bounding_cube(self.arr == label))
+
+        with self.assertRaises(KeyError):
+            self.index.voxels(7)
+
+    def test_mask(self):
+        (mask, lims) = self.index.mask(9)
+
+        self.assertEqual(lims, ((2, 4), (1, 5), (3, 6)))
+        self.assertEqual(mask.dtype, np.uint8)
+        self.assertTrue(np.all(mask == 1))
+
+    def test_isolate_watershed(self):
+        img = sitk.GetImageFromArray(self.arr)
+        img.SetOrigin((1, 2, 3))
+
+        for seed in ([4, 2, 3], [0, 0, 0], [8, 7, 6]):
+            (plain, _) = sitkstrats.isolate_watershed(img, {'seed': seed})
+            (indexed, info) = sitkstrats.isolate_watershed(
+                img, {'seed': seed, 'label_index': self.index})
+
+            self.assertNotIn('label_index', info)
+            self.assertEqual(info['label'],
+                             self.arr[seed[2], seed[1], seed[0]])
+            self.assertEqual(indexed.GetOrigin(), img.GetOrigin())
+            self.assertTrue(np.array_equal(sitk.GetArrayFromImage(plain),
+                                           sitk.GetArrayFromImage(indexed)))
+            self.assertTrue(np.array_equal(
+                sitk.GetArrayFromImage(indexed),
+                self.arr == info['label']))
+
+
+if __name__ == '__main__':
+    unittest.main()
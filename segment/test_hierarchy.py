@@ -0,0 +1,66 @@
+import unittest
+import SimpleITK as sitk  # pylint: disable=F0401
+import numpy as np
+
+import hierarchy
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class TestWatershedHierarchy(unittest.TestCase):
+    '''test hierarchy.WatershedHierarchy on three cone-shaped pits of known
+    depth, whose dynamics are about 5 (the shallowest) and 9 (the middle)'''
+
+    def setUp(self):
+        (z, y, x) = np.mgrid[0:20, 0:30, 0:40].astype('float64')
+        pits = [((10, 8, 8), 0.), ((10, 8, 30), 3.), ((10, 22, 20), 8.)]
+
+        arr = np.min([np.sqrt((z-a)**2 + (y-b)**2 + (x-c)**2) + depth
+                      for ((a, b, c), depth) in pits], axis=0)
+        self.img = sitk.GetImageFromArray(arr.astype('float32'))
+        self.img.SetSpacing((0.5, 0.7, 2.0))
+
+        self.hier = hierarchy.WatershedHierarchy.from_image(self.img)
+
+    def labels_at(self, img, pit):
+        return sitk.GetArrayFromImage(img)[pit]
+
+    def test_cut(self):
+        self.assertEqual(len(self.hier), 3)
+
+        base = sitk.MorphologicalWatershed(self.img, markWatershedLine=True,
+                                           fullyConnected=False)
+        self.assertTrue(np.array_equal(
+            sitk.GetArrayFromImage(self.hier.cut(1)),
+            sitk.GetArrayFromImage(base)))
+
+        pits = [(10, 8, 8), (10, 8, 30), (10, 22, 20)]
+        for (level, n_regions) in [(1, 3), (7, 2), (12, 1)]:
+            cut = self.hier.cut(level)
+            arr = sitk.GetArrayFromImage(cut)
+            self.assertEqual(self.hier.n_regions(level), n_regions)
+            self.assertEqual(len(np.unique(arr[arr != 0])), n_regions)
+            self.assertEqual(len(set(arr[p] for p in pits)), n_regions)
+            self.assertEqual(cut.GetSpacing(), self.img.GetSpacing())
+
+        # the shallowest pit is absorbed first, into the pit it overflows to
+        arr = sitk.GetArrayFromImage(self.hier.cut(7))
+        self.assertEqual(arr[pits[2]], arr[pits[0]])
+
+        # once everything has merged, no watershed line is left
+        self.assertEqual(np.count_nonzero(
+            sitk.GetArrayFromImage(self.hier.cut(12)) == 0), 0)
+
+    def test_arrays(self):
+        hier = hierarchy.WatershedHierarchy.from_arrays(self.hier.to_arrays())
+
+        self.assertEqual(hier.geometry, self.hier.geometry)
+        for level in (1, 7, 12):
+            self.assertTrue(np.array_equal(
+                sitk.GetArrayFromImage(hier.cut(level)),
+                sitk.GetArrayFromImage(self.hier.cut(level))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import sys
+import unittest
+
+import itk_attach
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class FakeTemplate(object):
+    '''Stands in for an itk template, counting the lookups made of it.'''
+
+    def __init__(self, types):
+        self.types = types
+        self.lookups = 0
+
+    def __iter__(self):
+        self.lookups += 1
+        return iter(self.types)
+
+    def __getitem__(self, types):
+        self.lookups += 1
+        if types not in self.types:
+            raise KeyError(types)
+        return FakeFilter
+
+
+class FakeFilter(object):
+
+    @classmethod
+    def New(cls):
+        return cls()
+
+    def SetInput(self, img):
+        self.img = img
+
+    def Update(self):
+        pass
+
+    def GetOutput(self):
+        return self.img + 1
+
+
+class FakeSource(object):
+
+    def __init__(self, img_type):
+        self.created = 0
+        self.img_type = img_type
+
+    def out_type(self):
+        return self.img_type
+
+    def resolve(self):
+        pass
+
+    def execute(self):
+        return 0
+
+
+class TestItkAttach(unittest.TestCase):
+    '''test itk_attach's template cache and pipeline validation without itk'''
+
+    def test_lazy_import(self):
+        # importing itk_attach mustn't import itk
+        if 'itk' not in sys.modules:
+            reload(itk_attach)
+            self.assertNotIn('itk', sys.modules)
+
+    def test_instantiation_cache(self):
+        template = FakeTemplate([('F', 'F'), ('F', 'UC')])
+
+        for _ in range(3):
+            self.assertIs(itk_attach.instantiation(template, 'F', 'UC'),
+                          FakeFilter)
+            self.assertEqual(itk_attach.template_types(template),
+                             [('F', 'F'), ('F', 'UC')])
+
+        self.assertEqual(template.lookups, 2)
+
+        with self.assertRaises(KeyError):
+            itk_attach.instantiation(template, 'UC', 'UC')
+
+    def test_pipeline(self):
+        template = FakeTemplate([('F', 'F')])
+
+        source = FakeSource('F')
+        stage = itk_attach.PipeStage(template, source)
+        stage = itk_attach.PipeStage(template, stage)
+
+        pipe = itk_attach.Pipeline(stage)
+        self.assertEqual(len(pipe.stages), 3)
+        self.assertEqual(pipe.execute(), 2)
+        self.assertEqual(sorted(pipe.times()), ['build_time', 'run_time'])
+
+        # a source whose type changes after the graph is built is caught
+        # before anything runs
+        source.img_type = 'UC'
+        with self.assertRaises(TypeError):
+            itk_attach.Pipeline(stage)
+
+    def test_invalid_stages(self):
+        good = FakeTemplate([('F', 'F')])
+        bad = FakeTemplate([('UC', 'UC')])
+
+        # building a graph with a stage that can't be instantiated for its
+        # input doesn't fail; validating it does, naming every such stage
+        stage = itk_attach.PipeStage(good, FakeSource('F'))
+        stage = itk_attach.PipeStage(bad, stage)
+        stage = itk_attach.PipeStage(good, stage)
+        self.assertIsNone(stage.instance)
+
+        with self.assertRaises(TypeError) as context:
+            itk_attach.Pipeline(stage)
+        self.assertEqual(str(context.exception).count("PipeStage:"), 1)
+        self.assertIsNotNone(stage.instance)
+
+        stage = itk_attach.PipeStage(bad, stage)
+        with self.assertRaises(TypeError) as context:
+            itk_attach.Pipeline(stage)
+        self.assertEqual(str(context.exception).count("PipeStage:"), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+import tempfile
+import shutil
+import time
+import warnings
+import SimpleITK as sitk  # pylint: disable=F0401
+import numpy as np
+
+import masterseg
+import sitkstrats
+import benchmark
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class TestSeedMemo(unittest.TestCase):
+    '''test that seeddep reuses memoised strategy results between seeds'''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+        arr = np.zeros((40, 40, 40), dtype='uint32')
+        arr[10:16, 10:16, 10:16] = 1
+        arr[22:30, 22:30, 22:30] = 2
+        self.labels = sitk.GetImageFromArray(arr)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def strats(self, memo):
+        strats = {}
+        for name in ['a', 'b', 'c']:
+            strats[name] = {'seed-dependent': {
+                'strategy': sitkstrats.isolate_watershed,
+                'opts': {}}}
+        strats['a']['seed-dependent']['memo'] = memo
+
+        return strats
+
+    def test_memo(self):
+        seeds = [[11, 11, 11], [25, 25, 25], [13, 14, 15]]
+        imgs = dict((name, self.labels) for name in ['a', 'b', 'c'])
+
+        for memo in ['label', 'region']:
+            info = masterseg.seeddep(imgs, seeds, self.dir, 'abc',
+                                     self.strats(memo), 8000, self.labels)
+
+            self.assertNotIn('memo_from', info['11-11-11']['a'])
+            self.assertNotIn('memo_from', info['25-25-25']['a'])
+            self.assertNotIn('memo_from', info['13-14-15']['b'])
+            self.assertEqual(info['13-14-15']['a']['memo_from'], '11-11-11')
+            self.assertEqual(info['13-14-15']['a']['seed'], [13, 14, 15])
+            self.assertEqual(info['13-14-15']['a']['size'], 216)
+
+            # the reused result gives the same consensus
+            for seed in info:
+                self.assertEqual(info[seed]['consensus']['size'],
+                                 info[seed]['b']['size'])
+
+        self.assertGreater(masterseg.PHASE_TIMES['seed-dependent'], 0)
+        self.assertGreater(masterseg.PHASE_TIMES['consensus'], 0)
+
+
+class TestConfigureStrats(unittest.TestCase):
+    '''test the strategy options configure_strats builds'''
+
+    def test_geodesic_convergence(self):
+        # convergence mode only applies to the region of interest strategy
+        for roi in (False, True):
+            opts = masterseg.configure_strats(
+                geodesic_convergence=True, geodesic_roi=roi)[
+                    'geodesic']['seed-dependent']['opts']
+
+            self.assertEqual('convergence' in opts['geodesic'], roi)
+            self.assertEqual('roi' in opts, roi)
+
+
+class TestPipeline(unittest.TestCase):
+    '''smoke test the pipeline benchmark's run of run_img on a small
+    phantom'''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.writer = masterseg.WRITER
+
+    def tearDown(self):
+        masterseg.WRITER = self.writer
+        shutil.rmtree(self.dir)
+
+    def test_run_pipeline(self):
+        (img, _) = benchmark.suite_phantom([48, 48, 32])
+
+        # newer numpys raise where this one warns (eg. on float indices).
+        # Warnings already issued are suppressed whatever the filter, so
+        # forget those.
+        getattr(sitkstrats, '__warningregistry__', {}).clear()
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', np.VisibleDeprecationWarning)
+            res = benchmark.run_pipeline(img, 3, self.dir, 1, 1)
+
+        self.assertGreater(res['seeds'], 0)
+        for phase in ['lungseg', 'seed-independent', 'seeds',
+                      'seed-dependent', 'consensus']:
+            self.assertGreater(res['phases'][phase], 0)
+
+
+class TestPhase(unittest.TestCase):
+    '''test that masterseg.phase times are exclusive of nested phases'''
+
+    def setUp(self):
+        masterseg.PHASE_TIMES.clear()
+
+    def test_nesting(self):
+        start = time.time()
+        with masterseg.phase('outer'):
+            time.sleep(0.02)
+            with masterseg.phase('inner'):
+                time.sleep(0.05)
+            with masterseg.phase('inner'):
+                time.sleep(0.05)
+        elapsed = time.time() - start
+
+        self.assertGreaterEqual(masterseg.PHASE_TIMES['inner'], 0.1)
+        self.assertGreaterEqual(masterseg.PHASE_TIMES['outer'], 0.02)
+
+        # the inner phases' time isn't also counted against the outer one
+        self.assertLessEqual(masterseg.PHASE_TIMES['outer'] +
+                             masterseg.PHASE_TIMES['inner'], elapsed)
+
+    def test_exception(self):
+        with self.assertRaises(ValueError):
+            with masterseg.phase('outer'):
+                raise ValueError()
+
+        self.assertIn('outer', masterseg.PHASE_TIMES)
+        self.assertEqual(masterseg._PHASE_STACK, [])  # pylint: disable=W0212
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+import tempfile
+import shutil
+import os
+import SimpleITK as sitk  # pylint: disable=F0401
+import numpy as np
+
+import memory
+import sitkstrats
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class TestMemoryLedger(unittest.TestCase):
+    '''test memory.MemoryLedger accounting and budget enforcement'''
+
+    def setUp(self):
+        self.spilled = []
+
+    def spiller(self, name):
+        return lambda: self.spilled.append(name)
+
+    def test_accounting(self):
+        ledger = memory.MemoryLedger()
+        ledger.hold('a', 100, self.spiller('a'))
+        ledger.hold('b', 50)
+        ledger.hold('a', 10)
+        ledger.release('b')
+
+        self.assertEqual(ledger.held, 10)
+        self.assertEqual(ledger.peak, 150)
+        self.assertEqual(self.spilled, [])
+        self.assertEqual(ledger.report()['held'], {'a': 10})
+
+    def test_budget(self):
+        ledger = memory.MemoryLedger(budget=200)
+        ledger.hold('image', 100)
+        ledger.hold('small', 40, self.spiller('small'))
+        ledger.hold('big', 60, self.spiller('big'))
+        ledger.hold('cache', 20, self.spiller('cache'), priority=0)
+        self.assertEqual(self.spilled, ['cache'])
+
+        # the largest spillable entry goes first
+        ledger.hold('more', 50)
+        self.assertEqual(self.spilled, ['cache', 'big'])
+        self.assertEqual(ledger.held, 190)
+        self.assertFalse(ledger.report()['over_budget'])
+
+        ledger.hold('too much', 100)
+        self.assertEqual(self.spilled, ['cache', 'big', 'small'])
+        self.assertTrue(ledger.report()['over_budget'])
+        self.assertEqual([a['spilled'] for a in ledger.actions],
+                         ['cache', 'big', 'small'])
+        self.assertEqual(ledger.report()['spills']['big'],
+                         {'times': 1, 'bytes': 60})
+
+    def test_pinned(self):
+        ledger = memory.MemoryLedger(budget=100, max_actions=2)
+        ledger.hold('empty', 0, self.spiller('empty'), priority=0)
+
+        with ledger.pinned('a'):
+            ledger.hold('a', 80, self.spiller('a'))
+            ledger.hold('b', 40, self.spiller('b'))
+            self.assertEqual(self.spilled, ['b'])
+
+            ledger.hold('b', 40, self.spiller('b'))
+            self.assertEqual(self.spilled, ['b', 'b'])
+
+        # unpinned, a can go, but empty entries are never 'spilled'
+        ledger.hold('b', 40, self.spiller('b'))
+        self.assertEqual(self.spilled, ['b', 'b', 'a'])
+
+        # only the last max_actions are kept, but every spill is counted
+        self.assertEqual([a['spilled'] for a in ledger.report()['actions']],
+                         ['b', 'a'])
+        self.assertEqual(ledger.report()['spills']['b']['times'], 2)
+
+
+class TestSpillableImages(unittest.TestCase):
+    '''test that spilled images are re-read intact'''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_spill(self):
+        img = sitk.GetImageFromArray(
+            np.arange(60, dtype='float32').reshape(3, 4, 5))
+        img.SetSpacing((0.5, 0.6, 0.7))
+        fname = os.path.join(self.dir, 'img.npy')
+        sitkstrats.write(img, fname)
+
+        imgs = memory.SpillableImages(a=img)
+        imgs.spill('a', fname)
+        self.assertTrue(imgs.spilled('a'))
+
+        for out in (imgs['a'], imgs.values()[0], dict(imgs.items())['a']):
+            self.assertEqual(out.GetSpacing(), img.GetSpacing())
+            self.assertTrue(np.array_equal(sitk.GetArrayFromImage(out),
+                                           sitk.GetArrayFromImage(img)))
+
+    def test_restore(self):
+        img = sitk.GetImageFromArray(np.ones((3, 4, 5), dtype='float32'))
+        fname = os.path.join(self.dir, 'img.npy')
+        sitkstrats.write(img, fname)
+
+        ledger = memory.MemoryLedger(budget=1000)
+        imgs = memory.SpillableImages(a=img)
+        imgs.spill('a', fname)
+
+        # a restored image is read once, accounted for, and spillable again
+        restored = imgs.restore('a', ledger, 'img')
+        self.assertFalse(imgs.spilled('a'))
+        self.assertIs(imgs.restore('a', ledger, 'img'), restored)
+        self.assertIs(imgs['a'], restored)
+        self.assertEqual(ledger.held, 240)
+
+        ledger.hold('other', 900)
+        self.assertTrue(imgs.spilled('a'))
+        self.assertEqual([a['spilled'] for a in ledger.actions], ['img'])
+
+
+if __name__ == '__main__':
+    unittest.main()
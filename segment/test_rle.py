@@ -0,0 +1,81 @@
+import unittest
+import SimpleITK as sitk  # pylint: disable=F0401
+import numpy as np
+
+import rle
+import bounding
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class TestRLEMask(unittest.TestCase):
+    '''test rle.RLEMask against the equivalent dense array operations'''
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.arrs = [rng.rand(7, 8, 9) < p for p in (0.2, 0.5, 0.7)]
+
+        # runs touching the ends of rows mustn't merge across them
+        self.arrs[0][3, 4, :] = True
+        self.arrs[0][3, 5, :] = True
+
+        self.masks = [rle.RLEMask.from_array(a) for a in self.arrs]
+
+    def test_round_trip(self):
+        for (arr, mask) in zip(self.arrs, self.masks):
+            self.assertTrue(np.array_equal(mask.to_array(), arr))
+            self.assertEqual(mask.count(), np.count_nonzero(arr))
+
+        self.assertEqual(self.masks[0], rle.RLEMask.from_array(self.arrs[0]))
+        self.assertNotEqual(self.masks[0], self.masks[1])
+
+    def test_image(self):
+        img = sitk.GetImageFromArray(self.arrs[1].astype('uint8'))
+        img.SetSpacing((0.5, 0.7, 2.0))
+        img.SetOrigin((1, 2, 3))
+
+        out = rle.RLEMask.from_image(img).to_image()
+        self.assertEqual(out.GetSpacing(), img.GetSpacing())
+        self.assertEqual(out.GetOrigin(), img.GetOrigin())
+        self.assertTrue(np.array_equal(sitk.GetArrayFromImage(out),
+                                       sitk.GetArrayFromImage(img)))
+
+    def test_set_operations(self):
+        (a, b, c) = self.masks
+
+        self.assertTrue(np.array_equal(
+            a.union(b, c).to_array(),
+            self.arrs[0] | self.arrs[1] | self.arrs[2]))
+        self.assertTrue(np.array_equal(
+            a.intersection(b).to_array(), self.arrs[0] & self.arrs[1]))
+
+        votes = sum(arr.astype('int') for arr in self.arrs)
+        for k in (0, 1, 2, 3):
+            self.assertTrue(np.array_equal(rle.vote(self.masks, k).to_array(),
+                                           votes >= k))
+
+        empty = rle.RLEMask(a.shape)
+        self.assertEqual(a.intersection(empty).count(), 0)
+        self.assertEqual(a.union(empty), a)
+
+    def test_contains(self):
+        for index in [(0, 0, 0), (3, 4, 8), (3, 5, 0), (6, 7, 8), (2, 3, 4)]:
+            self.assertEqual(self.masks[0].contains(index),
+                             self.arrs[0][index])
+
+        with self.assertRaises(IndexError):
+            self.masks[0].contains((7, 0, 0))
+
+    def test_bounding_box(self):
+        arr = np.zeros((10, 11, 12), dtype='bool')
+        arr[2:5, 3, 4:9] = True
+        arr[7, 1:2, 8:11] = True
+
+        self.assertEqual(rle.RLEMask.from_array(arr).bounding_box(),
+                         bounding.bounding_cube(arr))
+        self.assertEqual(rle.RLEMask(arr.shape).bounding_box(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
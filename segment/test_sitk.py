@@ -1,5 +1,10 @@
 import unittest
+import tempfile
+import shutil
+import os
 import sitkstrats
+import lungseg
+import phantom
 import SimpleITK as sitk  # pylint: disable=F0401
 import numpy as np
 
@@ -20,6 +25,23 @@ class TestConsensusSeg(unittest.TestCase):
 
         # segmentation_union([i1, i2], )
 
+    def test_thresholds(self):
+        arrs = [np.zeros((20, 20, 20), dtype='uint8') for _ in range(3)]
+        arrs[0][3:8, 3:8, 3:8] = 1
+        arrs[1][5:10, 5:10, 5:10] = 1
+        arrs[2][6:9, 2:12, 6:9] = 1
+        votes = sum(a.astype('int') for a in arrs)
+
+        imgs = [sitk.GetImageFromArray(a) for a in arrs]
+        for threshold in (0.0, 0.5, 2.0/3.0, 1.0):
+            (out, _) = sitkstrats.segmentation_union(
+                imgs, {'threshold': threshold, 'max_size': 1e4,
+                       'min_size': 1})
+
+            # a threshold of zero takes every voxel, as it always has
+            self.assertTrue(np.array_equal(sitk.GetArrayFromImage(out),
+                                           votes >= threshold * 3))
+
 
 class TestCOMCalc(unittest.TestCase):
     '''test sitkstrats.com_calc with various fudged data'''
@@ -100,5 +122,410 @@ class TestCOMCalc(unittest.TestCase):
         self.assertEqual(nmask_seeds[0], [2, 2, 2])
 
 
+def dice(img1, img2):
+    (a1, a2) = [sitk.GetArrayFromImage(i) != 0 for i in (img1, img2)]
+    return 2.0 * np.count_nonzero(a1 & a2) / \
+        (np.count_nonzero(a1) + np.count_nonzero(a2))
+
+
+class TestSegmentLung(unittest.TestCase):
+    '''test sitkstrats.segment_lung against a synthetic chest phantom'''
+
+    def setUp(self):
+        self.img = phantom.chest_phantom(nodules=[((30, 48, 32), 4)])
+
+    def test_downsample_matches_full(self):
+        (full, full_info) = sitkstrats.segment_lung(
+            self.img, {'probe_size': 7})
+        (fast, fast_info) = sitkstrats.segment_lung(
+            self.img, {'probe_size': 7, 'downsample': 2})
+
+        self.assertEqual(fast.GetSize(), full.GetSize())
+        self.assertEqual(fast.GetPixelID(), full.GetPixelID())
+        self.assertGreater(fast_info['size'], 0)
+        self.assertGreater(dice(full, fast), 0.95)
+
+        # the nodule is inside the lung mask in both cases
+        self.assertEqual(full.GetPixel(30, 48, 32), 1)
+        self.assertEqual(fast.GetPixel(30, 48, 32), 1)
+
+    def test_vessels(self):
+        vessels = phantom.random_vessels((96, 96, 64), n_vessels=4)
+        img = phantom.chest_phantom(nodules=[((30, 48, 32), 4)],
+                                    spiculated=[((66, 50, 30), 3, 6)],
+                                    vessels=vessels)
+        arr = sitk.GetArrayFromImage(img)
+
+        # spicules and vessels add soft tissue to the lungs
+        self.assertGreater(np.count_nonzero(arr != sitk.GetArrayFromImage(
+            self.img)), 4**3)
+        self.assertEqual(img.GetPixel(66, 50, 30), phantom.TISSUE)
+
+        (lung, _) = sitkstrats.segment_lung(img, {'probe_size': 7})
+        self.assertEqual(lung.GetPixel(30, 48, 32), 1)
+        self.assertEqual(lung.GetPixel(66, 50, 30), 1)
+        self.assertGreater(dice(lung, sitkstrats.segment_lung(
+            self.img, {'probe_size': 7})[0]), 0.95)
+
+
+class TestDistanceMorphology(unittest.TestCase):
+    '''test that lungseg's distance-map morphology matches the ball kernels'''
+
+    def setUp(self):
+        rand = np.random.RandomState(0)
+        arr = np.zeros((30, 30, 30), dtype='uint8')
+        for _ in range(6):
+            (z, y, x) = rand.randint(4, 26, size=3)
+            arr[z-3:z+rand.randint(1, 4), y-2:y+2,
+                x-rand.randint(1, 4):x+3] = 1
+
+        self.img = sitk.GetImageFromArray(arr)
+
+    def assertImagesEqual(self, img1, img2):
+        self.assertEqual(img1.GetPixelID(), img2.GetPixelID())
+        self.assertTrue(np.array_equal(sitk.GetArrayFromImage(img1),
+                                       sitk.GetArrayFromImage(img2)))
+
+    def test_dialate(self):
+        for radius in (1, 2, 4):
+            self.assertImagesEqual(
+                lungseg.dialate(self.img, radius, 'kernel'),
+                lungseg.dialate(self.img, radius, 'distance'))
+
+    def test_erode(self):
+        for radius in (0, 1, 2):
+            self.assertImagesEqual(
+                lungseg.erode(self.img, radius, 'kernel'),
+                lungseg.erode(self.img, radius, 'distance'))
+
+    def test_close(self):
+        self.assertImagesEqual(lungseg.close(self.img, 3, 'kernel'),
+                               lungseg.close(self.img, 3, 'distance'))
+
+    def test_bad_method(self):
+        with self.assertRaises(ValueError):
+            lungseg.dialate(self.img, 1, 'fft')
+
+    def test_segment_lung(self):
+        img = phantom.chest_phantom()
+
+        (kernel, _) = sitkstrats.segment_lung(img, {'probe_size': 7})
+        (dist, _) = sitkstrats.segment_lung(img, {'probe_size': 7,
+                                                  'morphology': 'distance'})
+
+        self.assertImagesEqual(kernel, dist)
+
+
+class TestNativeLungseg(unittest.TestCase):
+    '''test lungseg's native-ITK steps against the numpy reference versions'''
+
+    def setUp(self):
+        self.img = phantom.chest_phantom(nodules=[((60, 48, 32), 4)])
+
+    def assertSameVoxels(self, img1, img2):
+        self.assertEqual(img1.GetSize(), img2.GetSize())
+        self.assertTrue(np.array_equal(sitk.GetArrayFromImage(img1),
+                                       sitk.GetArrayFromImage(img2)))
+
+    def test_steps(self):
+        img = self.img
+        for step in ['otsu', 'find_components', 'isolate_lung_field']:
+            native = getattr(lungseg, step)(img)
+            self.assertSameVoxels(native,
+                                  getattr(lungseg, step + '_numpy')(img))
+            img = native
+
+        img = lungseg.find_components(lungseg.dialate(img, 3))
+        self.assertSameVoxels(lungseg.isolate_not_biggest(img),
+                              lungseg.isolate_not_biggest_numpy(img))
+
+    def test_masked_otsu(self):
+        # pad the phantom with a large block of out-of-FOV minimum values so
+        # that the otsu mask is used
+        arr = sitk.GetArrayFromImage(self.img)
+        arr[:, :, :40] = -3024
+        img = sitk.GetImageFromArray(arr)
+
+        self.assertSameVoxels(lungseg.otsu(img), lungseg.otsu_numpy(img))
+
+    def test_label_counts(self):
+        arr = np.zeros((5, 5, 5), dtype='uint32')
+        arr[0, 0, 0:3] = 2
+        arr[4, 4, 4] = 7
+
+        self.assertEqual(lungseg.label_counts(sitk.GetImageFromArray(arr)),
+                         {0: 121, 2: 3, 7: 1})
+
+
+class TestReadWrite(unittest.TestCase):
+    '''test sitkstrats.write and read in each supported format'''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+        arr = np.arange(4*5*6, dtype='float32').reshape((4, 5, 6))
+        self.img = sitk.GetImageFromArray(arr)
+        self.img.SetOrigin((1.0, -2.0, 3.5))
+        self.img.SetSpacing((0.7, 0.7, 2.5))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_formats(self):
+        for ext in ['.nii', '.nii.gz', '.npy']:
+            fname = os.path.join(self.dir, 'sub', 'img' + ext)
+            sitkstrats.write(self.img, fname)
+            img = sitkstrats.read(fname)
+
+            self.assertEqual(img.GetPixelID(), self.img.GetPixelID())
+            self.assertEqual(img.GetSize(), self.img.GetSize())
+            np.testing.assert_allclose(img.GetOrigin(), self.img.GetOrigin())
+            np.testing.assert_allclose(img.GetSpacing(),
+                                       self.img.GetSpacing())
+            self.assertTrue(np.array_equal(sitk.GetArrayFromImage(img),
+                                           sitk.GetArrayFromImage(self.img)))
+
+    def test_crop(self):
+        arr = np.zeros((20, 30, 40), dtype='uint8')
+        arr[5:8, 10:12, 30:35] = 1
+        arr[6, 11, 32] = 2
+        img = sitk.GetImageFromArray(arr)
+        img.SetOrigin((1.0, -2.0, 3.5))
+        img.SetSpacing((0.7, 0.7, 2.5))
+
+        self.assertEqual(sitkstrats.nonzero_bounding_box(img),
+                         ([30, 10, 5], [5, 2, 3]))
+
+        for ext in ['.nii.gz', '.npy']:
+            fname = os.path.join(self.dir, 'crop' + ext)
+            sitkstrats.write(img, fname, crop=True)
+
+            cropped = sitkstrats.read(fname, full=False)
+            self.assertEqual(cropped.GetSize(), (5, 2, 3))
+            np.testing.assert_allclose(
+                cropped.GetOrigin(),
+                img.TransformIndexToPhysicalPoint((30, 10, 5)))
+
+            full = sitkstrats.read(fname)
+            self.assertEqual(full.GetSize(), img.GetSize())
+            np.testing.assert_allclose(full.GetOrigin(), img.GetOrigin())
+            self.assertTrue(np.array_equal(sitk.GetArrayFromImage(full), arr))
+
+            # rewriting uncropped leaves no stale crop geometry behind
+            small = sitk.Image(4, 4, 4, sitk.sitkUInt8)
+            sitkstrats.write(small, fname)
+            self.assertEqual(sitkstrats.read(fname).GetSize(), (4, 4, 4))
+
+    def test_crop_empty(self):
+        img = sitk.Image(10, 10, 10, sitk.sitkUInt8)
+        fname = os.path.join(self.dir, 'empty.nii.gz')
+
+        self.assertEqual(sitkstrats.nonzero_bounding_box(img), None)
+        sitkstrats.write(img, fname, crop=True)
+
+        self.assertEqual(sitkstrats.read(fname).GetSize(), (10, 10, 10))
+        self.assertEqual(sitkstrats.read(fname, full=False).GetSize(),
+                         (1, 1, 1))
+
+    def test_mmap(self):
+        fname = os.path.join(self.dir, 'img.npy')
+        sitkstrats.write(self.img, fname)
+
+        (arr, geometry) = sitkstrats.read_array(fname)
+
+        self.assertIsInstance(arr, np.memmap)
+        self.assertEqual(arr.shape, (4, 5, 6))
+        self.assertEqual(arr[3, 4, 5], 4*5*6 - 1)
+        self.assertEqual(tuple(geometry['spacing']), self.img.GetSpacing())
+
+
+class TestGeodesic(unittest.TestCase):
+    '''test sitkstrats.fastmarch_seeded_geocontour's convergence mode'''
+
+    @classmethod
+    def setUpClass(cls):
+        img = sitk.Cast(phantom.chest_phantom(size=(64, 64, 48),
+                                              nodules=[((40, 32, 24), 4)]),
+                        sitk.sitkFloat32)
+        cls.feature = sitk.Sigmoid(sitk.GradientMagnitude(img), -20, 50)
+
+    def segment(self, seed, convergence=None, lung_size=None, roi=None):
+        opts = {'geodesic': {'propagation_scaling': 2.0,
+                             'iterations': 300,
+                             'curvature_scaling': 1.0,
+                             'max_rms_change': 1e-7},
+                'seed_shift': 3,
+                'seed': seed}
+        if convergence is not None:
+            opts['geodesic']['convergence'] = convergence
+        if lung_size is not None:
+            opts['lung_size'] = lung_size
+
+        if roi is not None:
+            opts['roi'] = roi
+            return sitkstrats.roi_seeded_geocontour(self.feature, opts)
+
+        return sitkstrats.fastmarch_seeded_geocontour(self.feature, opts)
+
+    def test_converged(self):
+        (full, full_info) = self.segment([40, 32, 24])
+        self.assertEqual(full_info['geodesic']['elapsed_iterations'], 300)
+        self.assertNotIn('termination', full_info['geodesic'])
+
+        (out, info) = self.segment(
+            [40, 32, 24], {'check_interval': 20, 'tolerance': 0.01,
+                           'patience': 1, 'max_size_frac': 0.5})
+
+        self.assertEqual(info['geodesic']['termination'], 'stable')
+        self.assertLess(info['geodesic']['elapsed_iterations'], 300)
+        # the stable contour is the one the full budget converges on
+        self.assertGreater(dice(out, full), 0.9)
+
+    def test_leak(self):
+        # a seed in the lung parenchyma spreads through the whole lung
+        (_, info) = self.segment(
+            [20, 32, 24], {'check_interval': 20, 'tolerance': 0.01,
+                           'patience': 1, 'max_size_frac': 0.5},
+            lung_size=1000)
+
+        self.assertEqual(info['geodesic']['termination'], 'leak')
+        self.assertEqual(info['geodesic']['elapsed_iterations'],
+                         20 * len(info['geodesic']['size_trace']))
+        self.assertGreater(info['geodesic']['size_trace'][-1], 500)
+
+    def test_seed_level_set(self):
+        feature = sitk.Image(self.feature)
+        feature.SetSpacing((0.7, 0.7, 1.25))
+
+        for seed in ([40, 32, 24], [1, 2, 0]):
+            speed = sitk.Image(feature.GetSize(), sitk.sitkFloat64) + 1
+            speed.CopyInformation(feature)
+            fastmarch = sitk.FastMarchingImageFilter()
+            fastmarch.SetTrialPoints([seed])
+            fastmarch.SetStoppingValue(16)
+            ref = sitk.GetArrayFromImage(fastmarch.Execute(speed)) - 3
+
+            level_set = sitkstrats._seed_level_set(  # pylint: disable=W0212
+                feature, seed, 3)
+            self.assertEqual(level_set.GetSpacing(), feature.GetSpacing())
+            arr = sitk.GetArrayFromImage(level_set)
+
+            # identical wherever level set filters look at the values
+            self.assertTrue(np.array_equal(arr < 0, ref < 0))
+            near = np.abs(ref) < 2
+            np.testing.assert_allclose(arr[near], ref[near], atol=1e-5)
+
+    def test_roi(self):
+        (full, _) = self.segment([40, 32, 24])
+
+        # the region starts too small for the nodule, so has to grow
+        (out, info) = self.segment([40, 32, 24],
+                                   roi={'radius': 4, 'max_radius': 32,
+                                        'margin': 2})
+
+        self.assertEqual(out.GetSize(), full.GetSize())
+        self.assertEqual(info['roi']['final_radius'], 8)
+        self.assertFalse(info['roi']['touches_border'])
+        self.assertTrue(np.array_equal(sitk.GetArrayFromImage(out),
+                                       sitk.GetArrayFromImage(full)))
+
+
+class TestCropToSegmentation(unittest.TestCase):
+    '''test sitkstrats.crop_to_segmentation on one or several images'''
+
+    def setUp(self):
+        arr = np.zeros((20, 30, 40), dtype='uint8')
+        arr[5:8, 10:12, 30:35] = 1
+
+        self.seg = sitk.GetImageFromArray(arr)
+        self.img = sitk.GetImageFromArray(
+            np.arange(arr.size, dtype='int32').reshape(arr.shape))
+
+    def test_several(self):
+        (seg, seg_info) = sitkstrats.crop_to_segmentation(
+            self.seg, self.seg, padding_px=2)
+        (img, img_info) = sitkstrats.crop_to_segmentation(
+            self.img, self.seg, padding_px=2)
+        ((seg2, img2), info) = sitkstrats.crop_to_segmentation(
+            [self.seg, self.img], self.seg, padding_px=2)
+
+        self.assertEqual(seg.GetSize(), (9, 6, 7))
+        self.assertEqual(info['origin'], seg_info['origin'])
+        self.assertEqual(info['padding'], img_info['padding'])
+
+        for (a, b) in [(seg, seg2), (img, img2)]:
+            self.assertTrue(np.array_equal(sitk.GetArrayFromImage(a),
+                                           sitk.GetArrayFromImage(b)))
+
+    def test_bbox(self):
+        bbox = sitkstrats.nonzero_bounding_box(self.seg)
+
+        (img, info) = sitkstrats.crop_to_segmentation(self.img, bbox)
+        (expected, _) = sitkstrats.crop_to_segmentation(self.img, self.seg)
+
+        self.assertEqual(info['origin'], (5, 10, 30))
+        self.assertTrue(np.array_equal(sitk.GetArrayFromImage(img),
+                                       sitk.GetArrayFromImage(expected)))
+
+        with self.assertRaises(ValueError):
+            sitkstrats.crop_to_segmentation(self.img, None)
+
+
+class TestSegmentStats(unittest.TestCase):
+    '''test sitkstrats.segment_stats against numpy'''
+
+    def setUp(self):
+        self.arr = np.zeros((10, 11, 12), dtype='int16')
+        self.arr[2:5, 3, 4:9] = 3
+        self.arr[7, 1:2, 8:11] = 1
+        self.arr[8, 9, 10] = -2
+
+    def check(self, img):
+        stats = sitkstrats.segment_stats(img)
+        nonzero = np.argwhere(self.arr != 0)
+
+        self.assertEqual(stats['size'], len(nonzero))
+        self.assertEqual(stats['bbox'], [
+            list(reversed(nonzero.min(axis=0))),
+            list(reversed(nonzero.max(axis=0) - nonzero.min(axis=0) + 1))])
+        self.assertTrue(np.allclose(stats['centroid'],
+                                    nonzero.mean(axis=0)[::-1]))
+
+    def test_labels(self):
+        img = sitk.GetImageFromArray(self.arr)
+        img.SetSpacing((0.5, 0.7, 2.0))
+        img.SetOrigin((1, 2, 3))
+
+        self.check(img)
+        self.check(sitk.Cast(img, sitk.sitkFloat32))
+
+        # a second call is answered from the cache, but a copy that is
+        # changed isn't
+        self.check(img)
+
+        copy = sitk.Image(img)
+        copy.SetPixel(0, 0, 0, 1)
+        self.assertEqual(sitkstrats.segment_stats(copy)['size'],
+                         np.count_nonzero(self.arr) + 1)
+
+    def test_empty(self):
+        img = sitk.Image((4, 5, 6), sitk.sitkUInt8)
+
+        self.assertEqual(sitkstrats.segment_stats(img),
+                         {'size': 0, 'bbox': None, 'centroid': None})
+        self.assertEqual(sitkstrats.nonzero_bounding_box(img), None)
+
+    def test_log_size(self):
+        img = sitk.GetImageFromArray((self.arr != 0).astype('uint8'))
+        opts = {'threshold': 0.5, 'max_size': 100, 'min_size': 1}
+
+        (out, info) = sitkstrats.segmentation_union([img, img], opts)
+
+        self.assertEqual(info['size'], np.count_nonzero(self.arr))
+        self.assertEqual(tuple(info['bbox']),
+                         sitkstrats.nonzero_bounding_box(img))
+        self.assertEqual(sitkstrats.segment_stats(out)['size'], info['size'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import tempfile
+import shutil
+import json
+import os
+import threading
+import SimpleITK as sitk  # pylint: disable=F0401
+import numpy as np
+
+import tracing
+import sitkstrats
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class TestTracing(unittest.TestCase):
+    '''test tracing spans, conversion counts and export'''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.img = sitk.GetImageFromArray(np.ones((10, 11, 12), dtype='uint8'))
+
+    def tearDown(self):
+        tracing.disable()
+        shutil.rmtree(self.dir)
+
+    def test_spans(self):
+        original = sitk.BinaryThreshold
+        tracer = tracing.enable()
+        self.assertIsNot(sitk.BinaryThreshold, original)
+
+        with tracing.span('outer', 'seed', seed='1-2-3') as timer:
+            sitk.GetArrayFromImage(self.img)
+            sitk.GetArrayViewFromImage(self.img)
+            with tracing.span('inner'):
+                sitk.BinaryThreshold(self.img, 1, 1)
+
+        self.assertEqual(tracing.disable(), tracer)
+        self.assertIs(sitk.BinaryThreshold, original)
+
+        # spans are recorded as they close, innermost first
+        names = [e['name'] for e in tracer.events]
+        self.assertEqual(names, ['BinaryThreshold', 'inner', 'outer'])
+
+        outer = tracer.events[-1]
+        self.assertEqual(outer['cat'], 'seed')
+        self.assertEqual(outer['args']['seed'], '1-2-3')
+        self.assertEqual(outer['args']['conversions'], 1)
+        self.assertEqual(outer['args']['bytes_copied'], 10 * 11 * 12)
+        self.assertEqual(outer['args']['views'], 1)
+        self.assertEqual(tracer.events[1]['args']['conversions'], 0)
+        self.assertAlmostEqual(timer.wall, outer['dur'] / 1e6)
+
+        summary = tracing.summarize(tracer)
+        self.assertEqual(summary['filter:BinaryThreshold']['n'], 1)
+        self.assertEqual(summary['seed:outer']['conversions'], 1)
+
+        fname = os.path.join(self.dir, 'trace.json')
+        tracing.export_chrome(tracer, fname)
+        with open(fname) as f:
+            events = json.loads(f.read())['traceEvents']
+        self.assertEqual(len([e for e in events if e['ph'] == 'X']), 3)
+
+    def test_threads(self):
+        tracer = tracing.enable()
+
+        # conversions on another thread aren't charged to this one's spans
+        with tracing.span('main'):
+            worker = threading.Thread(
+                target=sitk.GetArrayFromImage, args=(self.img,))
+            worker.start()
+            worker.join()
+        tracing.disable()
+
+        self.assertEqual(tracer.events[-1]['args']['conversions'], 0)
+
+    def test_disabled(self):
+        with tracing.span('untraced') as timer:
+            pass
+        self.assertGreaterEqual(timer.wall, 0)
+
+        # strategies are timed whether or not tracing is on
+        (_, opts) = sitkstrats.curvature_flow(
+            sitk.Cast(self.img, sitk.sitkFloat32),
+            {'curvature_flow': {'timestep': 0.01, 'iterations': 1}})
+        self.assertEqual(opts['algorithm'], 'curvature_flow')
+        self.assertGreaterEqual(opts['time'].total_seconds(), 0)
+
+    def test_iterspans(self):
+        tracer = tracing.enable()
+        for item in tracing.iterspans([1, 2, 3], 'item'):
+            if item == 2:
+                continue
+        tracing.disable()
+
+        self.assertEqual([e['args']['item'] for e in tracer.events],
+                         ['1', '2', '3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
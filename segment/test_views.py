@@ -0,0 +1,93 @@
+import gc
+import unittest
+import SimpleITK as sitk  # pylint: disable=F0401
+import numpy as np
+
+import views
+import rle
+import lungseg
+import sitkstrats
+import phantom
+
+# pylint: disable=missing-docstring
+# pylint: disable=invalid-name
+
+
+class TestViews(unittest.TestCase):
+    '''test views against the copying SimpleITK conversions'''
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.arr = rng.randint(0, 5, size=(6, 7, 8)).astype('int16')
+
+        self.img = sitk.GetImageFromArray(self.arr)
+        self.img.SetSpacing((0.5, 0.7, 2.0))
+        self.img.SetOrigin((1, 2, 3))
+
+    def test_array_view(self):
+        view = views.array_view(self.img)
+
+        self.assertTrue(np.array_equal(view, sitk.GetArrayFromImage(self.img)))
+        self.assertEqual(view.dtype, self.arr.dtype)
+        self.assertFalse(view.flags.writeable)
+
+        with self.assertRaises(ValueError):
+            view[0, 0, 0] = 1
+
+    def test_lifetime(self):
+        # views, and slices of them, keep their image alive
+        view = views.array_view(sitk.GetImageFromArray(self.arr))[2:]
+        gc.collect()
+        junk = [np.ones(self.arr.shape) for _ in range(10)]
+
+        self.assertTrue(np.array_equal(view, self.arr[2:]))
+        self.assertEqual(len(junk), 10)
+
+    def test_new_image(self):
+        (img, arr) = views.new_image(self.img, sitk.sitkUInt8)
+
+        self.assertEqual(img.GetSpacing(), self.img.GetSpacing())
+        self.assertEqual(img.GetOrigin(), self.img.GetOrigin())
+        self.assertEqual(arr.dtype, np.uint8)
+        self.assertEqual(np.count_nonzero(arr), 0)
+
+        arr[...] = self.arr > 2
+        arr[1, 2, 3] = 7
+
+        self.assertEqual(img.GetPixel(3, 2, 1), 7)
+        self.assertEqual(np.count_nonzero(sitk.GetArrayFromImage(img)),
+                         np.count_nonzero(arr))
+
+    def test_no_behaviour_change(self):
+        self.assertEqual(
+            sitkstrats.hash_img(self.img, 'x'),
+            sitkstrats.hash_img(sitk.GetImageFromArray(self.arr), 'x'))
+
+        mask = rle.RLEMask.from_image(self.img)
+        self.assertTrue(np.array_equal(
+            sitk.GetArrayFromImage(mask.to_image()), self.arr != 0))
+
+    def test_refine_boundary(self):
+        img = phantom.chest_phantom(size=(48, 48, 32), noise=0)
+        mask = sitkstrats._lung_mask(  # pylint: disable=W0212
+            lungseg.shrink(img, 2), 2, 1)
+
+        refined = lungseg.refine_boundary(mask, img)
+
+        # the old, copying, construction of the refined mask
+        frac = sitk.GetArrayFromImage(sitk.Resample(
+            sitk.Cast(mask, sitk.sitkFloat32), img, sitk.Transform(),
+            sitk.sitkLinear, 0.0, sitk.sitkFloat32))
+        band = np.logical_and(frac > 1e-3, frac < 1 - 1e-3)
+        air = lungseg.otsu(img)
+        air = sitk.GetArrayFromImage(sitk.Equal(air, air.GetPixel(0, 0, 0)))
+        expected = np.array(frac >= 1 - 1e-3, dtype='uint8')
+        expected[band] = air[band]
+
+        self.assertEqual(refined.GetPixelID(), mask.GetPixelID())
+        self.assertTrue(np.array_equal(sitk.GetArrayFromImage(refined),
+                                       expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+'''A lightweight tracer for finding where a run spends its time. Spans nest
+(image, seed, strategy, filter) and record their wall and cpu time, the growth
+of the process's peak memory and the number of SimpleITK image/array
+conversions made within them. Tracing is off until enable() is called, and
+spans cost next to nothing while it is. Traces can be exported in the Chrome
+trace event format (load them at chrome://tracing or ui.perfetto.dev) or
+summarised for the run JSON.'''
+
+import time
+import json
+import threading
+import resource
+from functools import wraps
+from contextlib import contextmanager
+
+import SimpleITK as sitk  # pylint: disable=F0401
+
+# the conversions between SimpleITK images and numpy arrays that are counted,
+# and whether each copies the pixel buffer
+CONVERSIONS = {'GetArrayFromImage': True,
+               'GetImageFromArray': True,
+               'GetArrayViewFromImage': False}
+
+# SimpleITK functions that are never traced as filters: conversions are
+# counted rather than traced, and the rest are trivial
+UNTRACED = ('Show', 'Version', 'ProcessObject')
+
+
+class Tracer(object):
+    '''
+    Collects finished spans as Chrome trace 'complete' events. Each thread
+    has its own stack of open spans. While a tracer is installed (see
+    enable) SimpleITK's procedural filters are wrapped so that each call is
+    a span of category 'filter', and image/array conversions are counted.
+    Conversions are counted per thread, so those made on one thread (eg. by
+    the background writer) aren't charged to spans open on another.
+    '''
+
+    def __init__(self):
+        self.events = []
+        self.epoch = time.time()
+        self.local = threading.local()
+        self.patched = {}
+
+        # the names of the threads spans have been seen on, by ident
+        self.threads = {}
+
+    def stack(self):
+        '''The open spans of this thread.'''
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def counts(self):
+        '''The conversions made on this thread.'''
+        if not hasattr(self.local, 'counts'):
+            self.local.counts = {'conversions': 0, 'bytes_copied': 0,
+                                 'views': 0}
+        return self.local.counts
+
+    def snapshot(self):
+        '''The current values of everything a span measures the change in.'''
+        return (time.time(), time.clock(),
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                dict(self.counts()))
+
+    def begin(self, name, cat, args):
+        '''Open a span on this thread.'''
+        self.stack().append((name, cat, args, self.snapshot()))
+
+    def end(self):
+        '''Close the innermost span of this thread, and return its event.'''
+        (name, cat, args, (wall, cpu, rss, counts)) = self.stack().pop()
+        (wall_end, cpu_end, rss_end, counts_end) = self.snapshot()
+
+        event_args = dict(args)
+        event_args.update({'cpu_s': cpu_end - cpu,
+                           'maxrss_delta_kb': rss_end - rss})
+        event_args.update((k, counts_end[k] - counts[k]) for k in counts)
+
+        thread = threading.current_thread()
+        self.threads[thread.ident] = thread.name
+
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': 0,
+                 'tid': thread.ident,
+                 'ts': (wall - self.epoch) * 1e6,
+                 'dur': (wall_end - wall) * 1e6,
+                 'args': event_args}
+        self.events.append(event)
+
+        return event
+
+    def count(self, copies, nbytes):
+        '''Count a conversion between an image and an array, made on this
+        thread.'''
+        counts = self.counts()
+        if copies:
+            counts['conversions'] += 1
+            counts['bytes_copied'] += nbytes
+        else:
+            counts['views'] += 1
+
+    def _wrap_filter(self, name, func):
+        '''Wrap the SimpleITK function func so each call is a span.'''
+        @wraps(func)
+        def traced_filter(*args, **kwargs):  # pylint: disable=C0111
+            self.begin(name, 'filter', {})
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.end()
+
+        return traced_filter
+
+    def _wrap_conversion(self, name, func, copies):
+        '''Wrap the SimpleITK conversion func so each call is counted.'''
+        @wraps(func)
+        def counted(obj, *args, **kwargs):  # pylint: disable=C0111
+            out = func(obj, *args, **kwargs)
+            self.count(copies, getattr(out, 'nbytes', None) or
+                       getattr(obj, 'nbytes', 0))
+            return out
+
+        return counted
+
+    def patch(self):
+        '''Wrap SimpleITK's procedural functions.'''
+        for name in dir(sitk):
+            func = getattr(sitk, name)
+
+            if not name[0].isupper() or isinstance(func, type) or \
+               not callable(func) or name.startswith(UNTRACED):
+                continue
+
+            self.patched[name] = func
+            if name in CONVERSIONS:
+                setattr(sitk, name, self._wrap_conversion(
+                    name, func, CONVERSIONS[name]))
+            else:
+                setattr(sitk, name, self._wrap_filter(name, func))
+
+    def unpatch(self):
+        '''Restore the functions wrapped by patch.'''
+        for (name, func) in self.patched.items():
+            setattr(sitk, name, func)
+        self.patched = {}
+
+
+# the installed tracer, or None if tracing is disabled
+TRACER = None
+
+
+def enable():
+    '''Start tracing with a new tracer, and return it.'''
+    global TRACER  # pylint: disable=W0603
+    disable()
+
+    TRACER = Tracer()
+    TRACER.patch()
+
+    return TRACER
+
+
+def disable():
+    '''Stop tracing, and return the tracer that was in use (or None).'''
+    global TRACER  # pylint: disable=W0603
+    tracer = TRACER
+
+    if tracer is not None:
+        tracer.unpatch()
+    TRACER = None
+
+    return tracer
+
+
+class Timer(object):
+    '''The wall time of a span, available (as wall, in seconds) once the span
+    has closed whether or not tracing is enabled.'''
+
+    def __init__(self):
+        self.start = time.time()
+        self.wall = None
+
+
+@contextmanager
+def span(name, cat='span', **args):
+    '''
+    Trace the block as a span named name, in category cat, annotated with the
+    (JSON-able) keyword arguments. Yields a Timer, so that callers can use the
+    span's time whether or not tracing is enabled.
+    '''
+    timer = Timer()
+    tracer = TRACER
+
+    if tracer is not None:
+        tracer.begin(name, cat, args)
+    try:
+        yield timer
+    finally:
+        if tracer is not None:
+            timer.wall = tracer.end()['dur'] / 1e6
+        else:
+            timer.wall = time.time() - timer.start
+
+
+def iterspans(items, name, cat='span', label=str):
+    '''Iterate over items, tracing the work done on each (until the next is
+    requested) as a span annotated with label(item).'''
+    for item in items:
+        with span(name, cat, item=label(item)):
+            yield item
+
+
+def traced(cat='span'):
+    '''A decorator tracing each call of the function as a span.'''
+    def traced_decorator(func):  # pylint: disable=C0111
+        @wraps(func)
+        def exec_func(*args, **kwargs):  # pylint: disable=C0111
+            with span(func.__name__, cat):
+                return func(*args, **kwargs)
+        return exec_func
+    return traced_decorator
+
+
+def summarize(tracer):
+    '''
+    Aggregate the spans of tracer by category and name into a dict of
+    'cat:name' to the number of spans and their total wall and cpu time,
+    the largest growth in peak memory any caused, and the conversions made
+    in them. Times and counts include those of spans nested inside.
+    '''
+    summary = {}
+
+    for event in tracer.events:
+        key = event['cat'] + ":" + event['name']
+        entry = summary.setdefault(key, {'n': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                         'maxrss_delta_kb': 0,
+                                         'conversions': 0, 'views': 0,
+                                         'bytes_copied': 0})
+        args = event['args']
+
+        entry['n'] += 1
+        entry['wall_s'] += event['dur'] / 1e6
+        entry['cpu_s'] += args['cpu_s']
+        entry['maxrss_delta_kb'] = max(entry['maxrss_delta_kb'],
+                                       args['maxrss_delta_kb'])
+        for k in ('conversions', 'views', 'bytes_copied'):
+            entry[k] += args[k]
+
+    return summary
+
+
+def export_chrome(tracer, fname):
+    '''Write the spans of tracer to fname in the Chrome trace event format.'''
+    names = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': ident,
+              'args': {'name': name}}
+             for (ident, name) in tracer.threads.items()]
+
+    with open(fname, 'w') as f:
+        f.write(json.dumps({'traceEvents': names + tracer.events,
+                            'displayTimeUnit': 'ms'}, default=str))
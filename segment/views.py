@@ -0,0 +1,54 @@
+'''
+Zero-copy access to the pixel buffers of SimpleITK images as numpy arrays.
+
+sitk.GetArrayFromImage and sitk.GetImageFromArray each copy the whole pixel
+buffer. Reading an image through a view, or building an image by writing
+into a view of a freshly allocated one, avoids those copies. A bare
+sitk.GetArrayViewFromImage does not keep its image alive (reading it after
+the image is freed crashes the interpreter), so the views made here hold a
+reference to their image for as long as they, or any array derived from
+them without copying, exist.
+'''
+
+import numpy as np
+import SimpleITK as sitk  # pylint: disable=F0401
+
+
+class _PixelBuffer(object):
+    '''The pixel buffer of img, exposed through the numpy array interface.
+    numpy keeps this object (and so img) alive as the base of every array
+    made from it.'''
+
+    def __init__(self, img, writeable):
+        view = sitk.GetArrayViewFromImage(img)
+
+        interface = dict(view.__array_interface__)
+        interface['data'] = (interface['data'][0], not writeable)
+
+        self.__array_interface__ = interface
+        self.image = img
+
+
+def array_view(img):
+    '''A read-only array, in numpy (z, y, x) order, viewing the pixels of img
+    without copying them.'''
+    return np.asarray(_PixelBuffer(img, writeable=False))
+
+
+def writeable_view(img):
+    '''An array viewing the pixels of img, through which they can be changed
+    in place.'''
+    return np.asarray(_PixelBuffer(img, writeable=True))
+
+
+def new_image(like, pixel_id):
+    '''
+    Allocate a zeroed image of type pixel_id with the size and geometry of the
+    image like, to be filled in place. Returns the image and a writeable view
+    of it, so that an image computed in numpy can be built without the copy
+    made by sitk.GetImageFromArray.
+    '''
+    img = sitk.Image(like.GetSize(), pixel_id)
+    img.CopyInformation(like)
+
+    return (img, writeable_view(img))
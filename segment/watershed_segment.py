@@ -22,6 +22,9 @@ def process_command_line(argv):
     parser.add_argument('--intermediate_images', action="store_true",
                         default=False, help="Produce pipeline intermediate " +
                         "images (i.e. after each filter stage.")
+    parser.add_argument('--preload', action="store_true", default=False,
+                        help="Load itk and the filters used before " +
+                        "segmenting, rather than with the first image.")
 
     segstrats.register_options(segstrats.aniso_gauss_watershed, parser)
 
@@ -67,6 +70,10 @@ def main(argv=None):
         basefname = os.path.basename(fname)
         return args.seeds[basefname]
 
+    if args.preload:
+        import itk_attach
+        print "Loaded itk in", itk_attach.preload(), "seconds"
+
     seg_opts = {"watershed":  {"level": args.watershed_level,
                                "threshold": args.watershed_threshold},
                 "gauss": {"sigma": args.sigma}